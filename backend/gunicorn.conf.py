@@ -0,0 +1,53 @@
+# 本番用のgunicorn設定
+#   gunicorn -c gunicorn.conf.py project.asgi:application
+#
+# ASGI（uvicornワーカー）で動かし、PDFの抽出・OCRは各ワーカーの
+# プロセスプール（CONVERSION_WORKERS）で実行する。
+# WSGIで動かす場合は GUNICORN_WORKER_CLASS=gthread と project.wsgi:application を指定する。
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# CPUを使う処理はプロセスプールで行うため、リクエストを受けるワーカーは少なくてよい
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 4)))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "uvicorn_worker.UvicornWorker")
+# gthreadの場合のスレッド数
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# OCRは数十秒かかることがある
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+# PyMuPDFやpandasで増えたメモリを解放するため、一定数のリクエストごとに入れ替える
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 500))
+max_requests_jitter = 50
+
+# マスタープロセスでアプリと重いライブラリを読み込んでからワーカーをフォークする
+# （ワーカーごとの起動時間とメモリを減らす）。GUNICORN_PRELOAD=0 で無効にする
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+
+def when_ready(server):
+    # ワーカーをフォークする前にマスタープロセスで呼ばれる
+    if not preload_app:
+        return
+    from pdfupload.preload import preload_modules
+
+    seconds = preload_modules()
+    server.log.info("Preloaded %s in %.2fs", ", ".join(seconds), sum(seconds.values()))
+
+
+def post_worker_init(worker):
+    # 前のワーカーが処理しきれずに残したジョブ（待機中・処理中のまま止まったもの）を再開する
+    from pdfupload.jobs import resume_jobs
+
+    try:
+        resume_jobs()
+    except Exception:
+        worker.log.exception("Could not resume conversion jobs")
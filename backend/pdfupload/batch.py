@@ -0,0 +1,182 @@
+import os
+import re
+import zipfile
+from collections import Counter
+
+from django.core.files import File
+
+from .cache import save_upload
+from .metrics import count
+
+
+# Excelのシート名に使えない文字
+_INVALID_SHEET_CHARS_RE = re.compile(r"[\[\]:*?/\\]")
+_MAX_SHEET_NAME_LENGTH = 31
+_ZIP_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed")
+
+
+class BatchError(Exception):
+    """バッチで受け取ったファイルが不正"""
+
+
+class _CorruptMember(BatchError):
+    """zip内のファイルが壊れていて展開できない（そのファイルだけを失敗にする）"""
+
+
+class BatchReport:
+    """バッチのファイルごとの変換の結果
+
+    failed_files: 展開または変換に失敗し、結果に含まれていないファイルの (名前, エラー)
+    parsed_rows・skipped_rows・failed_rows: 変換できたファイルのConversionReportの合計
+    """
+
+    def __init__(self):
+        self.converted_files = 0
+        self.failed_files = []
+        self.parsed_rows = 0
+        self.skipped_rows = 0
+        self.failed_rows = 0
+
+    def add(self, report):
+        """変換できたファイルのConversionReportを加える"""
+        self.converted_files += 1
+        self.parsed_rows += report.parsed_rows
+        self.skipped_rows += report.skipped_rows
+        self.failed_rows += report.failed_rows
+
+    def add_failed_file(self, name, error):
+        self.failed_files.append((name, str(error)))
+        count("failed_files", 1)
+
+
+def _is_zip(file_obj):
+    return (
+        file_obj.name.lower().endswith(".zip")
+        or getattr(file_obj, "content_type", None) in _ZIP_CONTENT_TYPES
+    )
+
+
+class _LimitedMember:
+    """zip内のファイルを読みながら、展開したバイト数を残りの上限から差し引く
+
+    ヘッダーのサイズは偽れるので、実際に展開したバイト数で上限を超えたら止める。
+    """
+
+    def __init__(self, member, name, budget):
+        self.member = member
+        self.name = name
+        self.budget = budget
+
+    def read(self, size=-1):
+        try:
+            data = self.member.read(size)
+        except zipfile.BadZipFile as e:
+            raise _CorruptMember(f"zipファイルを展開できません: {e}")
+        self.budget[0] -= len(data)
+        if self.budget[0] < 0:
+            raise BatchError(f"{self.name}: zipファイルの展開後のサイズが大きすぎます")
+        return data
+
+
+def _check_archive(name, members, max_bytes, max_ratio):
+    """開く前に、展開後の合計サイズと圧縮率をzipのヘッダーで確かめる"""
+    if max_bytes and sum(info.file_size for info in members) > max_bytes:
+        raise BatchError(f"{name}: zipファイルの展開後のサイズが大きすぎます")
+    for info in members:
+        if max_ratio and info.file_size > max_ratio * max(info.compress_size, 1):
+            raise BatchError(f"{name}/{info.filename}: 圧縮率が高すぎます")
+
+
+def iter_batch_pdfs(files, max_bytes=0, max_ratio=0):
+    """アップロードされたファイル（PDFまたはPDFを含むzip）から (名前, ファイル) を返す
+
+    zipは展開後の合計がmax_bytesを超えるもの、圧縮率（展開後/圧縮後）が
+    max_ratioを超えるファイルを含むものを断る（0は無制限）。
+    """
+    for file_obj in files:
+        if not _is_zip(file_obj):
+            yield file_obj.name, file_obj
+            continue
+        try:
+            archive = zipfile.ZipFile(file_obj)
+        except zipfile.BadZipFile as e:
+            raise BatchError(f"{file_obj.name}: zipファイルを開けません: {e}")
+        with archive:
+            members = [
+                info
+                for info in archive.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(".pdf")
+            ]
+            _check_archive(file_obj.name, members, max_bytes, max_ratio)
+            # zip全体で展開してよい残りのバイト数
+            budget = [max_bytes or float("inf")]
+            for info in members:
+                with archive.open(info) as member:
+                    yield f"{file_obj.name}/{info.filename}", File(
+                        _LimitedMember(member, file_obj.name, budget)
+                    )
+
+
+def spool_batch(files, directory, max_files, max_bytes=0, max_ratio=0, report=None):
+    """PDFを1件ずつdirectoryに書き出し、(名前, パス, SHA-256) のリストを返す
+
+    zip内の壊れたファイルはreport（BatchReport）に記録して飛ばし、残りを書き出す。
+    """
+    documents = []
+    for index, (name, file_obj) in enumerate(
+        iter_batch_pdfs(files, max_bytes, max_ratio)
+    ):
+        if index >= max_files:
+            raise BatchError(f"一度に処理できるPDFは{max_files}件までです")
+        path = os.path.join(directory, f"{index}.pdf")
+        try:
+            with open(path, "wb") as destination:
+                digest = save_upload(file_obj, destination)
+        except _CorruptMember as e:
+            os.remove(path)
+            if report is not None:
+                report.add_failed_file(name, e)
+            continue
+        documents.append((name, path, digest))
+    return documents
+
+
+def merge_records(results):
+    """ファイルごとのレコードを1つにまとめる
+
+    同じ明細が複数のファイルに含まれている場合は1件として扱う。
+    1つのファイル内の同一内容の行（同じ日に同じ区間を複数回利用など）は残す。
+    """
+    merged = []
+    seen = Counter()
+    for records in results:
+        counts = Counter()
+        for record in records:
+            counts[record] += 1
+            if counts[record] > seen[record]:
+                merged.append(record)
+        seen |= counts
+    return merged
+
+
+def sheet_name(name, used):
+    """Excelで使えるシート名にする（重複する場合は連番を付ける）"""
+    # マスクされたカード番号（****1234）は "1234" のようになる
+    base = _INVALID_SHEET_CHARS_RE.sub("", name)[:_MAX_SHEET_NAME_LENGTH] or "_"
+    candidate = base
+    number = 2
+    while candidate in used:
+        suffix = f"_{number}"
+        candidate = base[: _MAX_SHEET_NAME_LENGTH - len(suffix)] + suffix
+        number += 1
+    used.add(candidate)
+    return candidate
+
+
+def split_by_card(records):
+    """カード番号ごとのシートに分ける（出現順）"""
+    by_card = {}
+    for record in records:
+        by_card.setdefault(record.card_number, []).append(record)
+    used = set()
+    return [(sheet_name(card, used), rows) for card, rows in by_card.items()]
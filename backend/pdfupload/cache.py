@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+from django.conf import settings
+
+from .metrics import count
+
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCacheBackend:
+    """ローカルディスクに結果を保存するバックエンド
+
+    ファイルの更新時刻を最終アクセス時刻として使い、
+    合計サイズがmax_bytesを超えたら古いものから削除する（LRU）。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("キャッシュの読み込みに失敗しました: %s", e)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        # 書き込み途中のファイルを読まれないよう、一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(".pickle"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                logger.debug("Evicted cache entry %s", path)
+
+
+class DjangoCacheBackend:
+    """Djangoのキャッシュフレームワークを使うバックエンド
+
+    削除のポリシーは設定されたキャッシュ（MAX_ENTRIESなど）に従う。
+    変換はプロセスプールの各プロセスで実行するため、RedisやMemcachedなど
+    プロセス間で共有できるキャッシュを使う（process_localを参照）。
+    """
+
+    def __init__(self, alias="default", timeout=None):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    @property
+    def process_local(self):
+        """キャッシュがプロセスごとに別々か（LocMemCacheとDummyCache）"""
+        from django.core.cache.backends.dummy import DummyCache
+        from django.core.cache.backends.locmem import LocMemCache
+
+        return isinstance(self.cache, (LocMemCache, DummyCache))
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.timeout)
+
+
+class ResultCache:
+    """アップロードされたPDFの内容ハッシュをキーに抽出結果を保存する"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def make_key(self, namespace, digest, version):
+        return f"pdf-{namespace}-v{version}-{digest}"
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        # ワーカープロセスでの参照も、StageTimerの件数として呼び出し元に返る
+        count("cache_misses" if value is None else "cache_hits", 1)
+        return value
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            logger.warning("キャッシュへの保存に失敗しました: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+class NullCache(ResultCache):
+    """キャッシュ無効時に使う何も保存しないキャッシュ"""
+
+    def __init__(self):
+        super().__init__(backend=None)
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """設定に応じたResultCacheを返す（プロセス内で共有）"""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            backend_name = getattr(settings, "PDF_CACHE_BACKEND", "")
+            backend = None
+            if backend_name == "django":
+                backend = DjangoCacheBackend(settings.PDF_CACHE_ALIAS)
+                if backend.process_local:
+                    # ワーカープロセスごとに別のキャッシュになり、ほとんどヒットしない
+                    logger.warning(
+                        "Cache %r is local to each process, using the disk cache "
+                        "in %s instead",
+                        settings.PDF_CACHE_ALIAS,
+                        settings.PDF_CACHE_DIR,
+                    )
+                    backend_name = "disk"
+            if backend_name == "disk":
+                backend = DiskCacheBackend(
+                    settings.PDF_CACHE_DIR, settings.PDF_CACHE_MAX_BYTES
+                )
+            _result_cache = NullCache() if backend is None else ResultCache(backend)
+        return _result_cache
+
+
+def save_upload(file_obj, destination):
+    """アップロードをdestinationに書き込みながらSHA-256を計算して返す"""
+    digest = hashlib.sha256()
+    for chunk in file_obj.chunks():
+        digest.update(chunk)
+        destination.write(chunk)
+    destination.flush()
+    return digest.hexdigest()
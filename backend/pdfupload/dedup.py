@@ -0,0 +1,62 @@
+import hashlib
+from collections import Counter
+
+from . import models
+
+
+# 保存済みの指紋を何件ずつDBに問い合わせるか
+LOOKUP_BATCH_SIZE = 1000
+
+
+def trip_fingerprint(card_number, date, entry_ic, exit_ic, fee, occurrence):
+    """1回の利用を表す64ビットの指紋（BigIntegerFieldに入る符号付き整数）を返す"""
+    key = "\x1f".join(
+        (
+            card_number,
+            "" if date is None else date.isoformat(),
+            entry_ic,
+            exit_ic,
+            "" if fee is None else str(fee),
+            str(occurrence),
+        )
+    )
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def trip_fingerprints(columns):
+    """正規化した列（normalize_columnsの戻り値）から、行ごとの指紋のリストを返す
+
+    カード番号・利用年月日・入口IC・出口IC・割引後の金額が同じ行は、同じ明細の中で
+    何回目に出てきたかも指紋に含める。merge_recordsと同じく、1つの明細の中の
+    同じ内容の行（同じ日に同じ区間を複数回利用など）は別の利用として扱う。
+    時刻はOCRで読み違えやすく、保存済みのレコードにもないので使わない。
+    """
+    seen = Counter()
+    fingerprints = []
+    for key in zip(
+        columns["card_number"],
+        columns["date"],
+        columns["entry_ic"],
+        columns["exit_ic"],
+        columns["final_fee"],
+    ):
+        fingerprints.append(trip_fingerprint(*key, seen[key]))
+        seen[key] += 1
+    return fingerprints
+
+
+def find_stored_fingerprints(fingerprints):
+    """fingerprintsのうちDBに保存済みのものの集合を返す
+
+    LOOKUP_BATCH_SIZE件ずつ、指紋の一意インデックスで引く。
+    """
+    fingerprints = list(fingerprints)
+    found = set()
+    for start in range(0, len(fingerprints), LOOKUP_BATCH_SIZE):
+        found.update(
+            models.EtcRecord.objects.filter(
+                fingerprint__in=fingerprints[start : start + LOOKUP_BATCH_SIZE]
+            ).values_list("fingerprint", flat=True)
+        )
+    return found
@@ -0,0 +1,212 @@
+import csv
+import datetime
+import json
+import tempfile
+
+from django.http import FileResponse, StreamingHttpResponse
+
+from .normalize import TYPED_COLUMNS, normalize_columns, typed_rows
+from .parser import output_headers
+
+
+EXCEL_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXCEL_SHEET_NAME = "ETCデータ"
+EXCEL_FILENAME = "etc_data.xlsx"
+
+# これより大きい出力ファイルはメモリではなく一時ファイルに書き出す
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+# CSV・NDJSON・Parquetで共通の列名
+EXPORT_COLUMNS = TYPED_COLUMNS
+
+DATE_NUMBER_FORMAT = "yyyy/mm/dd"
+TIME_NUMBER_FORMAT = "hh:mm"
+AMOUNT_NUMBER_FORMAT = "#,##0"
+
+
+def _excel_rows(sheet, records):
+    """レコードをoutput_headers()の並びの型付きのセルの行にして返す
+
+    日付はdate、時刻はtime、金額・利用月は整数。
+    変換できなかった値は明細の文字列のまま書き込む。
+    """
+    from openpyxl.cell import WriteOnlyCell
+
+    def cell(value, raw, number_format):
+        if value is None:
+            return raw
+        cell = WriteOnlyCell(sheet, value)
+        cell.number_format = number_format
+        return cell
+
+    records = list(records)
+    columns = normalize_columns(records)
+    width = len(output_headers())
+    for record, month, date, original_fee, final_fee, entry_at, exit_at in zip(
+        records,
+        columns["month"],
+        columns["date"],
+        columns["original_fee"],
+        columns["final_fee"],
+        columns["entry_at"],
+        columns["exit_at"],
+    ):
+        yield [
+            record.card_number,
+            record.month if month is None else month,
+            cell(date, record.date, DATE_NUMBER_FORMAT),
+            record.vehicle_type,
+            record.vehicle_number,
+            record.entry_ic,
+            record.exit_ic,
+            cell(original_fee, record.original_fee, AMOUNT_NUMBER_FORMAT),
+            cell(final_fee, record.final_fee, AMOUNT_NUMBER_FORMAT),
+            cell(entry_at and entry_at.time(), record.entry_time, TIME_NUMBER_FORMAT),
+            cell(exit_at and exit_at.time(), record.exit_time, TIME_NUMBER_FORMAT),
+        ][:width]
+
+
+def write_workbook(sheets, file, tables=()):
+    """(シート名, レコード) のリストをxlsxとしてfileに書き出す
+
+    tablesには集計結果などを (シート名, ヘッダー, 行) のリストで渡すと、
+    レコードのシートの後ろに追加する。
+    openpyxlの書き込み専用モードで1行ずつ書き出すため、
+    ワークブック全体をメモリ上に組み立てない。
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for sheet_name, records in sheets:
+        sheet = workbook.create_sheet(title=sheet_name)
+        sheet.append(output_headers())
+        for row in _excel_rows(sheet, records):
+            sheet.append(row)
+    for sheet_name, headers, rows in tables:
+        sheet = workbook.create_sheet(title=sheet_name)
+        sheet.append(headers)
+        for row in rows:
+            sheet.append(row)
+    workbook.save(file)
+
+
+def excel_response(sheets, tables=(), filename=EXCEL_FILENAME):
+    """xlsxを一時ファイルに書き出し、ストリーミングで返すレスポンスを作成"""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        write_workbook(sheets, spool, tables)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    # FileResponseは送信し終わったらファイルを閉じる
+    return FileResponse(
+        spool,
+        as_attachment=True,
+        filename=filename,
+        content_type=EXCEL_CONTENT_TYPE,
+    )
+
+
+class _Echo:
+    """csv.writerの書き込み先として、書き込まれた文字列をそのまま返す"""
+
+    def write(self, value):
+        return value
+
+
+def _iter_csv(records):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in typed_rows(records):
+        yield writer.writerow(row)
+
+
+def csv_response(records, filename="etc_data.csv"):
+    """ヘッダー付きのCSV（PostgreSQLのCOPY ... CSV HEADERで読み込める形式）"""
+    response = StreamingHttpResponse(
+        _iter_csv(records), content_type="text/csv; charset=utf-8"
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _json_default(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def ndjson_rows(records):
+    """レコードをNDJSONの1行分の辞書（キーはEXPORT_COLUMNS、値は型付き）にして返す
+
+    format=ndjson と format=ndjson-stream はこの辞書を同じ形で返す。
+    """
+    return (dict(zip(EXPORT_COLUMNS, row)) for row in typed_rows(records))
+
+
+def ndjson_line(value):
+    """NDJSONの1行にする（日付・日時はISO 8601の文字列）"""
+    return json.dumps(value, ensure_ascii=False, default=_json_default) + "\n"
+
+
+def _iter_ndjson(records):
+    return map(ndjson_line, ndjson_rows(records))
+
+
+def ndjson_response(records, filename="etc_data.ndjson"):
+    """1行に1レコードのJSON（NDJSON）を1行ずつ返す"""
+    response = StreamingHttpResponse(
+        _iter_ndjson(records), content_type="application/x-ndjson; charset=utf-8"
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def parquet_response(records, filename="etc_data.parquet"):
+    """型付きの列を持つParquetファイルを返す"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [
+            ("card_number", pa.string()),
+            ("month", pa.int32()),
+            ("date", pa.date32()),
+            ("vehicle_type", pa.string()),
+            ("vehicle_number", pa.string()),
+            ("entry_ic", pa.string()),
+            ("exit_ic", pa.string()),
+            ("original_fee", pa.int64()),
+            ("final_fee", pa.int64()),
+            ("discount", pa.int64()),
+            ("entry_at", pa.timestamp("s")),
+            ("exit_at", pa.timestamp("s")),
+            ("entry_ic_code", pa.int32()),
+            ("exit_ic_code", pa.int32()),
+        ]
+    )
+    # 正規化した列をそのまま配列にする
+    columns = normalize_columns(records)
+    table = pa.Table.from_arrays(
+        [pa.array(columns[field.name], type=field.type) for field in schema],
+        schema=schema,
+    )
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    pq.write_table(table, spool)
+    spool.seek(0)
+    return FileResponse(
+        spool,
+        as_attachment=True,
+        filename=filename,
+        content_type="application/vnd.apache.parquet",
+    )
+
+
+# format=... で指定できる機械向けの出力形式
+EXPORT_RESPONSES = {
+    "csv": csv_response,
+    "ndjson": ndjson_response,
+    "parquet": parquet_response,
+}
@@ -0,0 +1,173 @@
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .memory import MemoryGuard, release_document_memory
+
+
+logger = logging.getLogger(__name__)
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    """ワーカー数ごとのプロセスプールを返す（プロセス内で使い回す）"""
+    with _pool_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers)
+        return pool
+
+
+def split_page_ranges(pages, workers):
+    """ページ番号のリストを連続したworkers個以下の範囲に分割"""
+    pages = list(pages)
+    size = math.ceil(len(pages) / workers)
+    return [pages[start : start + size] for start in range(0, len(pages), size)]
+
+
+def open_document(source):
+    """パスまたはバイト列（bytes・memoryview）からPDFを開く"""
+    import pymupdf
+
+    if isinstance(source, (str, os.PathLike)):
+        return pymupdf.open(source)
+    # bytesとmemoryviewはコピーされずにそのまま使われる
+    return pymupdf.open(stream=source, filetype="pdf")
+
+
+def to_markdown(doc, **kwargs):
+    """pymupdf4llm.to_markdownを呼ぶ（pymupdf4llmは読み込みが遅いので使うときにimportする）"""
+    import pymupdf4llm
+
+    return pymupdf4llm.to_markdown(doc, **kwargs)
+
+
+def iter_page_windows(pages, window):
+    """ページ番号のリストをwindowページずつに分けて返す"""
+    window = max(window, 1)
+    for start in range(0, len(pages), window):
+        yield pages[start : start + window]
+
+
+def _window_markdown(source, pages):
+    """PDFを開いて指定ページをMarkdownに変換し、(ページ番号(1始まり), テキスト) のリストを返す
+
+    開いている文書は読み込んだページの解析結果を閉じるまで保持するため、
+    呼び出しごとに開いて閉じる（バイト列はコピーされない）。
+    """
+    with open_document(source) as doc:
+        chunks = to_markdown(doc, pages=pages, page_chunks=True)
+    return [(chunk["metadata"]["page_number"], chunk["text"]) for chunk in chunks]
+
+
+def _release_window(guard):
+    # windowごとにPyMuPDFのキャッシュを解放し、メモリの上限と比べる
+    release_document_memory()
+    guard.check()
+
+
+def iter_window_markdown(source, pages=None, window=None, guard=None):
+    """PDF（パスまたはバイト列）の指定ページ（0始まり。Noneなら全ページ）を
+    windowページずつMarkdownに変換し、(ページ番号(1始まり), テキスト) を1ページずつ返す
+
+    pymupdf4llmが1回の変換で保持するページの情報をwindowページ分に抑え、
+    windowごとに文書を閉じてguard（MemoryGuard）の上限と比べる。
+    """
+    if window is None:
+        window = getattr(settings, "PDF_PAGE_WINDOW", 8)
+    if guard is None:
+        guard = MemoryGuard()
+    if pages is None:
+        with open_document(source) as doc:
+            pages = range(doc.page_count)
+
+    for window_pages in iter_page_windows(list(pages), window):
+        yield from _window_markdown(source, window_pages)
+        _release_window(guard)
+
+
+def iter_isolated_markdown(source, pages, window=None, guard=None):
+    """iter_window_markdownと同じく変換するが、変換に失敗したページで止まらない
+
+    windowの変換に失敗したらそのwindowを1ページずつ変換し直す。
+    (ページ番号(0始まり), テキスト, None) を、変換できなかったページは
+    (ページ番号(0始まり), None, 例外) を返す。
+    MemoryLimitExceededはページの問題ではないので、そのまま送出する。
+    """
+    if window is None:
+        window = getattr(settings, "PDF_PAGE_WINDOW", 8)
+    if guard is None:
+        guard = MemoryGuard()
+
+    for window_pages in iter_page_windows(list(pages), window):
+        try:
+            chunks = _window_markdown(source, window_pages)
+        except Exception as e:
+            if len(window_pages) == 1:
+                logger.warning("Failed to extract page %d: %s", window_pages[0] + 1, e)
+                yield window_pages[0], None, e
+            else:
+                logger.warning(
+                    "Failed to extract pages %d-%d, retrying page by page: %s",
+                    window_pages[0] + 1,
+                    window_pages[-1] + 1,
+                    e,
+                )
+                yield from iter_isolated_markdown(source, window_pages, 1, guard)
+            _release_window(guard)
+            continue
+        for page_number, text in chunks:
+            yield page_number - 1, text, None
+        _release_window(guard)
+
+
+def _extract_isolated(source, pages):
+    """iter_isolated_markdownの結果をリストで返す（ワーカープロセスで実行）
+
+    例外はpickleできるとは限らないので、メッセージの文字列にして返す。
+    """
+    return [
+        (page_number, text, None if error is None else str(error))
+        for page_number, text, error in iter_isolated_markdown(source, pages)
+    ]
+
+
+def extract_isolated_markdown(source, pages, workers=None):
+    """PDF（パスまたはバイト列）の指定ページ（0始まり）をiter_isolated_markdownで変換し、
+    (ページ番号(0始まり), テキスト, エラー) のリストをページ順に返す
+
+    workersが2以上の場合はページ範囲ごとにプロセスプールで並列に変換する。
+    変換に失敗したページは各ワーカーの中で切り分けるので、
+    1ページの失敗で範囲全体が失敗になることはない。
+    """
+    if workers is None:
+        workers = getattr(settings, "PDF_EXTRACT_WORKERS", 1)
+    pages = list(pages)
+    if workers <= 1 or len(pages) <= 1:
+        return list(iter_isolated_markdown(source, pages))
+
+    ranges = split_page_ranges(pages, workers)
+    logger.debug("Extracting %d pages in %d chunks", len(pages), len(ranges))
+    if not isinstance(source, (str, os.PathLike, bytes)):
+        # memoryviewはワーカープロセスに渡せないのでbytesにする
+        source = bytes(source)
+    pool = _get_pool(workers)
+    # mapは投入順に結果を返すので、ページ順のまま結合できる
+    return [
+        result
+        for results in pool.map(_extract_isolated, [source] * len(ranges), ranges)
+        for result in results
+    ]
+
+
+def text_layer_pages(doc, min_chars=None):
+    """ページごとにテキストレイヤーに文字があるか（OCRが不要か）を返す"""
+    if min_chars is None:
+        min_chars = getattr(settings, "HYBRID_MIN_TEXT_CHARS", 1)
+    return [len(page.get_text("text").strip()) >= min_chars for page in doc]
@@ -0,0 +1,188 @@
+import csv
+import hashlib
+import logging
+import os
+import sys
+import threading
+import unicodedata
+from collections import namedtuple
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# 同梱しているICのマスタ（code,name,road,aliases。別名は/区切り）
+# 明細によく出るICだけを集めたもので、すべてのICを含んではいない。
+# codeは公式のICコード。公式のコードが分からないICには、SURROGATE_CODE_BASEより
+# 大きい代わりのコード（同梱のマスタでは追加した順の連番）を入れる。
+# 代わりのコードは保存済みのレコードのentry_ic_code・exit_ic_codeにも入るため、
+# マスタを更新しても付け直さず、新しいICには続きの番号を使う（空欄のICのコードはNULL）
+DEFAULT_MASTER_PATH = os.path.join(
+    os.path.dirname(__file__), "data", "interchanges.csv"
+)
+
+# これより大きいコードは公式のICコードではなく、マスタで付けた代わりのコード
+SURROGATE_CODE_BASE = 900000
+
+Interchange = namedtuple("Interchange", ["code", "name", "road"])
+
+# 照合の前に除く表記（空白・自)至)・IC）
+_STRIP_WORDS = ("自)", "至)", "IC")
+
+
+def normalize_ic_name(name):
+    """照合用にIC名の表記をそろえる（全角英数字・空白・「IC」の有無の違いをなくす）"""
+    key = "".join(unicodedata.normalize("NFKC", name).split())
+    for word in _STRIP_WORDS:
+        key = key.replace(word, "")
+    return key
+
+
+def max_ic_distance(key):
+    """OCRの誤りとして補正する編集距離の上限（2文字以下の名前は補正しない）
+
+    1文字より多く違う名前は、別の（マスタにない）ICである可能性が高いので補正しない。
+    """
+    return 1 if len(key) >= 3 else 0
+
+
+class _TrieNode:
+    __slots__ = ("children", "interchange")
+
+    def __init__(self):
+        self.children = {}
+        self.interchange = None
+
+
+class InterchangeDictionary:
+    """ICのマスタを引く辞書
+
+    表記をそろえた名前からのハッシュ表で完全一致を引き、
+    見つからない名前はトライを辿りながら編集距離を計算して最も近いICを探す。
+    completeはマスタがすべてのICを含むか。含まない場合、マスタにない名前は
+    正しく読み取れたICかもしれないので、最も近いICには補正しない。
+    """
+
+    def __init__(self, rows, version="", complete=False):
+        self.version = version
+        self.complete = complete
+        self._by_code = {}
+        self._by_key = {}
+        self._root = _TrieNode()
+        for code, name, road, aliases in rows:
+            # 同じICの名前は全レコードで同じ文字列オブジェクトを共有する
+            interchange = Interchange(
+                int(code) if code else None, sys.intern(name), road
+            )
+            if interchange.code is not None:
+                if interchange.code in self._by_code:
+                    raise ValueError(f"Duplicate IC code in master: {code}")
+                self._by_code[interchange.code] = interchange
+            for alias in (name, *filter(None, aliases.split("/"))):
+                self._add(normalize_ic_name(alias), interchange)
+
+    def _add(self, key, interchange):
+        self._by_key[key] = interchange
+        node = self._root
+        for char in key:
+            node = node.children.setdefault(char, _TrieNode())
+        node.interchange = interchange
+
+    def __len__(self):
+        return len(self._by_code)
+
+    def get(self, code):
+        """コードからICを返す（なければNone）"""
+        return self._by_code.get(code)
+
+    def lookup(self, name):
+        """表記をそろえた名前が一致するICを返す（なければNone）"""
+        return self._by_key.get(normalize_ic_name(name))
+
+    def closest(self, name, max_distance=None):
+        """編集距離が最も近いICを返す
+
+        距離がmax_distance（省略時はmax_ic_distance）を超える場合や、
+        最も近いICが1つに決まらない場合（同じ距離のICがある場合と、
+        距離が1しか違わない次点のICがある場合）はNone。
+        マスタがすべてのICを含まない（completeでない）場合は完全一致だけを返す。
+        """
+        key = normalize_ic_name(name)
+        found = self._by_key.get(key)
+        if found is not None or not key or not self.complete:
+            return found
+        if max_distance is None:
+            max_distance = max_ic_distance(key)
+        if max_distance <= 0:
+            return None
+        # 次点のICと比べるため、1つ遠い距離まで探す
+        search_distance = max_distance + 1
+
+        best = {}
+        first_row = list(range(len(key) + 1))
+        # (ノード, 親のノードまでの距離の行) を深さ優先で辿る
+        stack = [
+            (child, char, first_row) for char, child in self._root.children.items()
+        ]
+        while stack:
+            node, char, previous = stack.pop()
+            row = [previous[0] + 1]
+            for i, key_char in enumerate(key, 1):
+                row.append(
+                    min(
+                        row[i - 1] + 1,
+                        previous[i] + 1,
+                        previous[i - 1] + (key_char != char),
+                    )
+                )
+            if node.interchange is not None and row[-1] <= search_distance:
+                best.setdefault(row[-1], set()).add(node.interchange)
+            # この先の名前の距離はmin(row)より小さくならない
+            if min(row) <= search_distance:
+                stack.extend(
+                    (child, next_char, row)
+                    for next_char, child in node.children.items()
+                )
+
+        distance = min(best, default=search_distance + 1)
+        if distance > max_distance or len(best[distance]) > 1:
+            return None
+        if best.get(distance + 1):
+            return None
+        return next(iter(best[distance]))
+
+
+def load_interchanges(path, complete=False):
+    """CSVのマスタを読み込んでInterchangeDictionaryを返す
+
+    completeはマスタがすべてのICを含むか（含む場合だけOCRのIC名を補正する）。
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    reader = csv.DictReader(data.decode("utf-8-sig").splitlines())
+    rows = (
+        (row["code"], row["name"], row.get("road") or "", row.get("aliases") or "")
+        for row in reader
+    )
+    # マスタを差し替えたら解析結果のキャッシュも使わないよう、内容のハッシュを版にする
+    version = hashlib.sha256(data).hexdigest()[:8] + ("c" if complete else "")
+    return InterchangeDictionary(rows, version, complete)
+
+
+_interchanges = None
+_interchanges_lock = threading.Lock()
+
+
+def get_interchanges():
+    """ICの辞書を返す（IC_MASTER_PATHのマスタをプロセス内で一度だけ読み込む）"""
+    global _interchanges
+    if _interchanges is None:
+        with _interchanges_lock:
+            if _interchanges is None:
+                path = getattr(settings, "IC_MASTER_PATH", None) or DEFAULT_MASTER_PATH
+                _interchanges = load_interchanges(
+                    path, getattr(settings, "IC_MASTER_COMPLETE", False)
+                )
+                logger.debug("Loaded %d interchanges from %s", len(_interchanges), path)
+    return _interchanges
@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .metrics import StageTimer, registry
+from .models import ConversionJob
+from .offload import MARKDOWN_KINDS, convert_in_pool
+from .parser import EtcRecord
+from .store import save_records_safely
+from .uploads import upload_buffer
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """待機中のジョブが上限に達している"""
+
+
+def _lease_seconds():
+    return getattr(settings, "JOB_LEASE_SECONDS", 300)
+
+
+def get_executor():
+    """ジョブ実行用のワーカープールを返す
+
+    ジョブのスレッドは変換をプロセスプール（offload）に投入して完了を待つ。
+    初回作成時に、前回のプロセスで処理されずに残った待機中のジョブも投入し、
+    処理中のまま止まったジョブを定期的に待機中に戻すスレッドを起動する。
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "JOB_WORKERS", 2),
+                thread_name_prefix="conversion-job",
+            )
+            pending = ConversionJob.objects.filter(
+                status=ConversionJob.Status.QUEUED
+            ).count()
+            for _ in range(pending):
+                _executor.submit(run_next_job)
+            threading.Thread(
+                target=_watch_stale_jobs, name="conversion-job-lease", daemon=True
+            ).start()
+        return _executor
+
+
+def resume_jobs():
+    """ワーカーの起動時に、止まったジョブを戻して待機中のジョブの処理を始める"""
+    reclaim_stale_jobs()
+    get_executor()
+
+
+def reclaim_stale_jobs():
+    """ワーカーが落ちて処理中のまま残ったジョブを待機中に戻し、戻した件数を返す
+
+    heartbeat_at（なければstarted_at）がJOB_LEASE_SECONDSより前の処理中のジョブが対象。
+    JOB_MAX_ATTEMPTS回試したジョブは、変換でワーカーが落ちている可能性があるので失敗にする。
+    """
+    now = timezone.now()
+    deadline = now - timedelta(seconds=_lease_seconds())
+    stale = ConversionJob.objects.filter(status=ConversionJob.Status.RUNNING).filter(
+        Q(heartbeat_at__lt=deadline)
+        | Q(heartbeat_at__isnull=True, started_at__lt=deadline)
+    )
+    failed = stale.filter(attempts__gte=getattr(settings, "JOB_MAX_ATTEMPTS", 3))
+    failed_count = failed.update(
+        status=ConversionJob.Status.FAILED,
+        error="変換中にワーカーが停止しました",
+        file_data=b"",
+        finished_at=now,
+    )
+    requeued = stale.update(
+        status=ConversionJob.Status.QUEUED, started_at=None, heartbeat_at=None
+    )
+    if failed_count or requeued:
+        logger.warning(
+            "Reclaimed %d stale conversion jobs (%d failed)", requeued, failed_count
+        )
+    if requeued and _executor is not None:
+        for _ in range(requeued):
+            _executor.submit(run_next_job)
+    return requeued
+
+
+def _watch_stale_jobs():
+    while True:
+        time.sleep(_lease_seconds())
+        try:
+            reclaim_stale_jobs()
+        except Exception:
+            logger.exception("An error occurred while reclaiming conversion jobs")
+        finally:
+            close_old_connections()
+
+
+def active_job_count():
+    reclaim_stale_jobs()
+    return ConversionJob.objects.filter(
+        status__in=[ConversionJob.Status.QUEUED, ConversionJob.Status.RUNNING]
+    ).count()
+
+
+def submit_job(kind, file_obj):
+    """アップロードされたファイルをジョブとして登録し、ワーカーに投入する
+
+    アップロードのバッファ（upload_buffer）をコピーせずにDBへ書き込む。
+    """
+    if active_job_count() >= getattr(settings, "JOB_QUEUE_LIMIT", 100):
+        raise QueueFullError(
+            "変換ジョブが混み合っています。しばらくしてから再度お試しください。"
+        )
+
+    with upload_buffer(file_obj) as (buffer, digest):
+        job = ConversionJob.objects.create(
+            kind=kind,
+            file_name=file_obj.name or "",
+            file_sha256=digest,
+            file_data=buffer,
+        )
+    transaction.on_commit(lambda: get_executor().submit(run_next_job))
+    logger.debug("Queued conversion job %s", job.id)
+    return job
+
+
+def claim_next_job():
+    """待機中のジョブを1件取り出して処理中にする（他のワーカーと重複しない）"""
+    with transaction.atomic():
+        job = (
+            ConversionJob.objects.select_for_update(skip_locked=True)
+            .filter(status=ConversionJob.Status.QUEUED)
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = ConversionJob.Status.RUNNING
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=["status", "started_at", "heartbeat_at", "attempts"])
+    return job
+
+
+def run_next_job():
+    try:
+        job = claim_next_job()
+        if job is not None:
+            process_job(job)
+    except Exception:
+        logger.exception("An error occurred while running a conversion job")
+    finally:
+        close_old_connections()
+
+
+def _heartbeat(job):
+    ConversionJob.objects.filter(pk=job.pk, status=ConversionJob.Status.RUNNING).update(
+        heartbeat_at=timezone.now()
+    )
+
+
+def process_job(job):
+    logger.debug("Running conversion job %s", job.id)
+    # 変換の処理時間と件数（結果キャッシュのヒット・ミスなど）をview="job"で集計する
+    with StageTimer("job") as timer:
+        try:
+            # PyMuPDFはスレッドセーフではないので、変換はプロセスプールで実行し、
+            # 待っているあいだ処理中であることをDBに記録する
+            result, report = convert_in_pool(
+                job.kind,
+                bytes(job.file_data),
+                job.file_sha256,
+                on_wait=lambda: _heartbeat(job),
+                interval=_lease_seconds() / 3,
+            )
+            if job.kind in MARKDOWN_KINDS:
+                job.result = result
+            else:
+                save_records_safely(
+                    job.file_sha256, job.file_name, result, report.failed_pages
+                )
+                job.result = [list(record) for record in result]
+                if not report.complete:
+                    # 変換できたページの結果は返し、失敗したページを残す
+                    job.error = "変換できなかったページ: " + ", ".join(
+                        map(str, report.failed_pages)
+                    )
+            job.status = ConversionJob.Status.DONE
+        except Exception as e:
+            logger.exception("Conversion job %s failed", job.id)
+            job.status = ConversionJob.Status.FAILED
+            job.error = str(e)
+    registry.record(timer, 200 if job.status == ConversionJob.Status.DONE else 500)
+
+    job.file_data = b""
+    job.finished_at = timezone.now()
+    # heartbeat_atなど他のスレッドが更新する列は上書きしない
+    job.save(update_fields=["status", "result", "error", "file_data", "finished_at"])
+
+
+def job_records(job):
+    """完了したuploadジョブの結果をEtcRecordのリストに戻す"""
+    return [EtcRecord(*row) for row in job.result or []]
@@ -0,0 +1,226 @@
+import logging
+import unicodedata
+from operator import itemgetter
+
+from .extraction import open_document
+from .parser import (
+    EtcRecord,
+    parse_amount_cell,
+    parse_card_cell,
+    parse_date_cell,
+    parse_fee_cell,
+    parse_ic_cell,
+    parse_text,
+    parse_text_cell,
+    parse_time_cell,
+    parse_trip_cell,
+    parse_vehicle_cell,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# 列の種類 → (セルから取り出すEtcRecordのフィールド, セルを解析する関数)
+# 関数はフィールドと同じ並びのタプルを返す。Noneを返したセルの行は明細の行ではない
+CELL_PARSERS = {
+    "trip": (
+        ("date", "month", "entry_ic", "exit_ic", "entry_time", "exit_time"),
+        parse_trip_cell,
+    ),
+    "fees": (("original_fee", "final_fee"), parse_fee_cell),
+    "vehicle": (("vehicle_type", "vehicle_number", "card_number"), parse_vehicle_cell),
+    "date": (("date", "month"), parse_date_cell),
+    "entry_ic": (("entry_ic",), parse_ic_cell),
+    "exit_ic": (("exit_ic",), parse_ic_cell),
+    "entry_time": (("entry_time",), parse_time_cell),
+    "exit_time": (("exit_time",), parse_time_cell),
+    "original_fee": (("original_fee",), parse_amount_cell),
+    "final_fee": (("final_fee",), parse_amount_cell),
+    "vehicle_type": (("vehicle_type",), parse_text_cell),
+    "vehicle_number": (("vehicle_number",), parse_text_cell),
+    "card_number": (("card_number",), parse_card_cell),
+}
+
+# どのレイアウトにも必要なフィールド（明細の行かどうかの判定に使う）
+REQUIRED_FIELDS = ("date", "card_number")
+
+
+def normalize_header_text(text):
+    """見出しの照合用に、全角英数字と空白の違いをなくす"""
+    return "".join(unicodedata.normalize("NFKC", text).split())
+
+
+class Layout:
+    """明細の列の並びと、それを見分けるための見出しの語
+
+    columnsはMarkdownの表の列ごとの種類（CELL_PARSERSのキー。使わない列はNone）。
+    signatureの語がすべて1ページ目にあれば、このレイアウトの明細とみなす。
+    作成時に列の定義を1行を解析する関数にまとめる。
+    """
+
+    def __init__(self, name, signature, columns, description=""):
+        self.name = name
+        self.description = description
+        self.signature = tuple(normalize_header_text(word) for word in signature)
+        self.columns = tuple(columns)
+
+        slots = []
+        for index, kind in enumerate(self.columns):
+            if kind is None:
+                continue
+            if kind not in CELL_PARSERS:
+                raise ValueError(f"{name}: unknown column kind {kind!r}")
+            fields, parse_cell = CELL_PARSERS[kind]
+            # "|a|b|" を分割すると先頭は空文字列なので、列iは i + 1 番目
+            slots.append((index + 1, parse_cell, fields))
+        # 日付の列を先に解析し、見出しなど明細でない行をすぐに読み飛ばす
+        slots.sort(key=lambda slot: "date" not in slot[2])
+
+        covered = [field for _, _, fields in slots for field in fields]
+        duplicated = {field for field in covered if covered.count(field) > 1}
+        missing = [field for field in REQUIRED_FIELDS if field not in covered]
+        if duplicated or missing:
+            raise ValueError(
+                f"{name}: duplicated fields {sorted(duplicated)}, "
+                f"missing fields {missing}"
+            )
+        self._cells = tuple((index, parse_cell) for index, parse_cell, _ in slots)
+        # セルごとの値をつなげたタプルの末尾に "" を足し、EtcRecordの並びに取り出す
+        # （どの列にもないフィールドは末尾の "" になる）
+        self._arrange = itemgetter(
+            *(
+                covered.index(field) if field in covered else len(covered)
+                for field in EtcRecord._fields
+            )
+        )
+        # 必要な最後の列より後ろは分割しない
+        self._maxsplit = max(index for index, _, _ in slots) + 1
+
+    def __repr__(self):
+        return f"<Layout {self.name}>"
+
+    def parse_line(self, line):
+        """Markdownの1行を解析してEtcRecordを返す（データ行でなければNone）"""
+        if "|" not in line or line.startswith("|---"):
+            return None
+        parts = line.strip().split("|", self._maxsplit)
+        if len(parts) < self._maxsplit:
+            return None
+        values = ()
+        for index, parse_cell in self._cells:
+            parsed = parse_cell(parts[index])
+            if parsed is None:
+                return None
+            values += parsed
+        return EtcRecord._make(self._arrange(values + ("",)))
+
+    def parse_text(self, text, counts=None):
+        """抽出したMarkdownテキスト全体からEtcRecordを1件ずつ返す（countsはparse_records）"""
+        return parse_text(text, self.parse_line, counts)
+
+
+# 受け付ける明細のレイアウト。新しい発行元の明細は、ここに定義を加えれば読める
+# （解析結果が変わるのでparser.PARSER_VERSIONも上げる）
+LAYOUTS = (
+    Layout(
+        "etc_meisai",
+        signature=(
+            "利用年月日",
+            "利用ＩＣ(自)",
+            "利用ＩＣ(至)",
+            "後納料金",
+            "ＥＴＣカード番号",
+        ),
+        columns=("trip", "fees", None, "vehicle", None),
+        description="ETC利用照会サービスの利用明細（日付・IC / 料金 / 後納料金 / "
+        "車両・カード / 備考）",
+    ),
+    Layout(
+        "per_column",
+        signature=("利用日", "入口IC", "出口IC", "車両番号", "カード番号", "通行料金"),
+        columns=(
+            "date",
+            "entry_time",
+            "entry_ic",
+            "exit_time",
+            "exit_ic",
+            "vehicle_type",
+            "vehicle_number",
+            "card_number",
+            "original_fee",
+            "final_fee",
+        ),
+        description="1列に1項目の利用明細（利用日 / 入口時刻 / 入口IC / 出口時刻 / 出口IC / "
+        "車種 / 車両番号 / カード番号 / 割引前料金 / 通行料金）",
+    ),
+)
+
+# 見分けられない明細・テキストレイヤーのない明細（OCRの結果もこの並びになる）
+DEFAULT_LAYOUT = LAYOUTS[0]
+
+
+class LayoutRegistry:
+    """名前と1ページ目の見出しからレイアウトを引く"""
+
+    def __init__(self, layouts):
+        self._by_name = {layout.name: layout for layout in layouts}
+        # 見出しの語が多い（より限定的な）レイアウトを先に試す
+        self._by_specificity = sorted(
+            layouts, key=lambda layout: len(layout.signature), reverse=True
+        )
+        self._words = frozenset(word for layout in layouts for word in layout.signature)
+
+    def __iter__(self):
+        return iter(self._by_name.values())
+
+    def get(self, name):
+        """名前からレイアウトを返す（なければNone）"""
+        return self._by_name.get(name)
+
+    def classify_text(self, text):
+        """1ページ目のテキストから明細のレイアウトを返す（見分けられなければNone）
+
+        すべてのレイアウトの見出しの語をテキストから一度だけ探し、
+        語がすべて見つかったレイアウトのうち最も語の多いものを選ぶ。
+        """
+        key = normalize_header_text(text)
+        found = {word for word in self._words if word in key}
+        for layout in self._by_specificity:
+            if found.issuperset(layout.signature):
+                return layout
+        return None
+
+
+_registry = LayoutRegistry(LAYOUTS)
+
+
+def get_layout(name):
+    """名前からレイアウトを返す（なければNone）"""
+    return _registry.get(name)
+
+
+def classify_text(text):
+    """1ページ目のテキストから明細のレイアウトを返す（見分けられなければNone）"""
+    return _registry.classify_text(text)
+
+
+def classify_document(doc):
+    """開いたPDFの1ページ目のテキストレイヤーから明細のレイアウトを返す
+
+    1ページ目に文字がない（スキャンした）明細と、見分けられない明細はDEFAULT_LAYOUT。
+    """
+    if not doc.page_count:
+        return DEFAULT_LAYOUT
+    text = doc[0].get_text("text")
+    layout = _registry.classify_text(text) if text.strip() else None
+    if layout is None:
+        logger.debug("Could not classify the statement layout, using the default")
+        return DEFAULT_LAYOUT
+    logger.debug("Classified the statement layout as %s", layout.name)
+    return layout
+
+
+def detect_layout(source):
+    """PDF（パスまたはバイト列）の1ページ目だけを読んで明細のレイアウトを返す"""
+    with open_document(source) as doc:
+        return classify_document(doc)
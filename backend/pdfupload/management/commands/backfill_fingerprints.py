@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from pdfupload.store import backfill_fingerprints
+
+
+class Command(BaseCommand):
+    help = (
+        "指紋の列を追加する前に保存したETC明細のレコードに、重複を見つけるための指紋を付ける"
+        "（他の明細で保存済みの利用と重複する行には付けない）"
+    )
+
+    def handle(self, *args, **options):
+        filled, duplicates = backfill_fingerprints()
+        self.stdout.write(
+            f"Added {filled} fingerprints ({duplicates} duplicate rows left without one)"
+        )
@@ -0,0 +1,148 @@
+import io
+import json
+import os
+import resource
+import statistics
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+
+from pdfupload.exporters import EXCEL_SHEET_NAME, write_workbook
+from pdfupload.extraction import extract_isolated_markdown
+from pdfupload.ocr import ocr_pdf
+from pdfupload.parser import parse_text, to_markdown
+from pdfupload.pipeline import format_ocr_markdown, ocr_pages_to_text
+from pdfupload.summary import summarize, summary_tables
+from pdfupload.synthetic import (
+    ROWS_PER_PAGE,
+    generate_rows,
+    rows_to_markdown,
+    rows_to_pdf,
+)
+from pdfupload.uploads import upload_buffer, upload_path
+
+
+def peak_rss_mb():
+    """プロセスのピークRSS（MB）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = "合成したETC明細で変換パイプラインの各段階の処理時間とピークRSSを計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            nargs="+",
+            default=[10, 100, 1000, 10000],
+            help="計測する明細の行数（複数指定可）",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="各段階の繰り返し回数（中央値を表示）"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--ocr", action="store_true", help="OCR（TestPDFView）の段階も計測する"
+        )
+        parser.add_argument(
+            "--save-dir", help="生成したPDFとMarkdownを保存するディレクトリ"
+        )
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+
+    def handle(self, *args, **options):
+        results = []
+        for count in options["rows"]:
+            results.append(self.run(count, options))
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"rows={result['rows']} pages={result['pages']} "
+                f"pdf={result['pdf_bytes'] / 1024:.0f}KiB "
+                f"parsed_from_pdf={result['parsed_from_pdf']}"
+            )
+            for stage, stats in result["stages"].items():
+                self.stdout.write(
+                    f"  {stage:<12} {stats['seconds'] * 1000:10.2f} ms"
+                    f"  peak_rss={stats['peak_rss_mb']:.1f} MB"
+                )
+
+    def timed(self, stages, name, repeat, func):
+        """funcをrepeat回実行し、中央値の時間とピークRSSを記録して最後の結果を返す"""
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - start)
+        stages[name] = {
+            "seconds": statistics.median(timings),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        return result
+
+    def run(self, count, options):
+        repeat = options["repeat"]
+        rows = generate_rows(count, seed=options["seed"])
+        markdown = rows_to_markdown(rows)
+        pdf_bytes = rows_to_pdf(rows)
+        pages = max(-(-count // ROWS_PER_PAGE), 1)
+
+        if options["save_dir"]:
+            os.makedirs(options["save_dir"], exist_ok=True)
+            base = os.path.join(options["save_dir"], f"etc_{count}")
+            with open(f"{base}.pdf", "wb") as f:
+                f.write(pdf_bytes)
+            with open(f"{base}.md", "w", encoding="utf-8") as f:
+                f.write(markdown)
+
+        stages = {}
+        upload = SimpleUploadedFile("etc.pdf", pdf_bytes)
+
+        def read_upload():
+            with upload_buffer(upload) as (_, digest):
+                return digest
+
+        self.timed(stages, "hash", repeat, read_upload)
+        with upload_buffer(upload) as (buffer, _):
+            # /api/upload/ と同じく、ページごとに失敗を切り分けて抽出する
+            extracted = self.timed(
+                stages,
+                "to_markdown",
+                repeat,
+                lambda: extract_isolated_markdown(buffer, range(pages)),
+            )
+        raw_text = "".join(text for _, text, _ in extracted if text)
+        records = self.timed(
+            stages, "parse", repeat, lambda: list(parse_text(markdown))
+        )
+        self.timed(stages, "markdown", repeat, lambda: to_markdown(records))
+        self.timed(
+            stages,
+            "excel",
+            repeat,
+            lambda: write_workbook(
+                [(EXCEL_SHEET_NAME, records)],
+                io.BytesIO(),
+                summary_tables(summarize(records)),
+            ),
+        )
+        if options["ocr"]:
+            with upload_path(upload) as (pdf_path, _):
+                self.timed(
+                    stages,
+                    "ocr",
+                    1,
+                    lambda: format_ocr_markdown(ocr_pages_to_text(ocr_pdf(pdf_path))),
+                )
+
+        return {
+            "rows": count,
+            "pages": pages,
+            "pdf_bytes": len(pdf_bytes),
+            "parsed_from_pdf": sum(1 for _ in parse_text(raw_text)),
+            "stages": stages,
+        }
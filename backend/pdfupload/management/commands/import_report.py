@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+from pdfupload.preload import HEAVY_MODULES
+
+
+# 新しいPythonプロセスで実行し、importにかかった時間と増えたRSSをJSONで出力する
+_MEASURE = """
+import json, resource, sys, time
+def rss():
+    # 現在のRSS（KB）。ru_maxrssは親プロセスのピークを引き継ぐことがあるため/procを読む
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+before = rss()
+start = time.perf_counter()
+{statement}
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "rss_mb": (rss() - before) / 1024,
+    "loaded": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+# Djangoのプロセス（runserver・gunicornのワーカー・管理コマンド）の起動時に読み込まれるもの
+_STARTUP_STATEMENT = "import django; django.setup(); import project.urls"
+
+
+def measure(statement):
+    code = _MEASURE.format(statement=statement, heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        env=os.environ,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class Command(BaseCommand):
+    help = (
+        "Djangoの起動と重いライブラリのimportにかかる時間と増えるメモリを、"
+        "それぞれ新しいプロセスで計測する"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+
+    def handle(self, *args, **options):
+        results = [{"module": "(startup)", **measure(_STARTUP_STATEMENT)}]
+        for name in HEAVY_MODULES:
+            try:
+                results.append({"module": name, **measure(f"import {name}")})
+            except subprocess.CalledProcessError:
+                results.append({"module": name, "error": "import failed"})
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'module':<16} {'seconds':>8} {'RSS MB':>8}")
+        for result in results:
+            if "error" in result:
+                self.stdout.write(f"{result['module']:<16} {result['error']}")
+                continue
+            self.stdout.write(
+                f"{result['module']:<16} {result['seconds']:>8.3f} "
+                f"{result['rss_mb']:>8.1f}"
+            )
+        # 起動時に読み込まれていれば、遅延importが崩れている
+        loaded = results[0]["loaded"]
+        self.stdout.write(
+            "Heavy modules loaded at startup: " + (", ".join(loaded) or "none")
+        )
@@ -0,0 +1,124 @@
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pdfupload.synthetic import generate_rows, rows_to_pdf
+
+
+def multipart_body(fields, file_name, file_data):
+    """multipart/form-dataの本文と Content-Type を返す"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n".encode()
+        )
+    parts.append(
+        f"--{boundary}\r\nContent-Disposition: form-data; "
+        f'name="file"; filename="{file_name}"\r\n'
+        "Content-Type: application/pdf\r\n\r\n".encode()
+    )
+    parts.append(file_data)
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def percentile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        "合成したETC明細のPDFを並列にアップロードし、"
+        "スループット（req/s）とレイテンシ（p50・p95・p99）を計測する"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url", default="http://127.0.0.1:8000/api/upload/", help="送信先のURL"
+        )
+        parser.add_argument("--requests", type=int, default=50, help="リクエスト数")
+        parser.add_argument("--concurrency", type=int, default=4, help="同時接続数")
+        parser.add_argument("--rows", type=int, default=100, help="PDFの明細の行数")
+        parser.add_argument(
+            "--unique",
+            action="store_true",
+            help="リクエストごとに内容の違うPDFを送る（結果キャッシュを効かせない）",
+        )
+        parser.add_argument(
+            "--field",
+            action="append",
+            default=[],
+            metavar="NAME=VALUE",
+            help="フォームの項目（例: --field format=excel --field kind=hybrid）",
+        )
+        parser.add_argument("--timeout", type=float, default=300)
+        parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+
+    def handle(self, *args, **options):
+        try:
+            fields = dict(field.split("=", 1) for field in options["field"])
+        except ValueError:
+            raise CommandError("--field は NAME=VALUE の形式で指定してください")
+
+        count = options["requests"]
+        seeds = range(count) if options["unique"] else [0] * count
+        pdfs = {
+            seed: rows_to_pdf(generate_rows(options["rows"], seed=seed))
+            for seed in set(seeds)
+        }
+
+        def send(seed):
+            body, content_type = multipart_body(fields, f"etc_{seed}.pdf", pdfs[seed])
+            request = urllib.request.Request(
+                options["url"],
+                data=body,
+                headers={"Content-Type": content_type},
+                method="POST",
+            )
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=options["timeout"]) as r:
+                    r.read()
+                    status = r.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except OSError as e:
+                status = type(e).__name__
+            return status, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            results = list(pool.map(send, seeds))
+        elapsed = time.perf_counter() - start
+
+        latencies = sorted(seconds for status, seconds in results if status == 200)
+        summary = {
+            "url": options["url"],
+            "requests": count,
+            "concurrency": options["concurrency"],
+            "rows": options["rows"],
+            "statuses": dict(Counter(str(status) for status, _ in results)),
+            "elapsed_seconds": round(elapsed, 3),
+            "requests_per_second": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "max_ms": round(max(latencies, default=0) * 1000, 1),
+        }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        for key, value in summary.items():
+            self.stdout.write(f"{key:<20} {value}")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from pdfupload.store import refresh_ic_codes
+
+
+class Command(BaseCommand):
+    help = (
+        "保存済みのETC明細の入口・出口ICのコードを、ICのマスタ（IC_MASTER_PATH）で付け直す"
+        "（コードを追加する前に保存したレコードや、マスタを差し替えた場合に使う）"
+    )
+
+    def handle(self, *args, **options):
+        updated = refresh_ic_codes()
+        self.stdout.write(f"Updated {updated} IC codes")
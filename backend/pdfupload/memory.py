@@ -0,0 +1,109 @@
+import ctypes
+import ctypes.util
+import gc
+import logging
+import resource
+import threading
+import weakref
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = resource.getpagesize()
+
+# 解放済みのヒープをOSに返す（glibcのみ。muslやmacOSにはない）
+try:
+    _malloc_trim = ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim
+except (OSError, AttributeError, TypeError):
+    _malloc_trim = None
+
+
+class MemoryLimitExceeded(Exception):
+    """1件の変換で増えたメモリがPDF_MEMORY_LIMIT_MBを超えた"""
+
+
+# 同じプロセスで変換中のMemoryGuard（変換が終わって参照がなくなると消える）
+_active_guards = weakref.WeakSet()
+_active_lock = threading.Lock()
+
+
+def current_rss():
+    """プロセスの現在のRSS（バイト）。/procがなければNone
+
+    getrusageのru_maxrssはピークの値で減らないため、代わりには使わない。
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return None
+
+
+def release_document_memory():
+    """PyMuPDFが描画・抽出のために保持しているキャッシュを解放し、空いたヒープをOSに返す
+
+    ページごとに確保と解放を繰り返すと、解放した領域が断片化してRSSが減らないため
+    malloc_trimでOSに返す。
+    """
+    import pymupdf
+
+    pymupdf.TOOLS.store_shrink(100)
+    gc.collect()
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+
+
+class MemoryGuard:
+    """変換の開始時からのRSSの増加を、区切りごとにcheck()で上限と比べる
+
+    RSSはプロセス全体の値なので、同じプロセスで他の変換（MemoryGuard）が動いている間は
+    どちらの分か区別できない。その間は比べず、再び1件だけになった時点のRSSから測り直す
+    （抽出・OCRはプロセスプールで1プロセス1件ずつ実行するので、通常は開始時から測れる）。
+    上限を超えたらPyMuPDFのキャッシュを解放してから測り直し、
+    それでも超えていればMemoryLimitExceededを送出する。
+    limit_mbが0の場合と、/procがなく現在のRSSを読めない場合は何もしない。
+    """
+
+    def __init__(self, limit_mb=None):
+        if limit_mb is None:
+            limit_mb = getattr(settings, "PDF_MEMORY_LIMIT_MB", 0)
+        self.limit = limit_mb * 1024 * 1024
+        self.baseline = None
+        if self.limit and current_rss() is None:
+            logger.debug("RSS is not available, memory limit is disabled")
+            self.limit = 0
+        if self.limit:
+            with _active_lock:
+                _active_guards.add(self)
+            self.used()
+
+    def used(self):
+        """測り始めてから増えたRSS（バイト）。他の変換と重なっている間は0"""
+        with _active_lock:
+            alone = len(_active_guards) == 1
+        if not alone:
+            self.baseline = None
+            return 0
+        rss = current_rss()
+        if self.baseline is None:
+            self.baseline = rss
+        return rss - self.baseline
+
+    def check(self):
+        """上限を超えていればMemoryLimitExceededを送出する"""
+        if not self.limit or self.used() <= self.limit:
+            return
+        release_document_memory()
+        used = self.used()
+        if used > self.limit:
+            logger.warning(
+                "Conversion used %.0f MB (limit %.0f MB)",
+                used / 1024 / 1024,
+                self.limit / 1024 / 1024,
+            )
+            raise MemoryLimitExceeded(
+                f"PDFの変換に必要なメモリが上限（{self.limit // (1024 * 1024)}MB）を"
+                "超えました"
+            )
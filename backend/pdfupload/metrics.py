@@ -0,0 +1,207 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+# 処理時間のヒストグラムのバケット（秒）
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_current_timer = contextvars.ContextVar("pdfupload_stage_timer", default=None)
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(STAGE_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class MetricsRegistry:
+    """プロセス内のリクエスト数・段階ごとの処理時間・ページ数・行数を集計する
+
+    値はプロセスごとに持つため、複数ワーカーで動かす場合は
+    ワーカーごとにスクレイプした値を合算する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.requests = {}
+
+    def record(self, timer, status_code):
+        with self._lock:
+            key = (timer.view, str(status_code))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for stage, seconds in timer.stages:
+                histogram = self.stages.get((timer.view, stage))
+                if histogram is None:
+                    histogram = self.stages[(timer.view, stage)] = _Histogram()
+                histogram.observe(seconds)
+            for name, value in timer.counts.items():
+                key = (timer.view, name)
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self):
+        """Prometheusのテキスト形式で返す"""
+        lines = [
+            "# HELP pdfupload_requests_total 変換リクエスト数",
+            "# TYPE pdfupload_requests_total counter",
+        ]
+        with self._lock:
+            for (view, code), value in sorted(self.requests.items()):
+                lines.append(
+                    f'pdfupload_requests_total{{view="{view}",code="{code}"}} {value}'
+                )
+
+            lines.append("# HELP pdfupload_stage_seconds 段階ごとの処理時間（秒）")
+            lines.append("# TYPE pdfupload_stage_seconds histogram")
+            for (view, stage), histogram in sorted(self.stages.items()):
+                labels = f'view="{view}",stage="{stage}"'
+                for bound, value in zip(STAGE_BUCKETS, histogram.buckets):
+                    lines.append(
+                        f'pdfupload_stage_seconds_bucket{{{labels},le="{bound}"}} '
+                        f"{value}"
+                    )
+                lines.append(
+                    f'pdfupload_stage_seconds_bucket{{{labels},le="+Inf"}} '
+                    f"{histogram.count}"
+                )
+                lines.append(
+                    f"pdfupload_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}"
+                )
+                lines.append(
+                    f"pdfupload_stage_seconds_count{{{labels}}} {histogram.count}"
+                )
+
+            names = sorted({name for _, name in self.counters})
+            for name in names:
+                lines.append(f"# TYPE pdfupload_{name}_total counter")
+                for (view, counter), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'pdfupload_{name}_total{{view="{view}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class StageTimer:
+    """1リクエスト内の段階ごとの処理時間とページ数・行数を記録する
+
+    with timer: の間はstage()・count()の記録先になるため、
+    パイプライン側の関数に引数を追加しなくても計測できる。
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.stages = []
+        self.counts = {}
+        self._token = None
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._token = _current_timer.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_timer.reset(self._token)
+        self.stages.append(("total", time.perf_counter() - self._start))
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - start))
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    @contextmanager
+    def activate(self):
+        """with timer: の外で、このブロックの間だけstage()・count()の記録先にする
+
+        ASGIでスレッドをまたいで1件ずつ進めるストリームなど、
+        with timer: で囲めない処理を計測するために使う。
+        """
+        token = _current_timer.set(self)
+        try:
+            yield
+        finally:
+            _current_timer.reset(token)
+
+    def merge(self, stages, counts):
+        """別のStageTimer（プロセスプールで計測したもの）の記録を加える"""
+        self.stages.extend(stages)
+        for name, value in counts.items():
+            self.count(name, value)
+
+    def server_timing(self):
+        """Server-Timingヘッダーの値（ミリ秒）"""
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages
+        )
+
+    def finish(self, response, server_timing=False):
+        """計測結果を集計に加え、必要であればServer-Timingヘッダーを付ける"""
+        registry.record(self, response.status_code)
+        if server_timing:
+            response["Server-Timing"] = self.server_timing()
+            response["Timing-Allow-Origin"] = "*"
+        return response
+
+
+@contextmanager
+def stage(name):
+    """実行中のStageTimerがあれば処理時間を記録する（なければ何もしない）"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def count(name, value):
+    """実行中のStageTimerがあればページ数・行数などを加算する"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.count(name, value)
+
+
+@contextmanager
+def collect():
+    """別プロセスで実行する処理のstage()・count()を記録する（呼び出し元でmerge()に渡す）"""
+    timer = StageTimer(None)
+    with timer.activate():
+        yield timer
+
+
+def merge(stages, counts):
+    """別プロセスで計測した処理時間と件数を、実行中のStageTimerがあれば加える"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.merge(stages, counts)
+
+
+def render_metrics():
+    """集計結果をPrometheusのテキスト形式で返す
+
+    結果キャッシュのヒット・ミスは、プロセスプールで参照したものも含めて
+    ビューごとのpdfupload_cache_hits_total・pdfupload_cache_misses_totalに入る。
+    """
+    return registry.render()
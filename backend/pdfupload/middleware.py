@@ -0,0 +1,96 @@
+import json
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import sync_and_async_middleware
+
+
+def _too_large_data(limit):
+    return {"error": f"ファイルが大きすぎます（上限 {limit // (1024 * 1024)}MB）"}
+
+
+def _too_large_response(request):
+    """Content-LengthがMAX_UPLOAD_BYTESを超えていれば413のレスポンスを返す"""
+    limit = getattr(settings, "MAX_UPLOAD_BYTES", 0)
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if not limit or length <= limit:
+        return None
+    response = JsonResponse(
+        _too_large_data(limit),
+        status=413,
+        json_dumps_params={"ensure_ascii": False},
+    )
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+@sync_and_async_middleware
+def upload_size_limit_middleware(get_response):
+    """本文を解析する前に、大きすぎるアップロードを断る
+
+    WSGIではDjangoが本文をContent-Lengthまでしか読まないので、ここで長さを確かめれば足りる。
+    Content-Lengthのない（チャンク転送の）本文は、ASGIではlimit_request_bodyで断る。
+    """
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            return _too_large_response(request) or await get_response(request)
+
+    else:
+
+        def middleware(request):
+            return _too_large_response(request) or get_response(request)
+
+    return middleware
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+def limit_request_body(app):
+    """ASGIアプリケーションを包み、受信した本文がMAX_UPLOAD_BYTESを超えたら413を返す
+
+    DjangoのASGIハンドラーは本文をすべて一時ファイルに書き出してからリクエストを作るため、
+    Content-Lengthのない本文も、書き出す前に実際に受信したバイト数で打ち切る。
+    """
+
+    async def application(scope, receive, send):
+        limit = getattr(settings, "MAX_UPLOAD_BYTES", 0)
+        if scope["type"] != "http" or not limit:
+            return await app(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise _BodyTooLarge
+            return message
+
+        try:
+            await app(scope, limited_receive, send)
+        except _BodyTooLarge:
+            # 本文を読み終える前なので、レスポンスはまだ送っていない
+            body = json.dumps(_too_large_data(limit), ensure_ascii=False).encode()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 413,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                        (b"access-control-allow-origin", b"*"),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+
+    return application
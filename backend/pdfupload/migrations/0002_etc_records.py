@@ -0,0 +1,70 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pdfupload", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SourceDocument",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("file_sha256", models.CharField(max_length=64, unique=True)),
+                ("file_name", models.CharField(blank=True, max_length=255)),
+                ("record_count", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="EtcRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("card_number", models.CharField(max_length=32)),
+                ("usage_date", models.DateField()),
+                ("vehicle_type", models.CharField(blank=True, max_length=16)),
+                ("vehicle_number", models.CharField(blank=True, max_length=32)),
+                ("entry_ic", models.CharField(blank=True, max_length=64)),
+                ("exit_ic", models.CharField(blank=True, max_length=64)),
+                ("original_fee", models.IntegerField(blank=True, null=True)),
+                ("final_fee", models.IntegerField(blank=True, null=True)),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="records",
+                        to="pdfupload.sourcedocument",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["card_number", "usage_date"],
+                        name="etcrecord_card_date_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.2 on 2026-10-18 11:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pdfupload", "0002_etc_records"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="etcrecord",
+            name="entry_ic_code",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="etcrecord",
+            name="exit_ic_code",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="etcrecord",
+            index=models.Index(
+                fields=["entry_ic_code", "exit_ic_code"], name="etcrecord_ic_codes_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pdfupload", "0003_etcrecord_ic_codes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="etcrecord",
+            name="fingerprint",
+            field=models.BigIntegerField(blank=True, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name="sourcedocument",
+            name="duplicate_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
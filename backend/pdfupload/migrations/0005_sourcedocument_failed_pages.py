@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pdfupload", "0004_trip_fingerprints"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sourcedocument",
+            name="failed_pages",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pdfupload", "0005_sourcedocument_failed_pages"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversionjob",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="conversionjob",
+            name="heartbeat_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.2 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pdfupload", "0006_conversionjob_lease"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="conversionjob",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("upload", "テキスト抽出（パターンB）"),
+                    ("hybrid", "テキスト抽出と文字のないページのOCR"),
+                    ("ocr", "OCR（パターンA）"),
+                    ("ocr-table", "表の範囲だけのOCR"),
+                ],
+                max_length=16,
+            ),
+        ),
+    ]
@@ -1,3 +1,96 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class ConversionJob(models.Model):
+    """非同期で実行するPDF変換ジョブ（キューの状態をDBに保存する）"""
+
+    class Kind(models.TextChoices):
+        UPLOAD = "upload", "テキスト抽出（パターンB）"
+        HYBRID = "hybrid", "テキスト抽出と文字のないページのOCR"
+        OCR = "ocr", "OCR（パターンA）"
+        OCR_TABLE = "ocr-table", "表の範囲だけのOCR"
+
+    class Status(models.TextChoices):
+        QUEUED = "queued", "待機中"
+        RUNNING = "running", "処理中"
+        DONE = "done", "完了"
+        FAILED = "failed", "失敗"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=16, choices=Kind.choices)
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.QUEUED, db_index=True
+    )
+    file_name = models.CharField(max_length=255, blank=True)
+    file_sha256 = models.CharField(max_length=64)
+    # 処理が終わったら空にする
+    file_data = models.BinaryField(blank=True)
+    # upload・hybridはレコードのリスト、ocr・ocr-tableはMarkdownテキスト
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # 処理中のワーカーが定期的に更新する。途絶えたジョブは待機中に戻す（jobs.reclaim_stale_jobs）
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+
+    def __str__(self):
+        return f"{self.kind} {self.id} ({self.status})"
+
+
+class SourceDocument(models.Model):
+    """変換したETC明細のPDF（同じ内容のPDFは1件として扱う）"""
+
+    file_sha256 = models.CharField(max_length=64, unique=True)
+    file_name = models.CharField(max_length=255, blank=True)
+    record_count = models.PositiveIntegerField(default=0)
+    # 他のPDFで保存済みだったため保存しなかった行数
+    duplicate_count = models.PositiveIntegerField(default=0)
+    # 変換できなかったページ（1始まり）。空でなければ、次の変換で残りの行を追加する
+    failed_pages = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.file_name or self.file_sha256
+
+
+class EtcRecord(models.Model):
+    """ETC明細の1行（金額は円単位の整数）"""
+
+    document = models.ForeignKey(
+        SourceDocument, on_delete=models.CASCADE, related_name="records"
+    )
+    card_number = models.CharField(max_length=32)
+    usage_date = models.DateField()
+    vehicle_type = models.CharField(max_length=16, blank=True)
+    vehicle_number = models.CharField(max_length=32, blank=True)
+    entry_ic = models.CharField(max_length=64, blank=True)
+    exit_ic = models.CharField(max_length=64, blank=True)
+    # ICのマスタ（interchanges.csv）のコード（公式のコードがないICは代わりのコード）。
+    # マスタにないICはNULL
+    entry_ic_code = models.PositiveIntegerField(null=True, blank=True)
+    exit_ic_code = models.PositiveIntegerField(null=True, blank=True)
+    # カード番号・利用年月日・IC・金額から作る利用の指紋（pdfupload.dedup）
+    fingerprint = models.BigIntegerField(null=True, blank=True, unique=True)
+    original_fee = models.IntegerField(null=True, blank=True)
+    final_fee = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["card_number", "usage_date"], name="etcrecord_card_date_idx"
+            ),
+            models.Index(
+                fields=["entry_ic_code", "exit_ic_code"],
+                name="etcrecord_ic_codes_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.card_number} {self.usage_date} {self.entry_ic}-{self.exit_ic}"
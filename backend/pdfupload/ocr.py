@@ -0,0 +1,185 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .memory import MemoryGuard
+from .metrics import count
+
+
+logger = logging.getLogger(__name__)
+
+# OCR結果の形式を変えたら上げる（キャッシュのキーに使う）
+OCR_VERSION = "2"
+
+TESSERACT_CONFIG = r"--oem 3 --psm 6"
+TESSERACT_LANG = "jpn"
+
+
+def render_page(pdf_path, page_number, dpi):
+    """1ページだけを画像に変換（page_numberは1始まり）"""
+    from pdf2image import convert_from_path
+
+    return convert_from_path(
+        pdf_path, dpi=dpi, first_page=page_number, last_page=page_number
+    )[0]
+
+
+def render_document_page(page, dpi):
+    """PyMuPDFのページをグレースケールの画像に変換（popplerを使わずメモリ上で描画する）"""
+    import pymupdf
+    from PIL import Image
+
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY)
+    return Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def ocr_image(image):
+    """画像をOCRしてテキストを返す"""
+    import pytesseract
+
+    return pytesseract.image_to_string(
+        image, lang=TESSERACT_LANG, config=TESSERACT_CONFIG
+    )
+
+
+def ocr_image_with_confidence(image):
+    """画像をOCRしてテキストと単語の平均信頼度を返す"""
+    import pytesseract
+
+    data = pytesseract.image_to_data(
+        image,
+        lang=TESSERACT_LANG,
+        config=TESSERACT_CONFIG,
+        output_type=pytesseract.Output.DICT,
+    )
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        conf = float(data["conf"][i])
+        if conf < 0 or not word.strip():
+            continue
+        confidences.append(conf)
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    return text, confidence
+
+
+def ocr_page(pdf_path, page_number, dpi, draft_dpi=None, min_confidence=0):
+    """1ページをOCRする
+
+    draft_dpiが指定されている場合はまず低解像度でOCRし、
+    平均信頼度がmin_confidence未満のページだけdpiで再度OCRする。
+    """
+    if draft_dpi:
+        image = render_page(pdf_path, page_number, draft_dpi)
+        try:
+            text, confidence = ocr_image_with_confidence(image)
+        finally:
+            image.close()
+        if confidence >= min_confidence:
+            logger.debug(
+                "Page %d: accepted %d DPI OCR (confidence %.1f)",
+                page_number,
+                draft_dpi,
+                confidence,
+            )
+            return text
+        logger.debug(
+            "Page %d: confidence %.1f too low, retrying at %d DPI",
+            page_number,
+            confidence,
+            dpi,
+        )
+
+    image = render_page(pdf_path, page_number, dpi)
+    try:
+        return ocr_image(image)
+    finally:
+        image.close()
+
+
+def ocr_pdf(pdf_path, workers=None, dpi=None, draft_dpi=None, min_confidence=None):
+    """PDFの全ページをOCRし、ページ順のテキストのリストを返す
+
+    ページは1枚ずつ画像化してワーカー内でOCRするため、
+    同時にメモリ上にあるページ画像はワーカー数までに抑えられる。
+    """
+    if workers is None:
+        workers = getattr(settings, "OCR_WORKERS", 1)
+    if dpi is None:
+        dpi = getattr(settings, "OCR_DPI", 300)
+    if draft_dpi is None:
+        draft_dpi = getattr(settings, "OCR_DRAFT_DPI", 0)
+    if min_confidence is None:
+        min_confidence = getattr(settings, "OCR_MIN_CONFIDENCE", 0)
+
+    from pdf2image import pdfinfo_from_path
+
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
+    count("pages", page_count)
+    logger.debug("Running OCR on %d pages with %d workers", page_count, workers)
+    guard = MemoryGuard()
+
+    def run(page_number):
+        # 上限を超えていれば残りのページは描画しない
+        guard.check()
+        text = ocr_page(pdf_path, page_number, dpi, draft_dpi, min_confidence)
+        logger.debug("Processed OCR for page %d", page_number)
+        return text
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        return list(pool.map(run, range(1, page_count + 1)))
+
+
+def map_document_pages(doc, page_numbers, prepare, workers=None, errors=None):
+    """開いているPDFの指定ページ（0始まり）ごとにprepare(page)を呼び、
+    返された関数をワーカーで実行して {ページ番号: 結果} を返す
+
+    PyMuPDFはスレッドセーフではないため、描画などPyMuPDFを使う処理は
+    prepareで呼び出し元のスレッドで行い、OCRだけをワーカーで並列に実行する。
+    準備済みで未処理のページはワーカー数までに抑え、ページを描画する前に
+    MemoryGuardの上限と比べる。
+    errorsに辞書を渡すと、失敗したページは {ページ番号: 例外} をそこに入れて
+    残りのページの処理を続ける（渡さなければ最初の例外を送出する）。
+    """
+    if workers is None:
+        workers = getattr(settings, "OCR_WORKERS", 1)
+    workers = max(workers, 1)
+    guard = MemoryGuard()
+
+    results = {}
+    pending = {}
+
+    def collect(future, page_number):
+        if errors is None:
+            results[page_number] = future.result()
+            return
+        try:
+            results[page_number] = future.result()
+        except Exception as e:
+            logger.warning("Failed to process page %d: %s", page_number + 1, e)
+            errors[page_number] = e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page_number in page_numbers:
+            if len(pending) >= workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, pending.pop(future))
+            guard.check()
+            try:
+                task = prepare(doc[page_number])
+            except Exception as e:
+                if errors is None:
+                    raise
+                logger.warning("Failed to render page %d: %s", page_number + 1, e)
+                errors[page_number] = e
+                continue
+            pending[pool.submit(task)] = page_number
+        for future, page_number in pending.items():
+            collect(future, page_number)
+    logger.debug("Processed OCR for %d pages", len(results))
+    return results
@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from .metrics import collect, merge
+from .extraction import iter_page_windows
+from .pipeline import (
+    ConversionReport,
+    convert_hybrid_to_records,
+    convert_page_range,
+    convert_to_ocr_markdown,
+    convert_to_records,
+    convert_to_table_ocr_markdown,
+    document_outline,
+)
+from .preload import HEAVY_MODULES
+
+
+logger = logging.getLogger(__name__)
+
+# ストリームで変換を先に投入しておくページ範囲の数
+STREAM_PREFETCH = 2
+
+
+class ConversionBusyError(Exception):
+    """同時に実行できる変換の数を超えて待ち時間が上限に達した"""
+
+
+_executor = None
+_executor_lock = threading.Lock()
+# イベントループごとのセマフォ（ワーカープロセスごとにループは1つ）
+_semaphores = weakref.WeakKeyDictionary()
+_thread_semaphore = None
+
+
+def _init_worker():
+    import django
+
+    django.setup()
+
+
+def get_executor():
+    """変換用のプロセスプールを返す（プロセス内で共有）
+
+    uvicornのイベントループやスレッドを引き継がないよう、
+    forkserverで起動したプロセスでDjangoを初期化して使う。
+    重いライブラリはforkserverで一度だけ読み込み、各プロセスに引き継ぐ。
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(list(HEAVY_MODULES))
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, "CONVERSION_WORKERS", 1),
+                mp_context=context,
+                initializer=_init_worker,
+            )
+        return _executor
+
+
+def _discard_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+    logger.warning("Conversion process pool was broken and has been discarded")
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(
+            getattr(settings, "CONVERSION_MAX_CONCURRENCY", 4)
+        )
+    return semaphore
+
+
+@asynccontextmanager
+async def conversion_slot():
+    """同時に実行する変換の数を制限する
+
+    空きを待つのはCONVERSION_QUEUE_TIMEOUT秒まで。超えたらConversionBusyError。
+    """
+    semaphore = _semaphore()
+    try:
+        await asyncio.wait_for(
+            semaphore.acquire(), getattr(settings, "CONVERSION_QUEUE_TIMEOUT", 30)
+        )
+    except asyncio.TimeoutError:
+        raise ConversionBusyError(
+            "変換が混み合っています。しばらくしてから再度お試しください。"
+        )
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@contextmanager
+def sync_conversion_slot():
+    """同期ビュー（スレッドで実行される）で同時に実行する変換の数を制限する"""
+    global _thread_semaphore
+    with _executor_lock:
+        if _thread_semaphore is None:
+            _thread_semaphore = threading.BoundedSemaphore(
+                getattr(settings, "CONVERSION_MAX_CONCURRENCY", 4)
+            )
+    if not _thread_semaphore.acquire(
+        timeout=getattr(settings, "CONVERSION_QUEUE_TIMEOUT", 30)
+    ):
+        raise ConversionBusyError(
+            "変換が混み合っています。しばらくしてから再度お試しください。"
+        )
+    try:
+        yield
+    finally:
+        _thread_semaphore.release()
+
+
+def convert_to_ocr(source, digest=None, report=None):
+    """OCR（パターンA）でMarkdownテキストにする
+
+    popplerにはファイルのパスが必要なので、バイト列は一時ファイルに書き出す。
+    reportは他の変換と引数をそろえるためのもので、何も記録しない。
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return convert_to_ocr_markdown(source, digest)
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as temp_pdf:
+        temp_pdf.write(source)
+        temp_pdf.flush()
+        return convert_to_ocr_markdown(temp_pdf.name, digest)
+
+
+def convert_to_table_ocr(source, digest=None, report=None):
+    """表の範囲だけを列ごとにOCRしたMarkdownにする（reportはconvert_to_ocrと同じ）"""
+    return convert_to_table_ocr_markdown(source, digest)
+
+
+# プロセスプールで実行する処理（引数と戻り値はpickleできるもの）
+# uploadとhybridはレコードのリスト、MARKDOWN_KINDSはMarkdownテキストを返す
+CONVERTERS = {
+    "upload": convert_to_records,
+    "hybrid": convert_hybrid_to_records,
+    "ocr": convert_to_ocr,
+    "ocr-table": convert_to_table_ocr,
+}
+MARKDOWN_KINDS = ("ocr", "ocr-table")
+
+
+def _convert(kind, source, digest):
+    # ワーカープロセスで計測した処理時間と件数（結果キャッシュのヒット・ミスを含む）も
+    # 呼び出し元に返し、_finishで呼び出し元のStageTimerに加える
+    report = ConversionReport()
+    with collect() as timer:
+        result = CONVERTERS[kind](source, digest, report)
+    return result, report, timer.stages, timer.counts
+
+
+def _finish(future_result):
+    result, report, stages, counts = future_result
+    merge(stages, counts)
+    return result, report
+
+
+def convert_in_pool(kind, source, digest, on_wait=None, interval=None):
+    """run_conversionの同期版（ジョブのスレッドや同期ビューから使う）
+
+    変換をプロセスプールで実行し、(結果, ConversionReport) を返す。
+    on_waitを渡すと、結果を待つあいだinterval秒ごとに呼ぶ。
+    """
+    executor = get_executor()
+    try:
+        future = executor.submit(_convert, kind, source, digest)
+        while True:
+            try:
+                return _finish(future.result(timeout=interval if on_wait else None))
+            except TimeoutError:
+                on_wait()
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        raise
+
+
+def convert_many_in_pool(kind, documents):
+    """複数のPDFをプロセスプールで並列に変換し、入力順に (結果, ConversionReport, エラー) を返す
+
+    documentsは (パスまたはbytes, SHA-256) のリスト。変換に失敗したファイルは
+    結果とConversionReportがNoneで、エラーは例外のメッセージ。
+    1つのファイルの失敗で残りのファイルの変換は止めない。
+    """
+    executor = get_executor()
+    try:
+        futures = [
+            executor.submit(_convert, kind, source, digest)
+            for source, digest in documents
+        ]
+        results = []
+        for future in futures:
+            try:
+                result, report = _finish(future.result())
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                results.append((None, None, str(e)))
+            else:
+                results.append((result, report, None))
+        return results
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        raise
+
+
+def _call(func, *args):
+    # _convertと同じく、ワーカープロセスで計測した処理時間と件数も返す
+    with collect() as timer:
+        result = func(*args)
+    return result, timer.stages, timer.counts
+
+
+def _call_result(executor, future):
+    try:
+        result, stages, counts = future.result()
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        raise
+    merge(stages, counts)
+    return result
+
+
+def iter_pages_in_pool(source, skip=(), report=None, window=None):
+    """pipeline.iter_converted_pagesをプロセスプールで実行する（iter_records_by_page用）
+
+    最初のwindowページは1ページずつ、以降はwindowページずつ投入し、
+    変換できたページ範囲から順に返す。最初のページの行はwindow全体を待たずに返せる。
+    投入しておくのはSTREAM_PREFETCH範囲までで、途中で閉じたら残りを取り消す。
+    """
+    if report is None:
+        report = ConversionReport()
+    if window is None:
+        window = getattr(settings, "PDF_PAGE_WINDOW", 8)
+    executor = get_executor()
+    layout_name, page_count = _call_result(
+        executor, executor.submit(_call, document_outline, source)
+    )
+    pages = [
+        page_number for page_number in range(page_count) if page_number not in skip
+    ]
+    chunks = iter(
+        [[page_number] for page_number in pages[:window]]
+        + list(iter_page_windows(pages[window:], window))
+    )
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < STREAM_PREFETCH:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append(
+                    executor.submit(
+                        _call, convert_page_range, source, layout_name, chunk
+                    )
+                )
+            if not pending:
+                return
+            results, chunk_report = _call_result(executor, pending.popleft())
+            report.merge(chunk_report)
+            yield from results
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def run_conversion(kind, source, digest):
+    """PDF（パスまたはbytes）の変換をプロセスプールで実行し、(結果, ConversionReport) を返す"""
+    async with conversion_slot():
+        loop = asyncio.get_running_loop()
+        executor = get_executor()
+        try:
+            return _finish(
+                await loop.run_in_executor(executor, _convert, kind, source, digest)
+            )
+        except BrokenProcessPool:
+            # ワーカーが異常終了したプールは使えないので、次の変換で作り直す
+            _discard_executor(executor)
+            raise
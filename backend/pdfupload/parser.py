@@ -0,0 +1,351 @@
+import io
+import logging
+import re
+from collections import namedtuple
+
+from django.conf import settings
+
+from .interchanges import get_interchanges
+
+
+logger = logging.getLogger(__name__)
+
+
+# 解析結果の形式や明細のレイアウト（layouts.LAYOUTS）を変えたら上げる（キャッシュのキーに使う）
+PARSER_VERSION = "5"
+
+# 出力する列（表示名）
+HEADERS = (
+    "カード番号",
+    "利用月",
+    "利用年月日",
+    "車種",
+    "車両番号",
+    "入口IC",
+    "出口IC",
+    "割引前の金額",
+    "割引後の金額",
+)
+# 入口・出口の時刻の列。markdown・json・Excelの列が変わるので、
+# OUTPUT_TRIP_TIMESが有効な場合だけHEADERSの後に加える（CSVなどの型付きの出力には常に含む）
+TIME_HEADERS = ("入口時刻", "出口時刻")
+
+# 1行分の利用明細（フィールドの並びはHEADERS + TIME_HEADERSと同じ）
+EtcRecord = namedtuple(
+    "EtcRecord",
+    [
+        "card_number",
+        "month",
+        "date",
+        "vehicle_type",
+        "vehicle_number",
+        "entry_ic",
+        "exit_ic",
+        "original_fee",
+        "final_fee",
+        "entry_time",
+        "exit_time",
+    ],
+    # 時刻の列を追加する前に保存されたジョブの結果も読めるようにする
+    defaults=("", ""),
+)
+
+# 23/04/01 形式の日付
+_DATE_RE = re.compile(r"(\d+)/(\d+)/(\d+)")
+# 時刻（HH:MM）・日付（YY/MM/DD）・数字のみのトークンはICではない
+_NOT_IC_RE = re.compile(r"[:/]|\A\d+\Z")
+# 07:32 形式の時刻
+_TIME_RE = re.compile(r"(\d{1,2}):(\d\d)")
+# 時刻とICの間の空白が抽出で失われた "07:32今井" を分ける
+_TIME_GLUED_RE = re.compile(r"(\d:\d\d)(?=[^\d\s|])")
+# "1, 230" のように分割された桁区切りを結合する
+_SPLIT_THOUSANDS_RE = re.compile(r",\s+")
+_PARENS = str.maketrans("", "", "()")
+# OCRの行で料金とみなすトークン（"(1,230)"・"980"）
+_OCR_FEE_RE = re.compile(r"\A\(?[\d,]+\)?\Z")
+# マスクされたカード番号（"****12345678"）または16桁前後の数字
+_OCR_CARD_RE = re.compile(r"\A[*＊\d]{12,}\Z")
+
+
+def parser_version():
+    """解析結果のキャッシュの版（ICのマスタを差し替えた場合も変わる）"""
+    return f"{PARSER_VERSION}.{get_interchanges().version}"
+
+
+def iter_lines(text):
+    """テキストを1行ずつ返す（全体をリストに分割しない）"""
+    return io.StringIO(text)
+
+
+def canonical_ic_name(name):
+    """ICのマスタにある名前ならマスタの表記（全レコードで共有する文字列）を返す"""
+    interchange = get_interchanges().lookup(name) if name else None
+    return name if interchange is None else interchange.name
+
+
+def correct_ic_names(cell):
+    """OCRで読み取った「日付・時刻・IC」の列のIC名を、マスタの最も近い名前に補正する
+
+    日付で始まらない（明細の行でない）セルと、マスタがすべてのICを含まない
+    （IC_MASTER_COMPLETEでない）場合はそのまま返す。マスタにない名前は補正しない。
+    """
+    interchanges = get_interchanges()
+    if not interchanges.complete:
+        return cell
+    tokens = _TIME_GLUED_RE.sub(r"\1 ", cell.replace("<br>", "")).split()
+    if not tokens or _DATE_RE.match(tokens[0]) is None:
+        return cell
+    for i, token in enumerate(tokens):
+        if _NOT_IC_RE.search(token):
+            continue
+        interchange = interchanges.closest(token)
+        if interchange is not None and interchange.name != token:
+            logger.debug("Corrected IC name %r to %r", token, interchange.name)
+            tokens[i] = interchange.name
+    return " ".join(tokens)
+
+
+def _format_date(match):
+    """日付の正規表現のマッチを (20240902形式の利用年月日, 利用月) にする"""
+    year, month, day = match.groups()
+    if len(year) <= 2:
+        year = f"20{year}"
+    return f"{year}{month.zfill(2)}{day.zfill(2)}", str(int(month))  # 04 → 4
+
+
+def parse_trip_cell(cell):
+    """「日付・時刻・IC」のセルを解析する
+
+    (利用年月日, 利用月, 入口IC, 出口IC, 入口時刻, 出口時刻) を返す。
+    日付で始まらないセルはNone。
+    """
+    # セル内の折り返し（<br>）はIC名の途中で起きるので詰める
+    date_ic_info = _TIME_GLUED_RE.sub(r"\1 ", cell.replace("<br>", "")).split()
+    if len(date_ic_info) < 5:
+        return None
+    date_match = _DATE_RE.match(date_ic_info[0])
+    if date_match is None:
+        return None
+    formatted_date, month_number = _format_date(date_match)
+
+    # ICの情報を抽出（最初のICを入口、最後のICを出口として扱う）
+    ic_info = [x for x in date_ic_info if not _NOT_IC_RE.search(x)]
+    if not ic_info:
+        entry_ic = ""
+        exit_ic = ""
+    elif len(ic_info) == 1:
+        # ICが1つの場合は出口ICとして扱う
+        entry_ic = ""
+        exit_ic = ic_info[0]
+    else:
+        entry_ic = ic_info[0]
+        exit_ic = ic_info[-1]
+    # 自)や至)が含まれている場合は除去
+    entry_ic = canonical_ic_name(entry_ic.replace("自)", "").strip())
+    exit_ic = canonical_ic_name(exit_ic.replace("至)", "").strip())
+
+    # 時刻もICと同じく、1つだけなら出口の時刻として扱う（7:32 → 07:32）
+    times = [
+        f"{int(m[1]):02d}:{m[2]}"
+        for m in map(_TIME_RE.fullmatch, date_ic_info)
+        if m is not None
+    ]
+    entry_time = times[0] if len(times) > 1 else ""
+    exit_time = times[-1] if times else ""
+    return formatted_date, month_number, entry_ic, exit_ic, entry_time, exit_time
+
+
+def parse_fee_cell(cell):
+    """「(割引前料金) 通行料金」のセルから (割引前の金額, 割引後の金額) を返す"""
+    # 先頭が割引前、末尾が割引後
+    fee_info = _SPLIT_THOUSANDS_RE.sub(",", cell.replace("<br>", " ").strip()).split()
+    if not fee_info:
+        return "", ""
+    return fee_info[0].translate(_PARENS), fee_info[-1]
+
+
+def parse_vehicle_cell(cell):
+    """「車種 車両番号 カード番号」のセルから (車種, 車両番号, カード番号) を返す"""
+    vehicle_info = cell.replace("<br>", " ").split()
+    if len(vehicle_info) < 3:
+        return None
+    return vehicle_info[0], vehicle_info[1], vehicle_info[2]
+
+
+def parse_date_cell(cell):
+    """利用年月日だけのセル（"23/04/01"・"2023/04/01"）から (利用年月日, 利用月) を返す"""
+    date_match = _DATE_RE.fullmatch(cell.strip())
+    if date_match is None:
+        return None
+    return _format_date(date_match)
+
+
+def parse_ic_cell(cell):
+    """IC名だけのセルから (IC名,) を返す（マスタにある名前はマスタの表記にする）"""
+    name = "".join(cell.replace("<br>", "").split())
+    return (canonical_ic_name(name.replace("自)", "").replace("至)", "")),)
+
+
+def parse_time_cell(cell):
+    """時刻だけのセルから (07:32形式の時刻,) を返す（時刻でなければ空文字列）"""
+    time_match = _TIME_RE.fullmatch(cell.strip())
+    if time_match is None:
+        return ("",)
+    return (f"{int(time_match[1]):02d}:{time_match[2]}",)
+
+
+def parse_amount_cell(cell):
+    """金額だけのセル（"(1,230)"・"1, 230"）から (金額,) を返す"""
+    amount = _SPLIT_THOUSANDS_RE.sub(",", cell.replace("<br>", "").strip())
+    return (amount.translate(_PARENS),)
+
+
+def parse_text_cell(cell):
+    """車種・車両番号などの文字列のセルから (折り返しと空白を詰めた文字列,) を返す"""
+    return (" ".join(cell.replace("<br>", " ").split()),)
+
+
+def parse_card_cell(cell):
+    """カード番号だけのセルから (カード番号,) を返す（空のセルはNone）"""
+    card_number = "".join(cell.replace("<br>", "").split())
+    return (card_number,) if card_number else None
+
+
+def parse_line(line):
+    """Markdownの1行を解析してEtcRecordを返す（データ行でなければNone）
+
+    ETC利用照会サービスの明細の列の並び（日付・IC / 料金 / 後納料金 / 車両・カード / 備考）。
+    ほかの並びの明細はlayoutsのLayoutで解析する。
+    """
+    if "|" not in line or line.startswith("|---") or "利用年月日" in line:
+        return None
+
+    # 必要なのは先頭5列だけなので、それ以降は分割しない
+    parts = line.strip().split("|", 5)
+    if len(parts) < 5:
+        return None
+
+    trip = parse_trip_cell(parts[1])
+    if trip is None:
+        return None
+    date, month, entry_ic, exit_ic, entry_time, exit_time = trip
+    original_fee, final_fee = parse_fee_cell(parts[2])
+    vehicle = parse_vehicle_cell(parts[4])
+    if vehicle is None:
+        return None
+    vehicle_type, vehicle_number, card_number = vehicle
+
+    return EtcRecord(
+        card_number,
+        month,
+        date,
+        vehicle_type,
+        vehicle_number,
+        entry_ic,
+        exit_ic,
+        original_fee,
+        final_fee,
+        entry_time,
+        exit_time,
+    )
+
+
+def ocr_line_to_markdown(line):
+    """OCRで読み取った明細の1行を、parse_lineが解析できる表の行にする
+
+    OCRでは列の区切りがなくなるため、トークンの形から列を推定する。
+    （日付・時刻・IC）（料金）（後納料金）（車種 車両番号 カード番号）（備考）
+    の並びになっていない行はNoneを返す。
+    """
+    tokens = _SPLIT_THOUSANDS_RE.sub(",", line).split()
+    if not tokens or _DATE_RE.match(tokens[0]) is None:
+        return None
+
+    card_index = next(
+        (i for i, token in enumerate(tokens) if _OCR_CARD_RE.match(token)), None
+    )
+    if card_index is None or card_index < 3:
+        return None
+
+    # 日付・時刻とICのあとに続く料金のトークン（日付・時刻は料金の形にならない）
+    fee_start = next(
+        (i for i in range(1, card_index - 2) if _OCR_FEE_RE.match(tokens[i])), None
+    )
+    if fee_start is None:
+        return None
+    fees = tokens[fee_start : card_index - 2]
+    if fees[0].startswith("(") and len(fees) > 1:
+        fee_column, deferred_column = fees[:2], fees[2:]
+    else:
+        fee_column, deferred_column = fees[:1], fees[1:]
+
+    columns = (
+        correct_ic_names(" ".join(tokens[:fee_start])).split(),
+        fee_column,
+        deferred_column,
+        tokens[card_index - 2 : card_index + 1],
+        tokens[card_index + 1 :],
+    )
+    return "|" + "|".join(" ".join(column) for column in columns) + "|"
+
+
+def iter_ocr_markdown_lines(text):
+    """OCRのテキストから明細の行だけを表の行にして返す"""
+    for line in iter_lines(text):
+        row = ocr_line_to_markdown(line)
+        if row is not None:
+            yield row
+
+
+def parse_records(lines, parse_line=parse_line, counts=None):
+    """行のイテラブルからEtcRecordを1件ずつ返すジェネレータ
+
+    parse_lineは1行を解析する関数（明細のレイアウトごとに異なる）。
+    counts（Counter）を渡すと、読み飛ばした行を数える。
+    "skipped" は日付を含む表の行なのにレコードにならなかった行、
+    "failed" は解析中に例外が発生した行。
+    """
+    for line in lines:
+        try:
+            record = parse_line(line)
+        except Exception as e:
+            logger.warning("行の解析中にエラーが発生しました: %s", e)
+            if counts is not None:
+                counts["failed"] += 1
+            continue
+        if record is not None:
+            yield record
+        elif counts is not None and "|" in line and _DATE_RE.search(line):
+            counts["skipped"] += 1
+
+
+def parse_text(text, parse_line=parse_line, counts=None):
+    """抽出したMarkdownテキスト全体からEtcRecordを1件ずつ返す"""
+    return parse_records(iter_lines(text), parse_line, counts)
+
+
+def output_headers():
+    """markdown・json・Excelで出力する列の表示名（レコードの先頭からこの列数だけ出力する）"""
+    if getattr(settings, "OUTPUT_TRIP_TIMES", False):
+        return HEADERS + TIME_HEADERS
+    return HEADERS
+
+
+def markdown_row(values):
+    """値のリストをMarkdownの表の1行にする"""
+    return "| " + " | ".join(values) + " |"
+
+
+def iter_markdown_lines(records, header=True):
+    """ヘッダーとレコードをMarkdownの表として1行ずつ返す（header=Falseならレコードだけ）"""
+    headers = output_headers()
+    if header:
+        yield markdown_row(headers)
+        yield "|" + "---|" * len(headers)
+    for record in records:
+        yield markdown_row(record[: len(headers)])
+
+
+def to_markdown(records):
+    """レコードをMarkdownの表に変換"""
+    return "\n".join(iter_markdown_lines(records))
@@ -0,0 +1,403 @@
+import heapq
+import logging
+from collections import Counter
+from operator import itemgetter
+
+from .cache import get_result_cache
+from .extraction import (
+    extract_isolated_markdown,
+    iter_isolated_markdown,
+    open_document,
+    text_layer_pages,
+)
+from .metrics import count, stage
+from .ocr import OCR_VERSION, ocr_pdf
+from .interchanges import get_interchanges
+from .layouts import detect_layout, get_layout
+from .parser import parser_version
+from .table_ocr import ocr_document_tables
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionReport:
+    """ページごとの変換の結果（ページ番号はすべて1始まり）
+
+    failed_pages: 抽出にもOCRにも失敗し、レコードに含まれていないページ
+    recovered_pages: テキストの抽出に失敗し、OCRで読み直したページ
+    reused_pages: 前回の変換で成功していたので、変換し直さなかったページ
+    skipped_rows・failed_rows: 日付があるのにレコードにならなかった行・解析中に
+    例外になった行の数（parse_records）。row_error_pagesはそれらの行があったページ
+    """
+
+    def __init__(self):
+        self.parsed_rows = 0
+        self.skipped_rows = 0
+        self.failed_rows = 0
+        self.failed_pages = []
+        self.recovered_pages = []
+        self.reused_pages = []
+        self.row_error_pages = []
+
+    @property
+    def complete(self):
+        """全ページを変換できたか"""
+        return not self.failed_pages
+
+    def add_rows(self, page_number, records, counts):
+        """1ページ（0始まり）の解析結果を加える"""
+        self.parsed_rows += len(records)
+        self.skipped_rows += counts["skipped"]
+        self.failed_rows += counts["failed"]
+        if counts["skipped"] or counts["failed"]:
+            self.row_error_pages.append(page_number + 1)
+        count("skipped_rows", counts["skipped"])
+        count("failed_rows", counts["failed"])
+
+    def add_failed_page(self, page_number):
+        self.failed_pages.append(page_number + 1)
+        count("failed_pages", 1)
+
+    def merge(self, other):
+        """別のConversionReport（一部のページをプロセスプールで変換したもの）を加える"""
+        self.parsed_rows += other.parsed_rows
+        self.skipped_rows += other.skipped_rows
+        self.failed_rows += other.failed_rows
+        self.failed_pages.extend(other.failed_pages)
+        self.recovered_pages.extend(other.recovered_pages)
+        self.row_error_pages.extend(other.row_error_pages)
+
+    def as_dict(self):
+        return {name: value for name, value in vars(self).items()}
+
+
+def _parse_page(layout, page_number, text, report):
+    counts = Counter()
+    records = list(layout.parse_text(text, counts))
+    report.add_rows(page_number, records, counts)
+    return records
+
+
+def convert_pages(source, layout, text_pages, ocr_pages, report):
+    """指定ページ（0始まり）ごとにレコードを取り出し、{ページ番号: レコードのリスト} を返す
+
+    text_pagesはテキストレイヤーから抽出し（PDF_EXTRACT_WORKERSが2以上ならページ範囲ごとに
+    並列に抽出する）、ocr_pagesと抽出に失敗したページは
+    表を列ごとにOCRする。1ページの失敗で文書全体を失敗にはせず、
+    OCRにも失敗したページは結果に含めずにreportに記録する。
+    """
+    texts = {}
+    retry_pages = []
+    with stage("extract"):
+        for page_number, text, _ in extract_isolated_markdown(source, text_pages):
+            if text is None:
+                retry_pages.append(page_number)
+            else:
+                texts[page_number] = text
+
+    ocr_targets = sorted([*ocr_pages, *retry_pages])
+    if ocr_targets:
+        errors = {}
+        with stage("ocr"), open_document(source) as doc:
+            texts.update(ocr_document_tables(doc, ocr_targets, errors=errors))
+        for page_number in sorted(errors):
+            report.add_failed_page(page_number)
+        report.recovered_pages.extend(
+            page_number + 1 for page_number in retry_pages if page_number not in errors
+        )
+
+    with stage("parse"):
+        return {
+            page_number: _parse_page(layout, page_number, texts[page_number], report)
+            for page_number in sorted(texts)
+        }
+
+
+def _all_pages_as_text(doc):
+    """テキストレイヤーから全ページを抽出する（OCRするページはない）"""
+    count("pages", doc.page_count)
+    return list(range(doc.page_count)), []
+
+
+def _split_by_text_layer(doc):
+    """テキストレイヤーのあるページは抽出し、文字のないページだけOCRする"""
+    has_text = text_layer_pages(doc)
+    text_pages = [i for i, text in enumerate(has_text) if text]
+    image_pages = [i for i, text in enumerate(has_text) if not text]
+    count("pages", len(has_text))
+    count("ocr_pages", len(image_pages))
+    logger.debug(
+        "%d pages with text layer, %d pages to OCR", len(text_pages), len(image_pages)
+    )
+    return text_pages, image_pages
+
+
+def _convert_document(source, digest, namespace, version, split_pages, report):
+    """ページごとに変換したレコードをページ順のリストで返す（結果はキャッシュする）
+
+    split_pages(doc) は (抽出するページ, OCRするページ) を返す関数。
+    失敗したページがあれば、成功したページの結果だけを "<namespace>-pages" に
+    キャッシュする。同じPDFを変換し直すときは、前回失敗したページだけを変換する。
+    """
+    if report is None:
+        report = ConversionReport()
+    result_cache = get_result_cache()
+    cache_key = pages_key = None
+    converted = {}
+    if digest is not None:
+        # 同じ内容のPDFを解析済みであればキャッシュを使う
+        cache_key = result_cache.make_key(namespace, digest, version)
+        with stage("cache"):
+            records = result_cache.get(cache_key)
+        if records is not None:
+            logger.debug("Cache hit for %s", digest)
+            count("rows", len(records))
+            report.parsed_rows = len(records)
+            return records
+        pages_key = result_cache.make_key(f"{namespace}-pages", digest, version)
+        converted = result_cache.get(pages_key) or {}
+
+    # 1ページ目から明細のレイアウトを見分け、そのレイアウトで1行ずつ解析する
+    with stage("classify"):
+        layout = detect_layout(source)
+    with open_document(source) as doc:
+        text_pages, ocr_pages = split_pages(doc)
+    if converted:
+        logger.debug("Reusing %d pages converted before for %s", len(converted), digest)
+        report.reused_pages = [page_number + 1 for page_number in sorted(converted)]
+        report.parsed_rows = sum(map(len, converted.values()))
+    converted.update(
+        convert_pages(
+            source,
+            layout,
+            [page_number for page_number in text_pages if page_number not in converted],
+            [page_number for page_number in ocr_pages if page_number not in converted],
+            report,
+        )
+    )
+    records = [
+        record for page_number in sorted(converted) for record in converted[page_number]
+    ]
+    count("rows", len(records))
+
+    if report.complete:
+        if cache_key is not None:
+            result_cache.set(cache_key, records)
+    else:
+        logger.warning("Could not convert pages %s of %s", report.failed_pages, digest)
+        if pages_key is not None:
+            result_cache.set(pages_key, converted)
+    return records
+
+
+def convert_to_records(source, digest=None, report=None):
+    """テキストレイヤーからETC明細のレコードを取り出す（パターンB）
+
+    明細のレイアウトは1ページ目の見出しから見分ける（layouts.LAYOUTS）。
+    テキストを抽出できなかったページだけをOCRし、それも失敗したページは除いて返す。
+    sourceはPDFのパスまたはバイト列。digestが指定されていれば解析結果をキャッシュする。
+    reportを渡すと、ページごとの結果と行数をConversionReportに記録する。
+    """
+    return _convert_document(
+        source, digest, "upload", parser_version(), _all_pages_as_text, report
+    )
+
+
+def document_outline(source):
+    """PDFの (明細のレイアウトの名前, ページ数) を返す"""
+    layout = detect_layout(source)
+    with open_document(source) as doc:
+        page_count = doc.page_count
+    count("pages", page_count)
+    return layout.name, page_count
+
+
+def iter_converted_pages(source, skip=(), report=None):
+    """PDFのページ（skipのページ番号を除く）を変換し、
+    (ページ番号(0始まり), レコードのリスト) をページ順に返す（変換できなかったページはNone）
+    """
+    if report is None:
+        report = ConversionReport()
+    layout_name, page_count = document_outline(source)
+    yield from _iter_converted_pages(
+        source,
+        get_layout(layout_name),
+        [page_number for page_number in range(page_count) if page_number not in skip],
+        report,
+    )
+
+
+def convert_page_range(source, layout_name, pages):
+    """指定ページ（0始まり）を変換し、([(ページ番号, レコードのリスト)], ConversionReport) を返す
+
+    プロセスプールで実行するため、レイアウトは名前で受け取る。
+    """
+    report = ConversionReport()
+    results = list(
+        _iter_converted_pages(source, get_layout(layout_name), pages, report)
+    )
+    return results, report
+
+
+def _iter_converted_pages(source, layout, pages, report):
+    # 抽出に失敗したページはその場で1ページだけOCRし、ページ順に返す
+    for page_number, text, _ in iter_isolated_markdown(source, pages):
+        if text is None:
+            errors = {}
+            with open_document(source) as doc:
+                text = ocr_document_tables(doc, [page_number], errors=errors).get(
+                    page_number
+                )
+            if text is None:
+                report.add_failed_page(page_number)
+                yield page_number, None
+                continue
+            report.recovered_pages.append(page_number + 1)
+        yield page_number, _parse_page(layout, page_number, text, report)
+
+
+def iter_records_by_page(source, digest=None, report=None, convert_pages=None):
+    """テキストレイヤーから1ページずつレコードを取り出し、(ページ番号, レコードのリスト) を返す
+
+    変換できなかったページはレコードのリストをNoneにして返す。
+    キャッシュがあれば全件を1ページ目としてまとめて返す。前回の変換で成功したページは
+    キャッシュから返す。最後のページまで読み終えたら結果をキャッシュする。
+    convert_pagesはiter_converted_pagesと同じ引数と戻り値で、残りのページを変換する
+    （offload.iter_pages_in_poolを渡すとプロセスプールで変換する）。
+    """
+    if convert_pages is None:
+        convert_pages = iter_converted_pages
+    if report is None:
+        report = ConversionReport()
+    result_cache = get_result_cache()
+    cache_key = pages_key = None
+    converted = {}
+    if digest is not None:
+        cache_key = result_cache.make_key("upload", digest, parser_version())
+        records = result_cache.get(cache_key)
+        if records is not None:
+            logger.debug("Cache hit for %s", digest)
+            report.parsed_rows = len(records)
+            yield 1, records
+            return
+        pages_key = result_cache.make_key("upload-pages", digest, parser_version())
+        converted = result_cache.get(pages_key) or {}
+
+    report.reused_pages = [page_number + 1 for page_number in sorted(converted)]
+    report.parsed_rows = sum(map(len, converted.values()))
+    pages = heapq.merge(
+        sorted(converted.items()),
+        convert_pages(source, set(converted), report),
+        key=itemgetter(0),
+    )
+    for page_number, page_records in pages:
+        if page_records is not None:
+            converted[page_number] = page_records
+        yield page_number + 1, page_records
+
+    if report.complete:
+        if cache_key is not None:
+            result_cache.set(
+                cache_key,
+                [record for i in sorted(converted) for record in converted[i]],
+            )
+    elif pages_key is not None:
+        result_cache.set(pages_key, converted)
+
+
+def ocr_pages_to_text(pages):
+    """ページごとのOCR結果をページ区切り付きの1つのテキストにまとめる"""
+    return "".join(
+        f"--- Page {i} ---\n{page_text}\n" for i, page_text in enumerate(pages, 1)
+    )
+
+
+def format_ocr_markdown(text):
+    """OCRで抽出されたテキストをMarkdown形式に変換"""
+    markdown_lines = []
+    for line in text.split("\n"):
+        if line.startswith("--- Page"):
+            markdown_lines.append(f"## {line}")
+        elif line.strip():
+            markdown_lines.append(line)
+    return "\n".join(markdown_lines)
+
+
+def convert_to_ocr_markdown(pdf_path, digest=None):
+    """OCRでPDFのテキストを抽出してMarkdownにする（パターンA）
+
+    digestが指定されていれば結果をキャッシュする。
+    """
+    result_cache = get_result_cache()
+    cache_key = None
+    if digest is not None:
+        # 同じ内容のPDFをOCR済みであればキャッシュを使う
+        cache_key = result_cache.make_key("ocr", digest, OCR_VERSION)
+        with stage("cache"):
+            markdown_text = result_cache.get(cache_key)
+        if markdown_text is not None:
+            logger.debug("Cache hit for %s", digest)
+            return markdown_text
+
+    try:
+        with stage("ocr"):
+            pages = ocr_pdf(pdf_path)
+    except Exception as e:
+        logger.error("Error during OCR processing: %s", e)
+        raise Exception(f"Error during OCR processing: {e}")
+    with stage("format"):
+        markdown_text = format_ocr_markdown(ocr_pages_to_text(pages))
+
+    if cache_key is not None:
+        result_cache.set(cache_key, markdown_text)
+    return markdown_text
+
+
+def convert_to_table_ocr_markdown(source, digest=None):
+    """各ページの表の範囲だけを列ごとにOCRし、ページごとの表のMarkdownにする
+
+    sourceはPDFのパスまたはバイト列。digestが指定されていれば結果をキャッシュする。
+    """
+    result_cache = get_result_cache()
+    cache_key = None
+    if digest is not None:
+        cache_key = result_cache.make_key(
+            "ocr-table", digest, f"{OCR_VERSION}.{get_interchanges().version}"
+        )
+        with stage("cache"):
+            markdown_text = result_cache.get(cache_key)
+        if markdown_text is not None:
+            logger.debug("Cache hit for %s", digest)
+            return markdown_text
+
+    with open_document(source) as doc:
+        count("pages", doc.page_count)
+        with stage("ocr"):
+            tables = ocr_document_tables(doc, range(doc.page_count))
+    markdown_text = "\n".join(
+        f"## --- Page {page_number + 1} ---\n{tables[page_number]}"
+        for page_number in sorted(tables)
+    )
+
+    if cache_key is not None:
+        result_cache.set(cache_key, markdown_text)
+    return markdown_text
+
+
+def convert_hybrid_to_records(source, digest=None, report=None):
+    """ページごとにテキスト抽出とOCRを使い分けてレコードを取り出す
+
+    テキストレイヤーのあるページは抽出し、文字のないページと抽出に失敗したページは
+    表の範囲を列ごとにOCRするため、どちらのページも同じ形式のMarkdownの表になる。
+    sourceはPDFのパスまたはバイト列。digestが指定されていれば解析結果をキャッシュする。
+    reportはconvert_to_recordsと同じ。
+    """
+    return _convert_document(
+        source,
+        digest,
+        "hybrid",
+        f"{parser_version()}.{OCR_VERSION}",
+        _split_by_text_layer,
+        report,
+    )
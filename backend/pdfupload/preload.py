@@ -0,0 +1,38 @@
+import importlib
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# 読み込みに時間とメモリがかかるため、各モジュールで使うときにimportしているライブラリ
+HEAVY_MODULES = (
+    "pymupdf",
+    "pymupdf4llm",
+    "PIL.Image",
+    "pytesseract",
+    "pdf2image",
+    "numpy",
+    "pandas",
+    "openpyxl",
+)
+
+
+def preload_modules(modules=HEAVY_MODULES):
+    """重いライブラリをまとめて読み込み、{モジュール名: 秒} を返す
+
+    gunicornのpreload_appでマスタープロセスから呼ぶと、
+    フォークしたワーカーは読み込み済みのモジュールを引き継ぐ。
+    インストールされていないモジュールは読み飛ばす。
+    """
+    seconds = {}
+    for name in modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            logger.warning("Could not preload %s", name)
+            continue
+        seconds[name] = time.perf_counter() - start
+    logger.debug("Preloaded %d modules in %.2fs", len(seconds), sum(seconds.values()))
+    return seconds
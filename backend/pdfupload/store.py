@@ -0,0 +1,280 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+from . import models
+from .dedup import find_stored_fingerprints, trip_fingerprints
+from .interchanges import get_interchanges
+from .metrics import count
+from .normalize import normalize_columns
+
+
+logger = logging.getLogger(__name__)
+
+BULK_CREATE_BATCH_SIZE = 1000
+
+# DBに書き込む列（利用月はusage_dateから求められるので保存しない）
+_ROW_FIELDS = (
+    "card_number",
+    "usage_date",
+    "vehicle_type",
+    "vehicle_number",
+    "entry_ic",
+    "exit_ic",
+    "original_fee",
+    "final_fee",
+    "entry_ic_code",
+    "exit_ic_code",
+    # 重複した利用を見つけるための指紋（一意インデックス）。最後の列にする
+    "fingerprint",
+)
+
+
+def _db_rows(records):
+    """利用年月日が読み取れたレコードを_ROW_FIELDSの並びの行のリストにする"""
+    columns = normalize_columns(records)
+    # 利用年月日の列名はモデルではusage_date
+    columns["usage_date"] = columns["date"]
+    columns["fingerprint"] = trip_fingerprints(columns)
+    return [
+        row
+        for row in zip(*(columns[field] for field in _ROW_FIELDS))
+        if row[1] is not None
+    ]
+
+
+def _copy_rows(document, rows):
+    """PostgreSQLのCOPYでまとめて書き込む（psycopg 3）"""
+    table = models.EtcRecord._meta.db_table
+    columns = ", ".join(("document_id",) + _ROW_FIELDS)
+    with connection.cursor() as cursor:
+        with cursor.copy(f"COPY {table} ({columns}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row((document.pk,) + row)
+    return len(rows)
+
+
+def _bulk_create_rows(document, rows):
+    """bulk_createで書き込む（指紋が保存済みの行は書き込まない）"""
+    objs = [
+        models.EtcRecord(document=document, **dict(zip(_ROW_FIELDS, row)))
+        for row in rows
+    ]
+    models.EtcRecord.objects.bulk_create(
+        objs, batch_size=BULK_CREATE_BATCH_SIZE, ignore_conflicts=True
+    )
+    return document.records.count()
+
+
+def save_records(digest, file_name, records, failed_pages=()):
+    """変換したレコードをDBに保存する
+
+    同じ内容のPDF（SHA-256が同じ）が保存済みの場合は何もしない。ただし前回の変換で
+    失敗したページがあった場合は、まだ保存していない行だけを追加する。
+    failed_pagesには今回変換できなかったページ（1始まり）を渡す。
+    他のPDFで保存済みの利用（指紋が同じ行）は書き込まず、件数をduplicate_countに残す。
+    PostgreSQLではCOPY、それ以外ではbulk_createで書き込む。
+    """
+    with transaction.atomic():
+        document, created = models.SourceDocument.objects.get_or_create(
+            file_sha256=digest, defaults={"file_name": file_name or ""}
+        )
+        if not created and not document.failed_pages:
+            return document
+
+        rows = _db_rows(records)
+        stored = find_stored_fingerprints(row[-1] for row in rows)
+        new_rows = [row for row in rows if row[-1] not in stored]
+        if connection.vendor != "postgresql":
+            saved = _bulk_create_rows(document, new_rows)
+        else:
+            try:
+                with transaction.atomic():
+                    saved = _copy_rows(document, new_rows)
+            except IntegrityError:
+                # 同時に保存された他のPDFの明細と重複した行がある
+                saved = _bulk_create_rows(document, new_rows)
+
+        # 追加した場合、前回保存した行は指紋が同じなのでnew_rowsに含まれない
+        document.record_count = saved if created else document.records.count()
+        document.duplicate_count = len(rows) - document.record_count
+        document.failed_pages = list(failed_pages)
+        document.save(update_fields=["record_count", "duplicate_count", "failed_pages"])
+    count("duplicate_rows", document.duplicate_count)
+    logger.debug(
+        "Saved %d records for %s (%d duplicates skipped)",
+        saved,
+        digest,
+        document.duplicate_count,
+    )
+    return document
+
+
+def save_records_safely(digest, file_name, records, failed_pages=()):
+    """設定で有効な場合だけ保存する（失敗しても変換結果の返却は妨げない）"""
+    if not getattr(settings, "PERSIST_RECORDS", False):
+        return None
+    try:
+        return save_records(digest, file_name, records, failed_pages)
+    except Exception:
+        logger.exception("Failed to save records")
+        return None
+
+
+def refresh_ic_codes():
+    """保存済みのレコードのICのコードを、現在のICのマスタで付け直す
+
+    IC名の種類ごとに1回UPDATEする。変更した行数を返す。
+    """
+    interchanges = get_interchanges()
+    updated = 0
+    with transaction.atomic():
+        for field in ("entry_ic", "exit_ic"):
+            code_field = f"{field}_code"
+            names = (
+                models.EtcRecord.objects.order_by()
+                .values_list(field, flat=True)
+                .distinct()
+            )
+            for name in list(names):
+                interchange = interchanges.lookup(name) if name else None
+                code = None if interchange is None else interchange.code
+                updated += (
+                    models.EtcRecord.objects.filter(**{field: name})
+                    .exclude(**{code_field: code})
+                    .update(**{code_field: code})
+                )
+    return updated
+
+
+def backfill_fingerprints():
+    """指紋の列を追加する前（マイグレーション0004より前）に保存したレコードに指紋を付ける
+
+    明細（SourceDocument）ごとに、保存した順（idの順）のレコードからsave_recordsと
+    同じ指紋を求める。他の明細で保存済みの利用と指紋が同じ行は重複なので、
+    指紋を付けずに残す。(指紋を付けた行数, 重複していた行数) を返す。
+    """
+    filled = duplicates = 0
+    document_ids = (
+        models.EtcRecord.objects.filter(fingerprint=None)
+        .order_by("document_id")
+        .values_list("document_id", flat=True)
+        .distinct()
+    )
+    for document_id in list(document_ids):
+        with transaction.atomic():
+            rows = list(
+                models.EtcRecord.objects.filter(document_id=document_id)
+                .order_by("id")
+                .values_list(
+                    "id",
+                    "card_number",
+                    "usage_date",
+                    "entry_ic",
+                    "exit_ic",
+                    "final_fee",
+                    "fingerprint",
+                )
+            )
+            ids, card_numbers, dates, entry_ics, exit_ics, fees, stored = zip(*rows)
+            fingerprints = trip_fingerprints(
+                {
+                    "card_number": card_numbers,
+                    "date": dates,
+                    "entry_ic": entry_ics,
+                    "exit_ic": exit_ics,
+                    "final_fee": fees,
+                }
+            )
+            missing = {
+                fingerprint: pk
+                for pk, fingerprint, current in zip(ids, fingerprints, stored)
+                if current is None
+            }
+            found = find_stored_fingerprints(missing)
+            updates = [
+                models.EtcRecord(pk=pk, fingerprint=fingerprint)
+                for fingerprint, pk in missing.items()
+                if fingerprint not in found
+            ]
+            models.EtcRecord.objects.bulk_update(
+                updates, ["fingerprint"], batch_size=BULK_CREATE_BATCH_SIZE
+            )
+        filled += len(updates)
+        duplicates += len(missing) - len(updates)
+    return filled, duplicates
+
+
+# 集計でグループ化できる項目
+SUMMARY_GROUPS = (
+    "month",
+    "card_number",
+    "vehicle_number",
+    "entry_ic",
+    "exit_ic",
+    "entry_ic_code",
+    "exit_ic_code",
+)
+
+
+def filter_records(params):
+    """クエリパラメータでEtcRecordを絞り込む
+
+    card_number・vehicle_number・entry_ic・exit_icは完全一致
+    （ICのマスタにあるIC名は、コードがあればコード、なければマスタの表記で絞り込む）、
+    month（YYYY-MM）・date_from・date_to（YYYY-MM-DD）は利用年月日で絞り込む。
+    日付の形式が正しくなければValueErrorを送出する。
+    """
+    queryset = models.EtcRecord.objects.all()
+    for field in ("card_number", "vehicle_number"):
+        if params.get(field):
+            queryset = queryset.filter(**{field: params[field]})
+    for field in ("entry_ic", "exit_ic"):
+        if params.get(field):
+            interchange = get_interchanges().lookup(params[field])
+            if interchange is None:
+                queryset = queryset.filter(**{field: params[field]})
+            elif interchange.code is None:
+                queryset = queryset.filter(**{field: interchange.name})
+            else:
+                queryset = queryset.filter(**{f"{field}_code": interchange.code})
+    if params.get("month"):
+        month = _parse_param(params, "month", "%Y-%m", "YYYY-MM")
+        queryset = queryset.filter(
+            usage_date__year=month.year, usage_date__month=month.month
+        )
+    if params.get("date_from"):
+        date_from = _parse_param(params, "date_from", "%Y-%m-%d", "YYYY-MM-DD")
+        queryset = queryset.filter(usage_date__gte=date_from)
+    if params.get("date_to"):
+        date_to = _parse_param(params, "date_to", "%Y-%m-%d", "YYYY-MM-DD")
+        queryset = queryset.filter(usage_date__lte=date_to)
+    return queryset
+
+
+def _parse_param(params, name, date_format, display_format):
+    """クエリパラメータを日付にする（読めなければパラメータ名と形式を示すValueError）"""
+    try:
+        return datetime.datetime.strptime(params[name], date_format).date()
+    except ValueError:
+        raise ValueError(
+            f"{name} must be a date in {display_format} format: {params[name]!r}"
+        ) from None
+
+
+def summarize_records(queryset, group_by):
+    """指定した項目ごとに件数と金額の合計をDB側で集計する"""
+    queryset = queryset.annotate(month=TruncMonth("usage_date"))
+    return (
+        queryset.values(*group_by)
+        .annotate(
+            trip_count=Count("id"),
+            original_fee_total=Sum("original_fee"),
+            final_fee_total=Sum("final_fee"),
+        )
+        .order_by(*group_by)
+    )
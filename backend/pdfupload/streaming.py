@@ -0,0 +1,205 @@
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+from .exporters import EXPORT_COLUMNS, ndjson_line, ndjson_rows
+from .metrics import StageTimer, count, registry
+from .offload import iter_pages_in_pool, sync_conversion_slot
+from .parser import iter_markdown_lines
+from .pipeline import ConversionReport, iter_records_by_page
+from .store import save_records_safely
+from .uploads import upload_source
+
+
+logger = logging.getLogger(__name__)
+
+MARKDOWN_STREAM_CONTENT_TYPE = "text/markdown; charset=utf-8"
+NDJSON_STREAM_CONTENT_TYPE = "application/x-ndjson; charset=utf-8"
+
+
+def iter_upload_pages(file_obj, report=None):
+    """アップロードされたPDFから1ページずつ (ページ番号, レコードのリスト) を返す
+
+    抽出はプロセスプールで実行し、変換できたページから順に返す（iter_pages_in_pool）。
+    変換できなかったページはレコードのリストがNone（reportに記録する）。
+    最後のページまで読み終えたらレコードをDBに保存する。
+    """
+    if report is None:
+        report = ConversionReport()
+    records = []
+    source, digest = upload_source(file_obj)
+    for page_number, page_records in iter_records_by_page(
+        source, digest, report, iter_pages_in_pool
+    ):
+        records.extend(page_records or ())
+        yield page_number, page_records
+    save_records_safely(digest, file_obj.name, records, report.failed_pages)
+
+
+def _stream_failed():
+    # MeteredStreamが失敗（500）として集計する
+    count("stream_errors", 1)
+
+
+def iter_markdown_stream(file_obj):
+    """ヘッダーを先に返し、明細の行をページごとにMarkdownの表として返す
+
+    ステータスコードは先に送るので、最後に結果をHTMLのコメントで返す。
+    最後まで変換できた場合は <!-- etc-stream: done {...} -->（行数と失敗したページ）、
+    途中で失敗した場合は <!-- etc-stream: error {...} -->。どちらもない場合は途中で切れている。
+    """
+    yield "".join(f"{line}\n" for line in iter_markdown_lines(()))
+    report = ConversionReport()
+    rows = 0
+    try:
+        for _, records in iter_upload_pages(file_obj, report):
+            if records:
+                rows += len(records)
+                yield "".join(
+                    f"{line}\n" for line in iter_markdown_lines(records, header=False)
+                )
+    except Exception as e:
+        logger.exception("An error occurred while streaming markdown")
+        _stream_failed()
+        yield _markdown_trailer("error", {"error": str(e), "rows": rows})
+        return
+    yield _markdown_trailer("done", {"rows": rows, **report.as_dict()})
+
+
+def _markdown_trailer(status, data):
+    # 表の後に空行を挟み、表示されないコメントにする（"--" はコメントを閉じうるのでエスケープする）
+    payload = json.dumps(data, ensure_ascii=False).replace("--", "-\\u002d")
+    return f"\n<!-- etc-stream: {status} {payload} -->\n"
+
+
+def iter_ndjson_stream(file_obj):
+    """header・page・done（失敗した場合はerror）のイベントを1行ずつJSONで返す
+
+    pageのrecordsはformat=ndjsonの各行と同じ形（ndjson_rows）。
+    変換できなかったページはpage_errorのイベントにし、残りのページを続けて返す。
+    doneには行数と失敗したページ（ConversionReport.as_dict）を含める。
+    """
+    yield ndjson_line({"event": "header", "headers": list(EXPORT_COLUMNS)})
+    report = ConversionReport()
+    pages = rows = 0
+    try:
+        for page_number, records in iter_upload_pages(file_obj, report):
+            pages += 1
+            if records is None:
+                yield ndjson_line({"event": "page_error", "page": page_number})
+                continue
+            rows += len(records)
+            yield ndjson_line(
+                {
+                    "event": "page",
+                    "page": page_number,
+                    "records": list(ndjson_rows(records)),
+                }
+            )
+    except Exception as e:
+        logger.exception("An error occurred while streaming NDJSON")
+        _stream_failed()
+        yield ndjson_line({"event": "error", "error": str(e)})
+        return
+    yield ndjson_line(
+        {"event": "done", "pages": pages, "rows": rows, **report.as_dict()}
+    )
+
+
+class MeteredStream:
+    """送り終えるまで変換の枠（sync_conversion_slot）を使い、StageTimerで計測するイテレータ
+
+    枠が空かなければ作成時にConversionBusyErrorを送出するので、送信を始める前に
+    503を返せる。ASGIでは1件ずつ別のスレッドで進むため、with timer: で囲まずに
+    1件ごとにtimer.activate()で記録先にする。close()で枠を返して集計に加える。
+    ステータスコードは先に200で送っているが、ストリームがエラーで終わった場合
+    （stream_errorsを数えた場合）は500として集計する。
+    """
+
+    def __init__(self, view_name, iterator):
+        self._stack = ExitStack()
+        self._stack.enter_context(sync_conversion_slot())
+        self._iterator = iterator
+        self._start = time.perf_counter()
+        self.timer = StageTimer(view_name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.timer.activate():
+            try:
+                return next(self._iterator)
+            except StopIteration:
+                self.close()
+                raise
+
+    def close(self):
+        if self._stack is None:
+            return
+        stack, self._stack = self._stack, None
+        with stack:
+            with self.timer.activate():
+                # 途中で切断された場合も一時ファイルなどを解放する
+                self._iterator.close()
+            self.timer.stages.append(("total", time.perf_counter() - self._start))
+            failed = self.timer.counts.get("stream_errors")
+            registry.record(self.timer, 500 if failed else 200)
+
+
+async def _iterate_in_thread(iterator):
+    """同期イテレータを1件ずつスレッドで進める非同期イテレータ（ASGI用）"""
+    sentinel = object()
+    try:
+        while True:
+            chunk = await sync_to_async(next)(iterator, sentinel)
+            if chunk is sentinel:
+                break
+            yield chunk
+    finally:
+        # クライアントが切断した場合も一時ファイルなどを解放する
+        await sync_to_async(iterator.close)()
+
+
+def streaming_response(request, iterator, content_type):
+    """iteratorを少しずつ送るStreamingHttpResponseを返す
+
+    ASGIでは同期イテレータを渡すとDjangoが全体を読み込んでから送るため、
+    非同期イテレータに変換して渡す。
+    """
+    iterator = iter(iterator)
+    if isinstance(getattr(request, "_request", request), ASGIRequest):
+        iterator = _iterate_in_thread(iterator)
+    response = StreamingHttpResponse(iterator, content_type=content_type)
+    # nginxなどのプロキシにバッファリングさせない
+    response["X-Accel-Buffering"] = "no"
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def markdown_stream_response(request, file_obj):
+    return streaming_response(
+        request,
+        MeteredStream("upload-stream", iter_markdown_stream(file_obj)),
+        MARKDOWN_STREAM_CONTENT_TYPE,
+    )
+
+
+def ndjson_stream_response(request, file_obj):
+    return streaming_response(
+        request,
+        MeteredStream("upload-stream", iter_ndjson_stream(file_obj)),
+        NDJSON_STREAM_CONTENT_TYPE,
+    )
+
+
+# format=... で指定できるストリーミング形式
+STREAM_RESPONSES = {
+    "markdown-stream": markdown_stream_response,
+    "ndjson-stream": ndjson_stream_response,
+}
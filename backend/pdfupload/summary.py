@@ -0,0 +1,114 @@
+from .normalize import normalize_columns
+
+
+# 集計結果の列（表示名）
+CARD_SUMMARY_HEADERS = (
+    "カード番号",
+    "利用年月",
+    "利用回数",
+    "割引前の金額合計",
+    "割引後の金額合計",
+    "割引額",
+)
+VEHICLE_SUMMARY_HEADERS = (
+    "車両番号",
+    "利用年月",
+    "利用回数",
+    "割引前の金額合計",
+    "割引後の金額合計",
+    "割引額",
+)
+CARD_SUMMARY_SHEET_NAME = "カード別月次集計"
+VEHICLE_SUMMARY_SHEET_NAME = "車両別月次集計"
+
+_SUMMARY_COLUMNS = [
+    "trip_count",
+    "original_fee_total",
+    "final_fee_total",
+    "discount_total",
+]
+
+
+def records_frame(records):
+    """レコードを集計用のDataFrameにする（正規化した型付きの列から作る）
+
+    金額・割引額は読み取れなければ欠損値（<NA>）のままにして、合計に含めない。
+    """
+    import pandas as pd
+
+    columns = normalize_columns(records)
+    return pd.DataFrame(
+        {
+            "card_number": columns["card_number"],
+            "vehicle_number": columns["vehicle_number"],
+            # date(2023, 4, 1) → "2023-04"（利用年月日が読めない行は集計しない）
+            "year_month": [
+                None if date is None else f"{date.year}-{date.month:02d}"
+                for date in columns["date"]
+            ],
+            "original_fee": pd.array(columns["original_fee"], dtype="Int64"),
+            "final_fee": pd.array(columns["final_fee"], dtype="Int64"),
+            # 割引前・割引後のどちらかが読めない行の割引額は<NA>
+            "discount": pd.array(columns["discount"], dtype="Int64"),
+        }
+    )
+
+
+def _summarize(df, key):
+    grouped = df.groupby([key, "year_month"], sort=True)
+    # 欠損値は合計に含めない（グループのすべてが欠損値なら合計も<NA>）
+    totals = grouped[["original_fee", "final_fee", "discount"]].sum(min_count=1)
+    totals.columns = _SUMMARY_COLUMNS[1:]
+    totals.insert(0, "trip_count", grouped.size())
+    totals = totals.reset_index()
+    # <NA>はJSON・Excelに書けないのでNoneにする
+    return totals.astype(object).where(totals.notna(), None)
+
+
+def summarize(records):
+    """カード別・車両別の月次集計を返す
+
+    戻り値は {"by_card": DataFrame, "by_vehicle": DataFrame, "undated_rows": 件数,
+    "unpriced_rows": 件数}。undated_rowsは利用年月日が読めず集計に含めなかった行、
+    unpriced_rowsは利用回数には数えたが、金額が読めず金額の合計に含めなかった行
+    （割引前・割引後の片方だけ読めた行は、読めた方の合計には含める）。
+    """
+    df = records_frame(records)
+    dated = df["year_month"].notna()
+    return {
+        "by_card": _summarize(df, "card_number"),
+        "by_vehicle": _summarize(df, "vehicle_number"),
+        "undated_rows": int((~dated).sum()),
+        "unpriced_rows": int((dated & df["discount"].isna()).sum()),
+    }
+
+
+def summary_json(summaries):
+    """集計結果をJSONで返せる形にする"""
+    data = {
+        name: summaries[name].rename(columns={"year_month": "month"}).to_dict("records")
+        for name in ("by_card", "by_vehicle")
+    }
+    data["undated_rows"] = summaries["undated_rows"]
+    data["unpriced_rows"] = summaries["unpriced_rows"]
+    return data
+
+
+def summary_tables(summaries):
+    """集計結果をExcelのシート (シート名, ヘッダー, 行) のリストにする"""
+    return [
+        (
+            CARD_SUMMARY_SHEET_NAME,
+            CARD_SUMMARY_HEADERS,
+            summaries["by_card"][
+                ["card_number", "year_month", *_SUMMARY_COLUMNS]
+            ].itertuples(index=False, name=None),
+        ),
+        (
+            VEHICLE_SUMMARY_SHEET_NAME,
+            VEHICLE_SUMMARY_HEADERS,
+            summaries["by_vehicle"][
+                ["vehicle_number", "year_month", *_SUMMARY_COLUMNS]
+            ].itertuples(index=False, name=None),
+        ),
+    ]
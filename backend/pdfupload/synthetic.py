@@ -0,0 +1,111 @@
+import random
+from html import escape
+
+
+# 明細書と同じ並びの列（日付・IC / 料金 / 後納料金 / 車両・カード / 備考）
+STATEMENT_HEADERS = (
+    "利用年月日 時分 利用ＩＣ(自) 利用ＩＣ(至)",
+    "(割引前料金) 通行料金",
+    "還元額適用料金 後納料金",
+    "車種 車両番号 ＥＴＣカード番号",
+    "備考",
+)
+
+INTERCHANGES = (
+    "横新狩場接続",
+    "阪東橋",
+    "今井",
+    "日野",
+    "狩場",
+    "衣笠",
+    "逗子",
+    "朝比奈",
+    "浅田",
+    "磯子",
+    "花之木",
+    "新山下上",
+    "第三京浜接続",
+)
+
+ROWS_PER_PAGE = 25
+
+# A4横向き
+_PAGE_WIDTH = 842
+_PAGE_HEIGHT = 595
+_TABLE_RECT = (20, 40, _PAGE_WIDTH - 20, _PAGE_HEIGHT - 20)
+_CELL_STYLE = "border: 1px solid black; padding: 2px;"
+# セル内で折り返すと1行が複数行に分かれて抽出されるため、列幅を固定する
+_COLUMN_WIDTHS = ("46%", "14%", "12%", "20%", "8%")
+
+
+def generate_rows(count, seed=0, cards=3):
+    """ランダムなETC明細の行（各列の文字列のタプル）をcount件作る"""
+    rng = random.Random(seed)
+    vehicles = [
+        (str(rng.randint(1, 5)), str(rng.randint(1000, 9999)), f"********{n:08d}")
+        for n in rng.sample(range(10**7, 10**8), cards)
+    ]
+    rows = []
+    for _ in range(count):
+        month = rng.randint(1, 12)
+        day = rng.randint(1, 28)
+        hour = rng.randint(0, 22)
+        minute = rng.randint(0, 59)
+        date = f"23/{month:02d}/{day:02d}"
+        entry_ic, exit_ic = rng.sample(INTERCHANGES, 2)
+        fee = rng.randint(3, 400) * 10
+        discounted = fee - rng.randint(0, fee // 20) * 10
+        vehicle_type, vehicle_number, card_number = rng.choice(vehicles)
+        rows.append(
+            (
+                f"{date} {hour:02d}:{minute:02d} {date} {hour + 1:02d}:{minute:02d} "
+                f"{entry_ic} {exit_ic}",
+                f"({fee:,}) {discounted:,}",
+                f"0 {discounted:,}",
+                f"{vehicle_type} {vehicle_number} {card_number}",
+                "確定",
+            )
+        )
+    return rows
+
+
+def rows_to_markdown(rows):
+    """行をpymupdf4llmが出力するMarkdownの表と同じ形式にする"""
+    lines = ["|" + "|".join(STATEMENT_HEADERS) + "|", "|---" * 5 + "|"]
+    lines.extend("|" + "|".join(row) + "|" for row in rows)
+    return "\n".join(lines) + "\n"
+
+
+def _page_html(rows):
+    cells = []
+    for row in (STATEMENT_HEADERS, *rows):
+        # ICの前後で単語が繋がらないよう、空白は全角スペースにする
+        tds = "".join(
+            f'<td style="{_CELL_STYLE} width: {width};">'
+            f'{escape(cell).replace(" ", "　")}</td>'
+            for cell, width in zip(row, _COLUMN_WIDTHS)
+        )
+        cells.append(f"<tr>{tds}</tr>")
+    return (
+        '<table style="border-collapse: collapse; font-size: 6.5pt; width: 100%;">'
+        + "".join(cells)
+        + "</table>"
+    )
+
+
+def rows_to_pdf(rows, rows_per_page=ROWS_PER_PAGE):
+    """行をテキストレイヤー付きの明細書PDFにしてバイト列で返す"""
+    import pymupdf
+
+    doc = pymupdf.open()
+    try:
+        for start in range(0, max(len(rows), 1), rows_per_page):
+            page = doc.new_page(width=_PAGE_WIDTH, height=_PAGE_HEIGHT)
+            page.insert_htmlbox(
+                _TABLE_RECT, _page_html(rows[start : start + rows_per_page])
+            )
+        # 埋め込みフォントをサブセット化しないと1ページ数MBになる
+        doc.subset_fonts()
+        return doc.tobytes(garbage=4, deflate=True)
+    finally:
+        doc.close()
@@ -0,0 +1,160 @@
+import bisect
+import logging
+
+from django.conf import settings
+
+from .ocr import (
+    TESSERACT_CONFIG,
+    TESSERACT_LANG,
+    map_document_pages,
+    ocr_image,
+    render_document_page,
+)
+from .parser import correct_ic_names, iter_ocr_markdown_lines
+
+
+logger = logging.getLogger(__name__)
+
+# 画素の明るさがこれ未満なら罫線・文字とみなす
+_DARK_THRESHOLD = 128
+# 横罫線: 行の画素のうち暗い画素の割合がこれ以上
+_HORIZONTAL_RULE_FRACTION = 0.5
+# 縦罫線: 表の高さのうち暗い画素の割合がこれ以上
+_VERTICAL_RULE_FRACTION = 0.8
+# セルの内側に残る罫線の太さ（画素）
+_RULE_MARGIN = 3
+
+
+def _rule_positions(mask):
+    """Trueが連続する範囲ごとに中央の位置を返す（太い罫線を1本にまとめる）"""
+    import numpy as np
+
+    indices = np.flatnonzero(mask)
+    if not len(indices):
+        return []
+    runs = np.split(indices, np.flatnonzero(np.diff(indices) > 1) + 1)
+    return [int(run.mean()) for run in runs]
+
+
+def detect_rules(image):
+    """ページ画像から表の罫線を探し、(縦罫線のx座標, 横罫線のy座標) を返す
+
+    スキャンした明細のように罫線がベクターで残っていないページで使う。
+    """
+    import numpy as np
+
+    dark = np.asarray(image) < _DARK_THRESHOLD
+    ys = _rule_positions(dark.mean(axis=1) >= _HORIZONTAL_RULE_FRACTION)
+    if len(ys) < 2:
+        return [], []
+    # 縦罫線は表の上端から下端の範囲だけで判定する
+    table = dark[ys[0] : ys[-1] + 1]
+    xs = _rule_positions(table.mean(axis=0) >= _VERTICAL_RULE_FRACTION)
+    return xs, ys
+
+
+def pdf_table_grid(page, scale):
+    """PyMuPDFで表を検出し、画像上の (縦罫線のx座標, 横罫線のy座標) を返す"""
+    tables = page.find_tables().tables
+    if not tables:
+        return [], []
+    table = max(tables, key=lambda t: t.row_count * t.col_count)
+    cells = [cell for cell in table.rows[0].cells if cell is not None]
+    xs = [cell[0] for cell in cells] + [cells[-1][2]]
+    ys = [row.bbox[1] for row in table.rows] + [table.rows[-1].bbox[3]]
+    return [round(x * scale) for x in xs], [round(y * scale) for y in ys]
+
+
+def table_grid(page, image, dpi):
+    """ページの表の罫線の位置を返す（ベクターの罫線がなければ画像から探す）"""
+    xs, ys = pdf_table_grid(page, dpi / 72)
+    if len(xs) < 2 or len(ys) < 2:
+        xs, ys = detect_rules(image)
+    if len(xs) < 2 or len(ys) < 2:
+        return None
+    return xs, ys
+
+
+def _column_words(image, box):
+    """列の範囲だけを切り出してOCRし、(文字, 画像上の中心のy座標, 行) を読み順に返す"""
+    import pytesseract
+
+    top = box[1]
+    crop = image.crop(box)
+    try:
+        data = pytesseract.image_to_data(
+            crop,
+            lang=TESSERACT_LANG,
+            config=TESSERACT_CONFIG,
+            output_type=pytesseract.Output.DICT,
+        )
+    finally:
+        crop.close()
+    return [
+        (
+            word,
+            top + data["top"][i] + data["height"][i] / 2,
+            (data["block_num"][i], data["par_num"][i], data["line_num"][i]),
+        )
+        for i, word in enumerate(data["text"])
+        if float(data["conf"][i]) >= 0 and word.strip()
+    ]
+
+
+def ocr_table_cells(image, xs, ys):
+    """表を列ごとに切り出してOCRし、セルの文字列の行のリストを返す
+
+    単語は中心のy座標が含まれる横罫線の間の行に割り当てる。
+    セル内で折り返した行はpymupdf4llmの出力と同じく<br>でつなぐ。
+    """
+    rows = [[{} for _ in range(len(xs) - 1)] for _ in range(len(ys) - 1)]
+    for column, (left, right) in enumerate(zip(xs, xs[1:])):
+        box = (left + _RULE_MARGIN, ys[0], right - _RULE_MARGIN, ys[-1])
+        for word, center, line in _column_words(image, box):
+            row = bisect.bisect(ys, center) - 1
+            if 0 <= row < len(rows):
+                rows[row][column].setdefault(line, []).append(word)
+    return [
+        ["<br>".join(" ".join(words) for words in cell.values()) for cell in row]
+        for row in rows
+        if any(row)
+    ]
+
+
+def cells_to_markdown(rows):
+    """セルの行をparse_lineが解析できる表の行にする"""
+    return "".join("|" + "|".join(row) + "|\n" for row in rows)
+
+
+def ocr_document_tables(doc, page_numbers, workers=None, dpi=None, errors=None):
+    """指定ページ（0始まり）の表を列ごとにOCRし、{ページ番号: 表のMarkdown} を返す
+
+    表が見つからないページはページ全体をOCRし、明細の行を推定して表の行にする。
+    errorsはmap_document_pagesと同じ（失敗したページの例外を入れて続ける）。
+    """
+    if dpi is None:
+        dpi = getattr(settings, "OCR_DPI", 300)
+
+    def prepare(page):
+        page_number = page.number
+        image = render_document_page(page, dpi)
+        grid = table_grid(page, image, dpi)
+
+        def run():
+            try:
+                if grid is None:
+                    logger.debug("No table found on page %d", page_number + 1)
+                    return "".join(
+                        f"{row}\n" for row in iter_ocr_markdown_lines(ocr_image(image))
+                    )
+                rows = ocr_table_cells(image, *grid)
+                # 1列目（日付・時刻・IC）のIC名はマスタの名前に補正する
+                return cells_to_markdown(
+                    [[correct_ic_names(row[0]), *row[1:]] for row in rows if row]
+                )
+            finally:
+                image.close()
+
+        return run
+
+    return map_document_pages(doc, page_numbers, prepare, workers, errors)
@@ -1,3 +1,932 @@
-from django.test import TestCase
+import asyncio
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from . import exporters, extraction, jobs, models, pipeline, views
+from .cache import (
+    DiskCacheBackend,
+    DjangoCacheBackend,
+    ResultCache,
+    get_result_cache,
+)
+from .dedup import find_stored_fingerprints, trip_fingerprints
+from .interchanges import SURROGATE_CODE_BASE, get_interchanges
+from .layouts import DEFAULT_LAYOUT, classify_document, classify_text, get_layout
+from .memory import MemoryGuard, MemoryLimitExceeded
+from .middleware import limit_request_body
+from .normalize import amount_column, date_column, datetime_columns, normalize_columns
+from .parser import (
+    EtcRecord,
+    parse_card_cell,
+    parse_date_cell,
+    parse_fee_cell,
+    parse_line,
+    parse_records,
+    parse_time_cell,
+    parse_trip_cell,
+    parse_vehicle_cell,
+    to_markdown,
+)
+from .store import (
+    backfill_fingerprints,
+    filter_records,
+    refresh_ic_codes,
+    save_records,
+)
+from .summary import summarize, summary_json, summary_tables
+from .synthetic import generate_rows, rows_to_markdown, rows_to_pdf
+
+
+class InlineConversionMixin:
+    """変換のプロセスプールを同じプロセスのスレッドに置き換え、結果キャッシュを有効にする"""
+
+    def setUp(self):
+        super().setUp()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        self.result_cache = ResultCache(DjangoCacheBackend())
+        self.result_cache.backend.cache.clear()
+        for target, value in (
+            ("pdfupload.offload.get_executor", lambda: executor),
+            ("pdfupload.pipeline.get_result_cache", lambda: self.result_cache),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def upload(self, url="/api/upload/", pdf=None, **data):
+        pdf = SimpleUploadedFile(
+            "statement.pdf", pdf or rows_to_pdf(generate_rows(30)), "application/pdf"
+        )
+        return self.client.post(url, {"file": pdf, **data})
+
+
+def _record(card_number="********15433721", date="20230619", fee="680"):
+    return EtcRecord(
+        card_number,
+        "6",
+        date,
+        "3",
+        "8808",
+        "今井",
+        "狩場",
+        "740",
+        fee,
+        "06:32",
+        "07:32",
+    )
+
+
+class ParseLineTests(SimpleTestCase):
+    def test_statement_row(self):
+        record = parse_line(
+            "|23/06/19 06:32 23/06/19 07:32今井 狩場|(1, 230) 1, 100|0 1,100|"
+            "3 8808 ********15433721|確定|"
+        )
+        self.assertEqual(
+            record,
+            EtcRecord(
+                "********15433721",
+                "6",
+                "20230619",
+                "3",
+                "8808",
+                "今井",
+                "狩場",
+                "1,230",
+                "1,100",
+                "06:32",
+                "07:32",
+            ),
+        )
+
+    def test_skips_trip_with_fewer_than_five_tokens(self):
+        line = "|23/06/19 07:32 今井 狩場|(740) 680|0 680|3 8808 ********15433721|確定|"
+        self.assertIsNone(parse_line(line))
+
+    def test_skips_header_and_separator(self):
+        self.assertIsNone(parse_line("|利用年月日 時分|(割引前料金) 通行料金|||"))
+        self.assertIsNone(parse_line("|---|---|---|---|---|"))
+
+    def test_counts_skipped_rows(self):
+        counts = {"skipped": 0, "failed": 0}
+        lines = [
+            "|23/06/19 07:32 今井 狩場|(740) 680|0 680|3 8808 ********15433721|確定|",
+            "|23/06/19 06:32 23/06/19 07:32 今井 狩場|(740) 680|0 680|3 8808|確定|",
+            "テキストだけの行",
+        ]
+        self.assertEqual(list(parse_records(lines, counts=counts)), [])
+        self.assertEqual(counts, {"skipped": 2, "failed": 0})
+
+    def test_synthetic_markdown(self):
+        rows = generate_rows(20)
+        records = list(parse_records(rows_to_markdown(rows).splitlines()))
+        self.assertEqual(len(records), 20)
+
+
+class CellParserTests(SimpleTestCase):
+    def test_trip_cell_with_single_ic_is_exit(self):
+        trip = parse_trip_cell("23/06/19 06:32 23/06/19 07:32 狩場")
+        self.assertEqual(trip, ("20230619", "6", "", "狩場", "06:32", "07:32"))
+
+    def test_trip_cell_joins_wrapped_ic_name(self):
+        trip = parse_trip_cell("23/05/02 17:58 23/05/02 18:58横新狩場接<br>続 阪東橋")
+        self.assertEqual(trip[2:4], ("横新狩場接続", "阪東橋"))
+
+    def test_trip_cell_without_date(self):
+        self.assertIsNone(parse_trip_cell("備考 06:32 07:32 今井 狩場"))
+
+    def test_fee_cell(self):
+        self.assertEqual(parse_fee_cell("(1, 230)<br>1, 100"), ("1,230", "1,100"))
+        self.assertEqual(parse_fee_cell(""), ("", ""))
+
+    def test_vehicle_cell_needs_three_tokens(self):
+        self.assertIsNone(parse_vehicle_cell("3 8808"))
+
+    def test_date_cell(self):
+        self.assertEqual(parse_date_cell(" 2023/4/1 "), ("20230401", "4"))
+        self.assertIsNone(parse_date_cell("2023/4/1 07:32"))
+
+    def test_time_cell(self):
+        self.assertEqual(parse_time_cell("7:32"), ("07:32",))
+        self.assertEqual(parse_time_cell("--:--"), ("",))
+
+    def test_card_cell(self):
+        self.assertEqual(parse_card_cell("****<br>1234"), ("****1234",))
+        self.assertIsNone(parse_card_cell(" "))
+
+
+class NormalizeTests(SimpleTestCase):
+    def test_amount_column(self):
+        self.assertEqual(
+            amount_column(["1,230", "(1,230)", "980", "", "abc"]),
+            [1230, 1230, 980, None, None],
+        )
+
+    def test_negative_amount_column(self):
+        self.assertEqual(
+            amount_column(["-1,230", "△980", "(−50)", "-", "1-2"]),
+            [-1230, -980, -50, None, None],
+        )
+
+    def test_date_column(self):
+        self.assertEqual(
+            date_column(["20230401", "20230231", ""]),
+            [datetime.date(2023, 4, 1), None, None],
+        )
+
+    def test_exit_after_midnight_is_next_day(self):
+        entry_at, exit_at = datetime_columns(
+            [datetime.date(2023, 4, 1), None], ["23:50", "07:00"], ["00:20", "08:00"]
+        )
+        self.assertEqual(entry_at, [datetime.datetime(2023, 4, 1, 23, 50), None])
+        self.assertEqual(exit_at, [datetime.datetime(2023, 4, 2, 0, 20), None])
+
+    def test_discount(self):
+        columns = normalize_columns([_record(fee="680"), _record(fee="")])
+        self.assertEqual(columns["discount"], [60, None])
+        self.assertEqual(columns["month"], [6, 6])
+
+
+class OutputColumnTests(SimpleTestCase):
+    def test_trip_times_are_opt_in(self):
+        header = to_markdown([_record()]).splitlines()[0]
+        self.assertNotIn("入口時刻", header)
+        with override_settings(OUTPUT_TRIP_TIMES=True):
+            lines = to_markdown([_record()]).splitlines()
+        self.assertIn("入口時刻", lines[0])
+        self.assertTrue(lines[2].endswith("| 06:32 | 07:32 |"))
+
+
+class InterchangeCodeTests(TestCase):
+    def test_bundled_master_has_a_code_for_every_ic(self):
+        interchanges = get_interchanges()
+        for name in ("今井", "狩場", "大黒埠頭", "名古屋"):
+            with self.subTest(name=name):
+                self.assertGreater(interchanges.lookup(name).code, SURROGATE_CODE_BASE)
+
+    def test_saved_records_get_ic_codes(self):
+        save_records("ic", "ic.pdf", [_record()])
+        record = models.EtcRecord.objects.get()
+        self.assertEqual(record.entry_ic_code, get_interchanges().lookup("今井").code)
+        self.assertEqual(record.exit_ic_code, get_interchanges().lookup("狩場").code)
+        self.assertEqual(refresh_ic_codes(), 0)
+        self.assertEqual(filter_records({"entry_ic": "今井"}).count(), 1)
+        self.assertEqual(filter_records({"exit_ic": "今井"}).count(), 0)
+
+
+class SummaryTests(SimpleTestCase):
+    def test_unreadable_fees_are_left_out_of_totals(self):
+        records = [_record(), _record(fee="x"), _record(date="2023/6/?")]
+        summaries = summarize(records)
+        self.assertEqual(summaries["undated_rows"], 1)
+        self.assertEqual(summaries["unpriced_rows"], 1)
+        self.assertEqual(
+            summary_json(summaries)["by_card"],
+            [
+                {
+                    "card_number": "********15433721",
+                    "month": "2023-06",
+                    "trip_count": 2,
+                    "original_fee_total": 1480,
+                    "final_fee_total": 680,
+                    "discount_total": 60,
+                }
+            ],
+        )
+
+    def test_excluded_rows_are_reported_in_headers(self):
+        response = views.records_response(
+            [_record(fee="x"), _record(date="")], "summary"
+        )
+        self.assertEqual(response["X-Undated-Rows"], "1")
+        self.assertEqual(response["X-Unpriced-Rows"], "1")
+        self.assertIn("X-Unpriced-Rows", response["Access-Control-Expose-Headers"])
+
+    def test_group_without_readable_fees(self):
+        summaries = summarize([_record(fee="x")])
+        row = summary_json(summaries)["by_vehicle"][0]
+        self.assertEqual(row["final_fee_total"], None)
+        self.assertEqual(row["discount_total"], None)
+        self.assertEqual(row["original_fee_total"], 740)
+
+
+class DedupTests(TestCase):
+    def test_repeated_trip_in_one_statement_has_distinct_fingerprints(self):
+        columns = normalize_columns([_record(), _record()])
+        first, second = trip_fingerprints(columns)
+        self.assertNotEqual(first, second)
+
+    def test_same_trip_twice_in_one_statement_is_kept(self):
+        document = save_records("a" * 64, "a.pdf", [_record(), _record()])
+        self.assertEqual(document.record_count, 2)
+        self.assertEqual(document.duplicate_count, 0)
+
+    def test_trip_saved_from_another_statement_is_skipped(self):
+        save_records("a" * 64, "a.pdf", [_record(), _record()])
+        document = save_records(
+            "b" * 64, "b.pdf", [_record(), _record(date="20230620")]
+        )
+        self.assertEqual(document.record_count, 1)
+        self.assertEqual(document.duplicate_count, 1)
+
+    def test_stored_fingerprints_are_looked_up_in_batches(self):
+        save_records("a" * 64, "a.pdf", [_record(), _record(date="20230620")])
+        fingerprints = list(
+            models.EtcRecord.objects.values_list("fingerprint", flat=True)
+        )
+        with mock.patch("pdfupload.dedup.LOOKUP_BATCH_SIZE", 2), self.assertNumQueries(
+            2
+        ):
+            found = find_stored_fingerprints([*fingerprints, 1, 2])
+        self.assertEqual(found, set(fingerprints))
+
+    def test_backfill_fingerprints(self):
+        save_records("a" * 64, "a.pdf", [_record(), _record(date="20230620")])
+        document = save_records("b" * 64, "b.pdf", [_record(date="20230621")])
+        expected = dict(models.EtcRecord.objects.values_list("id", "fingerprint"))
+        # 指紋の列を追加する前に保存したレコード（重複した利用も保存されている）
+        models.EtcRecord.objects.update(fingerprint=None)
+        duplicate = models.EtcRecord.objects.filter(usage_date="2023-06-19").get()
+        duplicate.pk = None
+        duplicate.document = document
+        duplicate.save()
+
+        self.assertEqual(backfill_fingerprints(), (3, 1))
+        self.assertEqual(
+            dict(
+                models.EtcRecord.objects.exclude(fingerprint=None).values_list(
+                    "id", "fingerprint"
+                )
+            ),
+            expected,
+        )
+        self.assertIsNone(models.EtcRecord.objects.get(pk=duplicate.pk).fingerprint)
+        self.assertEqual(backfill_fingerprints(), (0, 1))
+
+
+class LayoutTests(SimpleTestCase):
+    def test_classify_text(self):
+        self.assertEqual(
+            classify_text("利用日 入口IC 出口IC 車両番号 カード番号 通行料金"),
+            get_layout("per_column"),
+        )
+        self.assertIsNone(classify_text("請求書"))
+
+    def test_per_column_line(self):
+        record = get_layout("per_column").parse_line(
+            "|2023/04/01|7:32|今井|8:05|狩場|普通車|品川300あ1234|****1234|(1,230)|1,100|"
+        )
+        self.assertEqual(record.date, "20230401")
+        self.assertEqual(record.entry_time, "07:32")
+        self.assertEqual(record.card_number, "****1234")
+        self.assertEqual((record.original_fee, record.final_fee), ("1,230", "1,100"))
+
+    def test_classify_document(self):
+        import pymupdf
+
+        with extraction.open_document(rows_to_pdf(generate_rows(3))) as doc:
+            self.assertEqual(classify_document(doc), get_layout("etc_meisai"))
+        with pymupdf.open() as doc:
+            doc.new_page()
+            self.assertIs(classify_document(doc), DEFAULT_LAYOUT)
+
+
+class PageIsolationTests(SimpleTestCase):
+    """抽出に失敗したページだけを除き、次の変換でそのページだけを変換し直す"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pdf = rows_to_pdf(generate_rows(75))
+
+    def setUp(self):
+        self.calls = []
+        self.failing = set()
+        to_markdown = extraction.to_markdown
+
+        def flaky_to_markdown(doc, pages=None, **kwargs):
+            self.calls.append(list(pages))
+            if self.failing & set(pages):
+                raise RuntimeError("broken page")
+            return to_markdown(doc, pages=pages, **kwargs)
+
+        def failing_ocr(doc, pages, errors=None):
+            errors.update((page, RuntimeError("no OCR")) for page in pages)
+            return {}
+
+        result_cache = ResultCache(DjangoCacheBackend())
+        for target, value in (
+            ("pdfupload.extraction.to_markdown", flaky_to_markdown),
+            ("pdfupload.pipeline.ocr_document_tables", failing_ocr),
+            ("pdfupload.pipeline.get_result_cache", lambda: result_cache),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def convert(self, digest):
+        report = pipeline.ConversionReport()
+        return pipeline.convert_to_records(self.pdf, digest, report), report
+
+    def test_failed_page_is_isolated(self):
+        self.failing.add(1)
+        records, report = self.convert("isolated")
+        self.assertEqual(len(records), 50)
+        self.assertEqual(report.failed_pages, [2])
+        # 失敗したwindowを1ページずつ変換し直す
+        self.assertEqual(self.calls, [[0, 1, 2], [0], [1], [2]])
+
+    def test_retry_converts_only_failed_pages(self):
+        self.failing.add(1)
+        self.convert("retry")
+        self.failing.clear()
+        self.calls.clear()
+        records, report = self.convert("retry")
+        self.assertEqual(self.calls, [[1]])
+        self.assertEqual(report.reused_pages, [1, 3])
+        self.assertTrue(report.complete)
+        self.assertEqual(len(records), 75)
+
+    def test_stream_reports_failed_page(self):
+        self.failing.add(2)
+        report = pipeline.ConversionReport()
+        pages = [
+            (page_number, None if records is None else len(records))
+            for page_number, records in pipeline.iter_records_by_page(
+                self.pdf, "stream", report
+            )
+        ]
+        self.assertEqual(pages, [(1, 25), (2, 25), (3, None)])
+        self.assertEqual(report.failed_pages, [3])
+
+
+class RecordEndpointTests(TestCase):
+    def setUp(self):
+        save_records("a" * 64, "a.pdf", [_record(), _record(date="20230720")])
+
+    def test_list_filters_by_date(self):
+        response = self.client.get(
+            "/api/records/", {"date_from": "2023-07-01", "date_to": "2023-07-31"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row["usage_date"] for row in response.json()["records"]], ["2023-07-20"]
+        )
+
+    def test_list_filters_by_month(self):
+        response = self.client.get("/api/records/", {"month": "2023-06"})
+        self.assertEqual(len(response.json()["records"]), 1)
+
+    def test_list_paging(self):
+        response = self.client.get("/api/records/", {"limit": 1, "offset": 1})
+        self.assertEqual(len(response.json()["records"]), 1)
+
+    def test_bad_parameters(self):
+        for params, name in (
+            ({"date_from": "xx"}, "date_from"),
+            ({"date_to": "2023-13-01"}, "date_to"),
+            ({"month": "2023"}, "month"),
+            ({"limit": "-1"}, "limit"),
+            ({"offset": "x"}, "offset"),
+        ):
+            with self.subTest(params=params):
+                response = self.client.get("/api/records/", params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(name, response.json()["error"])
+
+    def test_summary(self):
+        response = self.client.get(
+            "/api/records/summary/", {"group_by": "month", "date_from": "2023-07-01"}
+        )
+        self.assertEqual(response.status_code, 200)
+        summary = response.json()["summary"]
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]["final_fee_total"], 680)
+
+    def test_summary_bad_parameters(self):
+        response = self.client.get("/api/records/summary/", {"date_to": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("date_to", response.json()["error"])
+        response = self.client.get("/api/records/summary/", {"group_by": "fee"})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(PERSIST_RECORDS=False)
+class MetricsEndpointTests(InlineConversionMixin, TestCase):
+    def counter(self, name, view="upload"):
+        prefix = f'pdfupload_{name}_total{{view="{view}"}} '
+        for line in self.client.get("/api/metrics/").content.decode().splitlines():
+            if line.startswith(prefix):
+                return int(line[len(prefix) :])
+        return 0
+
+    def test_repeated_upload_counts_cache_hit(self):
+        pdf = rows_to_pdf(generate_rows(5))
+        hits = self.counter("cache_hits")
+        self.assertEqual(self.upload(pdf=pdf).status_code, 200)
+        self.assertEqual(self.counter("cache_hits"), hits)
+        self.assertEqual(self.upload(pdf=pdf).status_code, 200)
+        self.assertEqual(self.counter("cache_hits"), hits + 1)
+
+    def test_metrics_format(self):
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(
+            "# TYPE pdfupload_requests_total counter", response.content.decode()
+        )
+
+
+@override_settings(PERSIST_RECORDS=False)
+class UploadEndpointTests(InlineConversionMixin, TestCase):
+    def test_markdown(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Parsed-Rows"], "30")
+        lines = response.json()["markdown"].splitlines()
+        self.assertEqual(len([line for line in lines if "********" in line]), 30)
+
+    def test_json(self):
+        rows = generate_rows(12)
+        response = self.upload(pdf=rows_to_pdf(rows), format="json")
+        self.assertEqual(response.status_code, 200)
+        records = response.json()["records"]
+        self.assertEqual(len(records), 12)
+        self.assertEqual(records[0]["カード番号"], rows[0][3].split()[-1])
+
+    def test_excel(self):
+        response = self.upload(format="excel")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("spreadsheetml", response["Content-Type"])
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"PK"))
+
+    def test_errors(self):
+        with self.assertLogs("pdfupload.views", "ERROR"):
+            response = self.client.post("/api/upload/", {"format": "json"})
+        self.assertEqual(response.status_code, 400)
+        response = self.upload(format="docx")
+        self.assertEqual(response.status_code, 400)
+        with self.assertLogs("pdfupload.views", "ERROR"):
+            response = self.upload(pdf=b"not a pdf")
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("error", response.json())
+
+
+class ExporterTests(SimpleTestCase):
+    records = [_record(), _record(card_number="********99990000", fee="x")]
+
+    def test_csv(self):
+        response = exporters.csv_response(self.records)
+        rows = list(
+            csv.reader(b"".join(response.streaming_content).decode().splitlines())
+        )
+        self.assertEqual(rows[0], list(exporters.EXPORT_COLUMNS))
+        self.assertEqual(len(rows), 3)
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual(row["date"], "2023-06-19")
+        self.assertEqual(row["discount"], "60")
+        self.assertEqual(dict(zip(rows[0], rows[2]))["final_fee"], "")
+
+    def test_ndjson(self):
+        response = exporters.ndjson_response(self.records)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]["entry_at"], "2023-06-19T06:32:00")
+        self.assertEqual(
+            rows[0]["entry_ic_code"], get_interchanges().lookup("今井").code
+        )
+        self.assertIsNone(rows[1]["final_fee"])
+
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+
+        response = exporters.parquet_response(self.records)
+        table = pq.read_table(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(table.column_names, list(exporters.EXPORT_COLUMNS))
+        self.assertEqual(table.column("final_fee").to_pylist(), [680, None])
+        self.assertEqual(
+            table.column("date").to_pylist()[0], datetime.date(2023, 6, 19)
+        )
+
+    def test_excel(self):
+        import openpyxl
+
+        response = exporters.excel_response(
+            [(exporters.EXCEL_SHEET_NAME, self.records)],
+            summary_tables(summarize(self.records)),
+        )
+        workbook = openpyxl.load_workbook(
+            io.BytesIO(b"".join(response.streaming_content))
+        )
+        self.assertEqual(workbook.sheetnames[0], exporters.EXCEL_SHEET_NAME)
+        sheet = workbook[exporters.EXCEL_SHEET_NAME]
+        self.assertEqual(sheet.max_row, 3)
+        self.assertEqual(len(workbook.sheetnames), 3)
+
+
+@override_settings(PERSIST_RECORDS=False)
+class ExportEndpointTests(InlineConversionMixin, TestCase):
+    def test_export_formats(self):
+        pdf = rows_to_pdf(generate_rows(8))
+        for output_format, content_type in (
+            ("csv", "text/csv"),
+            ("ndjson", "application/x-ndjson"),
+            ("parquet", "application/vnd.apache.parquet"),
+        ):
+            with self.subTest(format=output_format):
+                response = self.upload(pdf=pdf, format=output_format)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response["Content-Type"].startswith(content_type))
+                self.assertIn("attachment", response["Content-Disposition"])
+                self.assertEqual(response["X-Parsed-Rows"], "8")
+
+
+class MemoryGuardTests(SimpleTestCase):
+    def rss(self, *values):
+        return mock.patch("pdfupload.memory.current_rss", side_effect=values)
+
+    def test_limit_exceeded(self):
+        with self.rss(100 << 20, 100 << 20, 200 << 20, 200 << 20), mock.patch(
+            "pdfupload.memory.release_document_memory"
+        ) as release:
+            guard = MemoryGuard(limit_mb=50)
+            with self.assertRaises(MemoryLimitExceeded):
+                guard.check()
+        release.assert_called_once()
+
+    def test_released_memory_is_not_counted(self):
+        with self.rss(100 << 20, 100 << 20, 200 << 20, 120 << 20), mock.patch(
+            "pdfupload.memory.release_document_memory"
+        ):
+            MemoryGuard(limit_mb=50).check()
+
+    def test_overlapping_guards_are_not_measured(self):
+        with self.rss(100 << 20, 100 << 20, 500 << 20):
+            first = MemoryGuard(limit_mb=50)
+            second = MemoryGuard(limit_mb=50)
+            self.assertEqual(first.used(), 0)
+            self.assertEqual(second.used(), 0)
+
+    def test_disabled_without_rss(self):
+        with self.rss(None):
+            guard = MemoryGuard(limit_mb=50)
+        self.assertEqual(guard.limit, 0)
+        guard.check()
+
+    def test_windowed_extraction_checks_each_window(self):
+        pdf = rows_to_pdf(generate_rows(120))
+        guard = mock.Mock()
+        pages = [
+            page
+            for page, _ in extraction.iter_window_markdown(pdf, window=1, guard=guard)
+        ]
+        self.assertGreater(len(pages), 1)
+        self.assertEqual(pages, list(range(1, len(pages) + 1)))
+        self.assertEqual(guard.check.call_count, len(pages))
+
+
+@override_settings(PERSIST_RECORDS=False, PDF_MEMORY_LIMIT_MB=1)
+class MemoryLimitEndpointTests(InlineConversionMixin, TestCase):
+    def test_memory_limit_returns_413(self):
+        rss = itertools.count(0, 64 << 20)
+        with mock.patch("pdfupload.memory.current_rss", lambda: next(rss)):
+            response = self.upload()
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("error", response.json())
+
+
+@override_settings(PERSIST_RECORDS=False)
+class AsyncConvertEndpointTests(InlineConversionMixin, TestCase):
+    async def test_convert(self):
+        read_request = views.AsyncConvertView.read_request
+
+        def read_outside_loop(request):
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return read_request(request)
+
+        pdf = SimpleUploadedFile(
+            "statement.pdf", rows_to_pdf(generate_rows(6)), "application/pdf"
+        )
+        with mock.patch.object(
+            views.AsyncConvertView, "read_request", staticmethod(read_outside_loop)
+        ):
+            response = await self.async_client.post(
+                "/api/async/convert/", {"file": pdf, "format": "json"}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["records"]), 6)
+        self.assertEqual(response["X-Parsed-Rows"], "6")
+
+    async def test_errors(self):
+        with self.assertLogs("pdfupload.views", "ERROR"):
+            response = await self.async_client.post("/api/async/convert/", {})
+        self.assertEqual(response.status_code, 400)
+        for data in ({"kind": "docx"}, {"format": "docx"}):
+            with self.subTest(**data):
+                pdf = SimpleUploadedFile("statement.pdf", b"%PDF-", "application/pdf")
+                response = await self.async_client.post(
+                    "/api/async/convert/", {"file": pdf, **data}
+                )
+                self.assertEqual(response.status_code, 400)
+
+
+class UploadSizeLimitTests(TestCase):
+    @override_settings(MAX_UPLOAD_BYTES=1024)
+    def test_content_length_over_limit(self):
+        pdf = SimpleUploadedFile("statement.pdf", b"0" * 2048, "application/pdf")
+        response = self.client.post("/api/upload/", {"file": pdf})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("error", response.json())
+
+    @override_settings(MAX_UPLOAD_BYTES=1024)
+    async def test_chunked_body_over_limit(self):
+        async def app(scope, receive, send):
+            while (await receive()).get("more_body"):
+                pass
+            self.fail("the body should have been cut off")
+
+        chunks = [
+            {"type": "http.request", "body": b"0" * 512, "more_body": True}
+            for _ in range(4)
+        ]
+        sent = []
+
+        async def receive():
+            return chunks.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await limit_request_body(app)({"type": "http"}, receive, send)
+        self.assertEqual(sent[0]["status"], 413)
+        self.assertEqual(len(chunks), 1)
+
+
+@override_settings(PERSIST_RECORDS=False)
+class BatchEndpointTests(InlineConversionMixin, TestCase):
+    def post(self, *files):
+        return self.client.post(
+            "/api/batch/",
+            {"files": [SimpleUploadedFile(name, data) for name, data in files]},
+        )
+
+    def test_duplicate_rows_are_merged(self):
+        rows = generate_rows(10)
+        response = self.post(
+            ("a.pdf", rows_to_pdf(rows[:6])), ("b.pdf", rows_to_pdf(rows[4:]))
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Converted-Files"], "2")
+        self.assertEqual(response["X-Parsed-Rows"], "12")
+        self.assertNotIn("X-Failed-Files", response)
+
+    def test_corrupt_files_are_reported(self):
+        good = rows_to_pdf(generate_rows(5))
+        corrupt = rows_to_pdf(generate_rows(3))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            archive.writestr("good.pdf", good)
+            archive.writestr("corrupt.pdf", corrupt)
+        data = bytearray(buffer.getvalue())
+        # 格納したままのデータを書き換えて、CRCが合わないようにする
+        offset = data.index(corrupt) + len(corrupt) // 2
+        data[offset] ^= 0xFF
+        with self.assertLogs("pdfupload.views", "WARNING"):
+            response = self.post(
+                ("statements.zip", bytes(data)), ("broken.pdf", b"%PDF-1.7 broken")
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Converted-Files"], "1")
+        self.assertEqual(response["X-Parsed-Rows"], "5")
+        self.assertEqual(
+            response["X-Failed-Files"], "statements.zip/corrupt.pdf,broken.pdf"
+        )
+
+    def test_no_convertible_files(self):
+        with self.assertLogs("pdfupload.views", "WARNING"):
+            response = self.post(("broken.pdf", b"%PDF-1.7 broken"))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["failed_files"][0]["name"], "broken.pdf")
+
+    def test_no_files(self):
+        with self.assertLogs("pdfupload.views", "ERROR"):
+            response = self.client.post("/api/batch/", {})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(PERSIST_RECORDS=False, PDF_PAGE_WINDOW=2)
+class StreamEndpointTests(InlineConversionMixin, TestCase):
+    pdf = rows_to_pdf(generate_rows(120))
+
+    def stream(self, output_format):
+        response = self.upload(pdf=self.pdf, format=output_format)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_markdown_stream(self):
+        body = self.stream("markdown-stream")
+        self.assertEqual(body.count("********"), 120)
+        self.assertIn('<!-- etc-stream: done {"rows": 120', body)
+
+    def test_first_window_is_converted_page_by_page(self):
+        with mock.patch(
+            "pdfupload.offload.convert_page_range",
+            side_effect=pipeline.convert_page_range,
+        ) as convert:
+            events = [
+                json.loads(line) for line in self.stream("ndjson-stream").splitlines()
+            ]
+        self.assertEqual(
+            [call.args[2] for call in convert.call_args_list], [[0], [1], [2, 3], [4]]
+        )
+        self.assertEqual(events[0]["event"], "header")
+        self.assertEqual([event["page"] for event in events[1:-1]], [1, 2, 3, 4, 5])
+        self.assertEqual(events[-1]["event"], "done")
+        self.assertEqual(events[-1]["rows"], 120)
+
+    def test_error_trailer_is_counted_as_failure(self):
+        def failed_requests():
+            prefix = 'pdfupload_requests_total{view="upload-stream",code="500"} '
+            for line in self.client.get("/api/metrics/").content.decode().splitlines():
+                if line.startswith(prefix):
+                    return int(line[len(prefix) :])
+            return 0
+
+        before = failed_requests()
+        with mock.patch(
+            "pdfupload.offload.convert_page_range", side_effect=RuntimeError("boom")
+        ), self.assertLogs("pdfupload.streaming", "ERROR"):
+            body = self.stream("markdown-stream")
+        self.assertIn('<!-- etc-stream: error {"error": "boom"', body)
+        self.assertEqual(failed_requests(), before + 1)
+
+
+class _InlineJobExecutor:
+    """ジョブをその場で実行する（jobs.get_executorの代わり）"""
+
+    def submit(self, func, *args):
+        func(*args)
+
+
+@override_settings(PERSIST_RECORDS=False)
+class JobEndpointTests(InlineConversionMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("pdfupload.jobs.get_executor", _InlineJobExecutor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def submit(self, **data):
+        pdf = SimpleUploadedFile("statement.pdf", rows_to_pdf(generate_rows(9)))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/jobs/", {"file": pdf, **data})
+        return response
+
+    def test_job_lifecycle(self):
+        for kind in ("upload", "hybrid"):
+            with self.subTest(kind=kind):
+                response = self.submit(kind=kind)
+                self.assertEqual(response.status_code, 202)
+                url = f"/api/jobs/{response.json()['id']}/"
+                job = self.client.get(url).json()
+                self.assertEqual((job["kind"], job["status"]), (kind, "done"))
+                response = self.client.get(url + "result/", {"format": "json"})
+                self.assertEqual(len(response.json()["records"]), 9)
+
+    def test_errors(self):
+        self.assertEqual(self.submit(kind="docx").status_code, 400)
+        with self.assertLogs("pdfupload.views", "ERROR"):
+            response = self.client.post("/api/jobs/", {})
+        self.assertEqual(response.status_code, 400)
+        job = models.ConversionJob.objects.create(kind="ocr-table", file_sha256="0")
+        response = self.client.get(f"/api/jobs/{job.id}/result/")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["status"], "queued")
+
+    def test_finishing_keeps_heartbeat(self):
+        models.ConversionJob.objects.create(
+            kind="upload", file_sha256="0", file_data=rows_to_pdf(generate_rows(3))
+        )
+        job = jobs.claim_next_job()
+        heartbeat = job.heartbeat_at + datetime.timedelta(minutes=1)
+        models.ConversionJob.objects.filter(pk=job.pk).update(heartbeat_at=heartbeat)
+        jobs.process_job(job)
+        job = models.ConversionJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.heartbeat_at, heartbeat)
+        self.assertEqual(bytes(job.file_data), b"")
+
+
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch("pdfupload.cache._result_cache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disk_backend(self):
+        cache = ResultCache(DiskCacheBackend(self.directory, 1024 * 1024))
+        key = cache.make_key("upload", "abc", "1")
+        self.assertIsNone(cache.get(key))
+        cache.set(key, [_record()])
+        self.assertEqual(cache.get(key), [_record()])
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_disk_backend_evicts_least_recently_used(self):
+        backend = DiskCacheBackend(self.directory, 3500)
+        for i, key in enumerate(("a", "b", "c")):
+            backend.set(key, b"0" * 1000)
+            os.utime(backend._path(key), (i, i))
+        backend.get("a")
+        backend.set("d", b"0" * 1000)
+        self.assertEqual(
+            [key for key in "abcd" if backend.get(key) is not None], ["a", "c", "d"]
+        )
+
+    def test_unreadable_entry_is_a_miss(self):
+        backend = DiskCacheBackend(self.directory, 1024)
+        with open(backend._path("broken"), "wb") as f:
+            f.write(b"not a pickle")
+        with self.assertLogs("pdfupload.cache", "WARNING"):
+            self.assertIsNone(backend.get("broken"))
+
+    def test_process_local_django_cache_falls_back_to_disk(self):
+        with self.settings(
+            PDF_CACHE_BACKEND="django", PDF_CACHE_DIR=self.directory
+        ), self.assertLogs("pdfupload.cache", "WARNING"):
+            cache = get_result_cache()
+        self.assertIsInstance(cache.backend, DiskCacheBackend)
+
+    def test_shared_django_cache(self):
+        caches = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": self.directory,
+            }
+        }
+        with self.settings(CACHES=caches, PDF_CACHE_BACKEND="django"):
+            cache = get_result_cache()
+        self.assertIsInstance(cache.backend, DjangoCacheBackend)
+        self.assertFalse(cache.backend.process_local)
+
+    def test_disabled_by_default(self):
+        with self.settings(PDF_CACHE_BACKEND=""):
+            cache = get_result_cache()
+        cache.set("key", [_record()])
+        self.assertIsNone(cache.get("key"))
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import mmap
+import tempfile
+from contextlib import contextmanager
+
+from .cache import save_upload
+from .metrics import stage
+
+
+@contextmanager
+def _mapped_file(path):
+    """ファイルを読み取り専用でmmapし、memoryviewとして返す"""
+    with open(path, "rb") as f:
+        # 空のファイルはmmapできない
+        if not f.seek(0, io.SEEK_END):
+            yield memoryview(b"")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+@contextmanager
+def _upload_view(file_obj):
+    if hasattr(file_obj, "temporary_file_path"):
+        # 大きいアップロードはDjangoが書き出した一時ファイルをそのまま参照する
+        with _mapped_file(file_obj.temporary_file_path()) as view:
+            yield view
+        return
+
+    buffer = getattr(file_obj, "file", None)
+    if isinstance(buffer, io.BytesIO):
+        # メモリ上のアップロードはそのバッファを参照する
+        view = buffer.getbuffer()
+        try:
+            yield view
+        finally:
+            view.release()
+        return
+
+    # zipの中のPDFなど
+    yield memoryview(b"".join(file_obj.chunks()))
+
+
+@contextmanager
+def upload_buffer(file_obj):
+    """アップロードされたPDFをコピーせずに (memoryview, SHA-256) として返す
+
+    memoryviewはwithブロックの中でだけ有効。
+    """
+    with _upload_view(file_obj) as view:
+        with stage("hash"):
+            digest = hashlib.sha256(view).hexdigest()
+        yield view, digest
+
+
+@contextmanager
+def upload_path(file_obj):
+    """OCRなどファイルのパスが必要な処理のために (パス, SHA-256) を返す
+
+    Djangoが一時ファイルに書き出したアップロードはそのパスを使い、
+    メモリ上のアップロードだけ一時ファイルに書き出す（withを抜けると削除する）。
+    """
+    if hasattr(file_obj, "temporary_file_path"):
+        with upload_buffer(file_obj) as (_, digest):
+            pass
+        yield file_obj.temporary_file_path(), digest
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as temp_pdf:
+        with stage("spool"):
+            digest = save_upload(file_obj, temp_pdf)
+        yield temp_pdf.name, digest
+
+
+def upload_source(file_obj):
+    """別プロセスに渡せる形で (パスまたはbytes, SHA-256) を返す
+
+    Djangoが一時ファイルに書き出したアップロードはパスを渡し、
+    メモリ上のアップロードだけbytesにコピーする。
+    """
+    with upload_buffer(file_obj) as (view, digest):
+        if hasattr(file_obj, "temporary_file_path"):
+            return file_obj.temporary_file_path(), digest
+        return bytes(view), digest
@@ -1,8 +1,38 @@
 from django.urls import path
 from .views import UploadPDFView
 from .views import TestPDFView
+from .views import (
+    AsyncConvertView,
+    BatchUploadView,
+    ConversionJobDetailView,
+    ConversionJobListView,
+    ConversionJobResultView,
+    HybridPDFView,
+    MetricsView,
+    RecordListView,
+    RecordSummaryView,
+    SummaryView,
+)
 
 urlpatterns = [
     path("upload/", UploadPDFView.as_view(), name="upload_pdf"),
     path("test/", TestPDFView.as_view(), name="test_pdf"),
+    path("convert/", HybridPDFView.as_view(), name="convert_pdf"),
+    path("async/convert/", AsyncConvertView.as_view(), name="async_convert"),
+    path("batch/", BatchUploadView.as_view(), name="batch_upload"),
+    path("summary/", SummaryView.as_view(), name="summary"),
+    path("jobs/", ConversionJobListView.as_view(), name="conversion_jobs"),
+    path(
+        "jobs/<uuid:job_id>/",
+        ConversionJobDetailView.as_view(),
+        name="conversion_job_detail",
+    ),
+    path(
+        "jobs/<uuid:job_id>/result/",
+        ConversionJobResultView.as_view(),
+        name="conversion_job_result",
+    ),
+    path("records/", RecordListView.as_view(), name="records"),
+    path("records/summary/", RecordSummaryView.as_view(), name="records_summary"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
 ]
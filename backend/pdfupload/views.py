@@ -1,25 +1,183 @@
 import tempfile
+from urllib.parse import quote
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework import status
-from django.shortcuts import render
-import pymupdf4llm
-import pytesseract
-from pdf2image import convert_from_path
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 import logging
-import os
-from markdownify import markdownify as md
-import pandas as pd
-from django.http import HttpResponse
-import io
+from django.conf import settings
 from rest_framework.renderers import JSONRenderer
+from .batch import (
+    BatchError,
+    BatchReport,
+    merge_records,
+    spool_batch,
+    split_by_card,
+)
+from .exporters import EXCEL_SHEET_NAME, EXPORT_RESPONSES, excel_response
+from .jobs import QueueFullError, job_records, submit_job
+from .memory import MemoryLimitExceeded
+from .metrics import (
+    PROMETHEUS_CONTENT_TYPE,
+    StageTimer,
+    count,
+    render_metrics,
+    stage,
+)
+from .models import ConversionJob
+from .offload import (
+    CONVERTERS,
+    MARKDOWN_KINDS,
+    ConversionBusyError,
+    convert_in_pool,
+    convert_many_in_pool,
+    run_conversion,
+    sync_conversion_slot,
+)
+from .parser import output_headers, to_markdown
+from .store import (
+    SUMMARY_GROUPS,
+    filter_records,
+    save_records_safely,
+    summarize_records,
+)
+from .streaming import STREAM_RESPONSES
+from .summary import summarize, summary_json, summary_tables
+from .uploads import upload_source
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.DEBUG, format="%(asctime)s [%(levelname)s] %(message)s"
-)
+
+
+def finish_timer(timer, response):
+    """計測結果を集計し、設定で有効ならServer-Timingヘッダーを付ける
+
+    保存済みの明細と重複して保存しなかった行があれば、その数をX-Duplicate-Rowsで返す。
+    """
+    duplicates = timer.counts.get("duplicate_rows")
+    if duplicates:
+        response["X-Duplicate-Rows"] = str(duplicates)
+        expose_headers(response, "X-Duplicate-Rows")
+    return timer.finish(response, getattr(settings, "SERVER_TIMING", False))
+
+
+def expose_headers(response, *names):
+    """ブラウザのJavaScriptから読めるヘッダーに加える"""
+    exposed = response.get("Access-Control-Expose-Headers")
+    response["Access-Control-Expose-Headers"] = ", ".join(
+        filter(None, (exposed, *names))
+    )
+
+
+def add_report_headers(response, report):
+    """ConversionReportの行数とページ番号（カンマ区切り）をヘッダーで返す
+
+    X-Failed-Pagesのページは変換できず、結果に含まれていない。同じPDFをもう一度
+    送ると、前回変換できたページは変換し直さずに、そのページだけを変換する。
+    """
+    headers = {
+        "X-Parsed-Rows": report.parsed_rows,
+        "X-Skipped-Rows": report.skipped_rows,
+        "X-Failed-Rows": report.failed_rows,
+    }
+    for name, pages in (
+        ("X-Failed-Pages", report.failed_pages),
+        ("X-Recovered-Pages", report.recovered_pages),
+        ("X-Row-Error-Pages", report.row_error_pages),
+    ):
+        if pages:
+            headers[name] = ",".join(map(str, pages))
+    for name, value in headers.items():
+        response[name] = str(value)
+    expose_headers(response, *headers)
+    return response
+
+
+def add_summary_headers(response, summaries):
+    """集計に含めなかった行数をヘッダーで返す
+
+    X-Undated-Rowsは利用年月日が読めず集計に含めなかった行、X-Unpriced-Rowsは
+    利用回数には数えたが、金額が読めず金額の合計に含めなかった行。
+    """
+    headers = {
+        "X-Undated-Rows": summaries["undated_rows"],
+        "X-Unpriced-Rows": summaries["unpriced_rows"],
+    }
+    for name, value in headers.items():
+        response[name] = str(value)
+    expose_headers(response, *headers)
+    return response
+
+
+def add_batch_report_headers(response, report):
+    """BatchReportのファイル数・行数と、変換できなかったファイルの名前をヘッダーで返す
+
+    X-Failed-Filesのファイルは結果に含まれていない。名前はURLエンコードしてカンマ区切りにする。
+    """
+    headers = {
+        "X-Converted-Files": report.converted_files,
+        "X-Parsed-Rows": report.parsed_rows,
+        "X-Skipped-Rows": report.skipped_rows,
+        "X-Failed-Rows": report.failed_rows,
+    }
+    if report.failed_files:
+        headers["X-Failed-Files"] = ",".join(
+            quote(name, safe="/") for name, _ in report.failed_files
+        )
+    for name, value in headers.items():
+        response[name] = str(value)
+    expose_headers(response, *headers)
+    return response
+
+
+def busy_response(error):
+    """同時に実行できる変換の数を超えたときの503レスポンス"""
+    response = JsonResponse(
+        {"error": str(error)}, status=503, json_dumps_params={"ensure_ascii": False}
+    )
+    response["Retry-After"] = "10"
+    return add_cors_headers(response, "POST, OPTIONS")
+
+
+def memory_limit_response(error, methods="POST, OPTIONS"):
+    """変換に必要なメモリがPDF_MEMORY_LIMIT_MBを超えたときの413レスポンス"""
+    response = JsonResponse(
+        {"error": str(error)}, status=413, json_dumps_params={"ensure_ascii": False}
+    )
+    return add_cors_headers(response, methods)
+
+
+def run_view(view_name, convert, request):
+    """変換の数を制限し、処理時間を計測してconvert(request)を実行する"""
+    try:
+        with sync_conversion_slot(), StageTimer(view_name) as timer:
+            response = convert(request)
+    except ConversionBusyError as e:
+        return busy_response(e)
+    return finish_timer(timer, response)
+
+
+def convert_uploaded_file(file_obj, kind="upload"):
+    """アップロードされたPDFからレコードを抽出し、DBにも保存する
+
+    抽出はプロセスプール（offload）で実行し、リクエストのスレッドを塞がない。
+    (レコード, ConversionReport) を返す。変換できなかったページがあっても
+    残りのページのレコードを返し、ConversionReportに記録する。
+    """
+    # 大きいアップロードはDjangoが書き出した一時ファイルのパスを渡す
+    source, digest = upload_source(file_obj)
+    # PDFからレコードを抽出（同じ内容のPDFはキャッシュを使う）
+    records, report = convert_in_pool(kind, source, digest)
+
+    with stage("persist"):
+        save_records_safely(digest, file_obj.name, records, report.failed_pages)
+    return records, report
 
 
 # パターンB
@@ -37,6 +195,29 @@ class UploadPDFView(APIView):
         return response
 
     def post(self, request, *args, **kwargs):
+        if request.data.get("format") in STREAM_RESPONSES:
+            # ストリームは送り終えるまで変換の枠を使うので、run_viewの外で返す
+            return self.stream(request)
+        return run_view("upload", self.convert, request)
+
+    def stream(self, request):
+        """抽出の進み具合に合わせてページごとに返す"""
+        file_obj = request.FILES.get("file")
+        if not file_obj:
+            logger.error("No file uploaded")
+            return add_cors_headers(
+                Response(
+                    {"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST
+                ),
+                "POST, OPTIONS",
+            )
+        try:
+            response = STREAM_RESPONSES[request.data["format"]](request, file_obj)
+        except ConversionBusyError as e:
+            return busy_response(e)
+        return add_cors_headers(response, "POST, OPTIONS")
+
+    def convert(self, request):
         try:
             file_obj = request.FILES.get("file")
             output_format = request.data.get(
@@ -49,186 +230,36 @@ class UploadPDFView(APIView):
                     {"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST
                 )
 
-            logger.debug(f"Request headers: {request.headers}")
-            logger.debug(f"Output format: {output_format}")
-
-            markdown_text = ""
-            formatted_data = []  # エクセル出力用のデータを保存
-
-            # 一時ファイルとして保存して処理
-            with tempfile.NamedTemporaryFile(delete=True) as temp_pdf:
-                logger.debug("Saving uploaded file to temporary location")
-                for chunk in file_obj.chunks():
-                    temp_pdf.write(chunk)
-                temp_pdf.flush()
-                logger.debug(f"Temporary file created at {temp_pdf.name}")
-
-                # PDFからテキストを抽出
-                raw_text = pymupdf4llm.to_markdown(temp_pdf.name)
-
-                # テキストを解析して新しい形式に変換
-                lines = raw_text.split("\n")
-                formatted_lines = []
-
-                # 新しいヘッダーを追加
-                headers = [
-                    "カード番号",
-                    "利用月",
-                    "利用年月日",
-                    "車種",
-                    "車両番号",
-                    "入口IC",
-                    "出口IC",
-                    "割引前の金額",
-                    "割引後の金額",
-                ]
-                formatted_lines.append("| " + " | ".join(headers) + " |")
-                formatted_lines.append("|" + "---|" * len(headers))
-
-                # データ行を処理
-                for line in lines:
-                    if (
-                        "|" in line
-                        and not line.startswith("|---")
-                        and not "利用年月日" in line
-                    ):
-                        parts = line.strip().split("|")
-                        if len(parts) >= 5:
-                            try:
-                                # 日付とIC情報を分解
-                                date_ic_info = parts[1].strip().split()
-                                if len(date_ic_info) >= 5:
-                                    # 日付を20240902形式に変換
-                                    date_parts = date_ic_info[0].split(
-                                        "/"
-                                    )  # 23/04/01 を分割
-                                    year = f"20{date_parts[0]}"  # 23 → 2023
-                                    month = date_parts[1].zfill(2)  # 4 → 04
-                                    day = date_parts[2].zfill(2)  # 1 → 01
-                                    formatted_date = f"{year}{month}{day}"
-                                    month_number = str(int(date_parts[1]))  # 04 → 4
-
-                                    # ICの情報を抽出
-                                    # 時刻とIC情報を分離
-                                    ic_info = []
-                                    for i, x in enumerate(date_ic_info):
-                                        # 時刻（HH:MM形式）や日付（YY/MM/DD形式）は除外
-                                        if not ":" in x and not "/" in x:
-                                            # 数字のみの場合は時刻の一部として除外
-                                            if not x.replace(" ", "").isdigit():
-                                                ic_info.append(x)
-
-                                    # ICの情報を処理
-                                    if len(ic_info) == 1:
-                                        # ICが1つの場合は出口ICとして扱う
-                                        entry_ic = ""
-                                        exit_ic = ic_info[0]
-                                    elif len(ic_info) >= 2:
-                                        # ICが2つ以上の場合は、最初のICを入口、最後のICを出口として扱う
-                                        entry_ic = ic_info[0]
-                                        exit_ic = ic_info[-1]
-                                    else:
-                                        entry_ic = ""
-                                        exit_ic = ""
-
-                                    # 自)や至)が含まれている場合は除去
-                                    entry_ic = entry_ic.replace("自)", "").strip()
-                                    exit_ic = exit_ic.replace("至)", "").strip()
-
-                                # 料金情報を分解
-                                fee_info = parts[2].strip().split()
-                                # カンマを含む金額を正しく処理
-                                if fee_info:
-                                    # 割引前料金の処理
-                                    # カンマで分割されている場合は結合
-                                    if len(fee_info) >= 2 and fee_info[0].endswith(","):
-                                        original_fee = (
-                                            fee_info[0].rstrip(",") + "," + fee_info[1]
-                                        )
-                                    else:
-                                        original_fee = fee_info[0]
-                                    original_fee = original_fee.replace(
-                                        "(", ""
-                                    ).replace(")", "")
-
-                                    # 割引後料金の処理
-                                    # 最後の2つの数字がカンマで分割されている場合は結合
-                                    if len(fee_info) >= 2 and fee_info[-2].endswith(
-                                        ","
-                                    ):
-                                        final_fee = (
-                                            fee_info[-2].rstrip(",")
-                                            + ","
-                                            + fee_info[-1]
-                                        )
-                                    else:
-                                        final_fee = fee_info[-1]
-                                else:
-                                    original_fee = ""
-                                    final_fee = ""
-
-                                # 車両情報を分解
-                                vehicle_info = parts[4].strip().split()
-                                if len(vehicle_info) >= 3:
-                                    vehicle_type = vehicle_info[0]
-                                    vehicle_number = vehicle_info[1]
-                                    card_number = vehicle_info[2]
-
-                                    # 新しい形式で行を追加
-                                    formatted_line = f"| {card_number} | {month_number} | {formatted_date} | {vehicle_type} | {vehicle_number} | {entry_ic} | {exit_ic} | {original_fee} | {final_fee} |"
-                                    formatted_lines.append(formatted_line)
-
-                                    # エクセル出力用のデータを保存
-                                    formatted_data.append(
-                                        {
-                                            "カード番号": card_number,
-                                            "利用月": month_number,
-                                            "利用年月日": formatted_date,
-                                            "車種": vehicle_type,
-                                            "車両番号": vehicle_number,
-                                            "入口IC": entry_ic,
-                                            "出口IC": exit_ic,
-                                            "割引前の金額": original_fee,
-                                            "割引後の金額": final_fee,
-                                        }
-                                    )
-
-                            except Exception as e:
-                                logger.warning(f"行の解析中にエラーが発生しました: {e}")
-                                continue
-
-                markdown_text = "\n".join(formatted_lines)
+            if output_format not in OUTPUT_FORMATS:
+                return add_cors_headers(
+                    Response(
+                        {"error": f"Unsupported format: {output_format}"},
+                        status=status.HTTP_400_BAD_REQUEST,
+                    ),
+                    "POST, OPTIONS",
+                )
+
+            logger.debug("Output format: %s", output_format)
+
+            records, report = convert_uploaded_file(file_obj)
 
             # 出力形式に応じてレスポンスを返す
             if output_format == "excel":
                 try:
-                    # DataFrameを作成
-                    df = pd.DataFrame(formatted_data)
-
-                    # Excelファイルを作成
-                    excel_buffer = io.BytesIO()
-                    with pd.ExcelWriter(excel_buffer, engine="openpyxl") as writer:
-                        df.to_excel(writer, index=False, sheet_name="ETCデータ")
-
-                    # レスポンスの作成
-                    excel_buffer.seek(0)
-                    excel_data = excel_buffer.getvalue()
-
-                    response = HttpResponse(
-                        excel_data,
-                        content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    )
-                    response["Content-Disposition"] = (
-                        "attachment; filename=etc_data.xlsx"
-                    )
-                    response["Content-Length"] = len(excel_data)
+                    # Excelファイルを作成してストリーミングで返す
+                    with stage("summary"):
+                        summaries = summarize(records)
+                    with stage("excel"):
+                        response = excel_response(
+                            [(EXCEL_SHEET_NAME, records)], summary_tables(summaries)
+                        )
                     response["Access-Control-Allow-Origin"] = "*"
                     response["Access-Control-Allow-Methods"] = "POST, OPTIONS"
                     response["Access-Control-Allow-Headers"] = (
                         "Content-Type, Accept, X-Requested-With"
                     )
                     response["Access-Control-Expose-Headers"] = "Content-Disposition"
-                    return response
+                    add_summary_headers(response, summaries)
                 except Exception as excel_error:
                     logger.exception("Error creating Excel file")
                     error_response = Response(
@@ -244,18 +275,15 @@ class UploadPDFView(APIView):
                     )
                     return error_response
             else:
-                # 従来のMarkdownレスポンス
-                response_data = {
-                    "markdown": markdown_text,
-                }
-                response = Response(response_data, status=status.HTTP_200_OK)
-                response["Access-Control-Allow-Origin"] = "*"
-                response["Access-Control-Allow-Methods"] = "POST, OPTIONS"
+                # markdown・json・summary・CSV・NDJSON・Parquet
+                response = records_response(records, output_format, "POST, OPTIONS")
                 response["Access-Control-Allow-Headers"] = (
                     "Content-Type, Accept, X-Requested-With"
                 )
-                return response
+            return add_report_headers(response, report)
 
+        except MemoryLimitExceeded as e:
+            return memory_limit_response(e)
         except Exception as e:
             logger.exception("An error occurred during file processing")
             error_response = Response(
@@ -346,6 +374,9 @@ class UploadPDFView(APIView):
 
 class TestPDFView(APIView):
     def post(self, request, *args, **kwargs):
+        return run_view("ocr", self.convert, request)
+
+    def convert(self, request):
         try:
             file = request.FILES.get("file")
             if not file:
@@ -355,67 +386,537 @@ class TestPDFView(APIView):
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
-            # アップロードされたファイルを一時ファイルとして保存
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-                for chunk in file.chunks():
-                    temp_file.write(chunk)
-                temp_file_path = temp_file.name
-                logger.debug(f"File saved to temporary path: {temp_file_path}")
-
-            # PDFを画像に変換してOCRでテキストを抽出
-            extracted_text = self.extract_text_from_pdf(temp_file_path)
-            logger.debug(
-                f"Extracted text (first 100 characters): {extracted_text[:100]}..."
-            )
-
-            # Markdown形式に整形
-            markdown_text = self.format_as_markdown(extracted_text)
-            logger.debug(
-                f"Formatted Markdown text (first 100 characters): {markdown_text[:100]}..."
-            )
-
-            # 一時ファイルを削除
-            os.remove(temp_file_path)
-            logger.debug(f"Temporary file {temp_file_path} deleted.")
+            # OCRはプロセスプール（offload）で実行し、リクエストのスレッドを塞がない
+            # （同じ内容のPDFはキャッシュを使う）
+            source, digest = upload_source(file)
+            if request.data.get("mode") == "table":
+                # 表の範囲だけを列ごとにOCRし、セル単位の表にする
+                markdown_text, _ = convert_in_pool("ocr-table", source, digest)
+            else:
+                # PDFを画像に変換してOCRでテキストを抽出し、Markdown形式に整形
+                markdown_text, _ = convert_in_pool("ocr", source, digest)
+            logger.debug("Formatted Markdown text: %d characters", len(markdown_text))
 
             # Markdown を JSON で返す
             response_data = {"markdown": markdown_text}
-            logger.info(f"Final response: {response_data}")
             return Response(response_data, status=status.HTTP_200_OK)
 
+        except MemoryLimitExceeded as e:
+            return memory_limit_response(e)
         except Exception as e:
             logger.exception("An error occurred during PDF processing.")
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-    def extract_text_from_pdf(self, pdf_path):
-        """PDFからテキストを抽出（OCR処理を含む）"""
-        text = ""
+
+def add_cors_headers(response, methods="GET, POST, OPTIONS"):
+    response["Access-Control-Allow-Origin"] = "*"
+    response["Access-Control-Allow-Methods"] = methods
+    response["Access-Control-Allow-Headers"] = "Content-Type, Accept, X-Requested-With"
+    return response
+
+
+# format=... で指定できる出力形式（ストリーミング形式はSTREAM_RESPONSES）
+OUTPUT_FORMATS = ("markdown", "json", "summary", "excel", *EXPORT_RESPONSES)
+
+
+def records_response(
+    records, output_format, methods="GET, POST, OPTIONS", json_response=Response
+):
+    """レコードを指定された形式（markdown・json・summary・excel・csv・ndjson・parquet）で返す
+
+    json_responseはJSONの形式で返すときに使うレスポンスのクラス。
+    """
+    if output_format == "excel":
+        with stage("summary"):
+            summaries = summarize(records)
+        with stage("excel"):
+            response = excel_response(
+                [(EXCEL_SHEET_NAME, records)], summary_tables(summaries)
+            )
+        response["Access-Control-Expose-Headers"] = "Content-Disposition"
+        return add_cors_headers(add_summary_headers(response, summaries), methods)
+    if output_format in EXPORT_RESPONSES:
+        with stage(output_format):
+            response = EXPORT_RESPONSES[output_format](records)
+        response["Access-Control-Expose-Headers"] = "Content-Disposition"
+        return add_cors_headers(response, methods)
+    if output_format == "summary":
+        summaries = summarize(records)
+        return add_cors_headers(
+            add_summary_headers(json_response(summary_json(summaries)), summaries),
+            methods,
+        )
+    if output_format == "json":
+        headers = output_headers()
+        return add_cors_headers(
+            json_response(
+                {
+                    "headers": headers,
+                    "records": [dict(zip(headers, r)) for r in records],
+                }
+            ),
+            methods,
+        )
+    with stage("markdown"):
+        data = {"markdown": to_markdown(records)}
+    return add_cors_headers(json_response(data), methods)
+
+
+def job_status_data(job):
+    return {
+        "id": str(job.id),
+        "kind": job.kind,
+        "status": job.status,
+        "file_name": job.file_name,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+class ConversionJobListView(APIView):
+    """変換ジョブを登録してすぐにジョブIDを返す"""
+
+    parser_classes = (MultiPartParser, FormParser)
+    renderer_classes = (JSONRenderer,)
+
+    def options(self, request, *args, **kwargs):
+        return add_cors_headers(Response(), "POST, OPTIONS")
+
+    def post(self, request, *args, **kwargs):
+        file_obj = request.FILES.get("file")
+        kind = request.data.get("kind", ConversionJob.Kind.UPLOAD)
+
+        if not file_obj:
+            logger.error("No file uploaded")
+            return add_cors_headers(
+                Response(
+                    {"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST
+                )
+            )
+        if kind not in ConversionJob.Kind.values:
+            return add_cors_headers(
+                Response(
+                    {"error": f"Unknown kind: {kind}"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            )
+
+        try:
+            job = submit_job(kind, file_obj)
+        except QueueFullError as e:
+            response = Response(
+                {"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+            response["Retry-After"] = "30"
+            return add_cors_headers(response)
+
+        return add_cors_headers(
+            Response(job_status_data(job), status=status.HTTP_202_ACCEPTED)
+        )
+
+
+class ConversionJobDetailView(APIView):
+    """変換ジョブの状態を返す"""
+
+    renderer_classes = (JSONRenderer,)
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_object_or_404(ConversionJob.objects.defer("file_data"), pk=job_id)
+        return add_cors_headers(Response(job_status_data(job)))
+
+
+class ConversionJobResultView(APIView):
+    """完了した変換ジョブの結果を返す
+
+    formatはmarkdown・json・summary・excel・csv・ndjson・parquet。
+    """
+
+    renderer_classes = (JSONRenderer,)
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_object_or_404(ConversionJob.objects.defer("file_data"), pk=job_id)
+        output_format = request.query_params.get("format", "markdown")
+
+        if job.status != ConversionJob.Status.DONE:
+            return add_cors_headers(
+                Response(job_status_data(job), status=status.HTTP_409_CONFLICT)
+            )
+
+        if job.kind in MARKDOWN_KINDS:
+            # OCRの結果はMarkdownのみ
+            return add_cors_headers(Response({"markdown": job.result}))
+
+        return records_response(job_records(job), output_format)
+
+
+class HybridPDFView(APIView):
+    """テキストレイヤーのあるページは抽出し、文字のないページだけOCRして変換する
+
+    スキャンしたページが混ざった明細もパターンBと同じ形式のレコードにする。
+    formatはmarkdown・json・summary・excel・csv・ndjson・parquet。
+    """
+
+    parser_classes = (MultiPartParser, FormParser)
+    renderer_classes = (JSONRenderer,)
+
+    def options(self, request, *args, **kwargs):
+        return add_cors_headers(Response(), "POST, OPTIONS")
+
+    def post(self, request, *args, **kwargs):
+        return run_view("hybrid", self.convert, request)
+
+    def convert(self, request):
+        file_obj = request.FILES.get("file")
+        output_format = request.data.get("format", "markdown")
+        if not file_obj:
+            logger.error("No file uploaded")
+            return add_cors_headers(
+                Response(
+                    {"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST
+                ),
+                "POST, OPTIONS",
+            )
+
         try:
-            images = convert_from_path(pdf_path, dpi=300)
-            logger.debug(f"Converted {len(images)} pages from PDF to images.")
-            for i, image in enumerate(images):
-                custom_config = r"--oem 3 --psm 6"
-                page_text = pytesseract.image_to_string(
-                    image, lang="jpn", config=custom_config
+            records, report = convert_uploaded_file(file_obj, "hybrid")
+            return add_report_headers(
+                records_response(records, output_format, "POST, OPTIONS"), report
+            )
+        except MemoryLimitExceeded as e:
+            return memory_limit_response(e)
+        except Exception as e:
+            logger.exception("An error occurred during file processing")
+            return add_cors_headers(
+                Response(
+                    {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                ),
+                "POST, OPTIONS",
+            )
+
+
+def _json_response(data):
+    return JsonResponse(data, json_dumps_params={"ensure_ascii": False})
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncConvertView(View):
+    """ASGIで動かす変換エンドポイント
+
+    PDFの抽出・OCRはプロセスプールで実行し、イベントループを塞がない。
+    kindはupload（テキストレイヤー）・hybrid（文字のないページだけOCR）・
+    ocr（全ページをOCRしてMarkdownテキストで返す）。
+    upload・hybridのformatはmarkdown・json・summary・excel・csv・ndjson・parquet。
+    """
+
+    async def options(self, request, *args, **kwargs):
+        return add_cors_headers(HttpResponse(), "POST, OPTIONS")
+
+    @staticmethod
+    def read_request(request):
+        """(アップロードされたファイル, kind, format) を返す
+
+        multipartの本文を読み込んで解析する（一時ファイルへの書き出しを含む）ため、
+        イベントループの外でsync_to_asyncから呼ぶ。
+        """
+        return (
+            request.FILES.get("file"),
+            request.POST.get("kind", "upload"),
+            request.POST.get("format", "markdown"),
+        )
+
+    async def post(self, request, *args, **kwargs):
+        file_obj, kind, output_format = await sync_to_async(self.read_request)(request)
+        if not file_obj:
+            logger.error("No file uploaded")
+            return add_cors_headers(
+                JsonResponse({"error": "No file uploaded"}, status=400),
+                "POST, OPTIONS",
+            )
+        if kind not in CONVERTERS:
+            return add_cors_headers(
+                JsonResponse({"error": f"Unknown kind: {kind}"}, status=400),
+                "POST, OPTIONS",
+            )
+        if kind not in MARKDOWN_KINDS and output_format not in OUTPUT_FORMATS:
+            return add_cors_headers(
+                JsonResponse(
+                    {"error": f"Unsupported format: {output_format}"}, status=400
+                ),
+                "POST, OPTIONS",
+            )
+
+        try:
+            source, digest = await sync_to_async(upload_source)(file_obj)
+            result, report = await run_conversion(kind, source, digest)
+        except ConversionBusyError as e:
+            return busy_response(e)
+        except MemoryLimitExceeded as e:
+            return memory_limit_response(e)
+        except Exception as e:
+            logger.exception("An error occurred during file processing")
+            return add_cors_headers(
+                JsonResponse(
+                    {"error": str(e)},
+                    status=500,
+                    json_dumps_params={"ensure_ascii": False},
+                ),
+                "POST, OPTIONS",
+            )
+
+        if kind in MARKDOWN_KINDS:
+            # OCRの結果はMarkdownのみ
+            return add_cors_headers(
+                _json_response({"markdown": result}), "POST, OPTIONS"
+            )
+
+        await sync_to_async(save_records_safely)(
+            digest, file_obj.name, result, report.failed_pages
+        )
+        # Excelなどの書き出しもイベントループの外で行う
+        response = await sync_to_async(records_response, thread_sensitive=False)(
+            result, output_format, "POST, OPTIONS", _json_response
+        )
+        return add_report_headers(response, report)
+
+
+class BatchUploadView(APIView):
+    """複数のPDF（またはPDFをまとめたzip）を1つのExcelファイルに変換する
+
+    複数ファイルに含まれる同じ明細は1件にまとめる。
+    split_by_card=true の場合はカード番号ごとにシートを分ける。
+    """
+
+    parser_classes = (MultiPartParser, FormParser)
+    renderer_classes = (JSONRenderer,)
+
+    def options(self, request, *args, **kwargs):
+        return add_cors_headers(Response(), "POST, OPTIONS")
+
+    def post(self, request, *args, **kwargs):
+        return run_view("batch", self.convert, request)
+
+    def convert(self, request):
+        files = request.FILES.getlist("files") + request.FILES.getlist("file")
+        split = request.data.get("split_by_card", "").lower() in ("1", "true", "yes")
+
+        if not files:
+            logger.error("No file uploaded")
+            return add_cors_headers(
+                Response(
+                    {"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST
+                )
+            )
+
+        report = BatchReport()
+        results = []
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                with stage("spool"):
+                    documents = spool_batch(
+                        files,
+                        temp_dir,
+                        getattr(settings, "BATCH_MAX_FILES", 500),
+                        getattr(settings, "BATCH_MAX_UNCOMPRESSED_BYTES", 0),
+                        getattr(settings, "BATCH_MAX_COMPRESSION_RATIO", 0),
+                        report,
+                    )
+                if not documents and not report.failed_files:
+                    raise BatchError("PDFファイルが含まれていません")
+                # ファイルごとにプロセスプールで変換し、失敗したファイルは飛ばす
+                converted = convert_many_in_pool(
+                    "upload", [(path, digest) for _, path, digest in documents]
+                )
+            count("documents", len(documents))
+            with stage("persist"):
+                for (name, _, digest), (
+                    document_records,
+                    document_report,
+                    error,
+                ) in zip(documents, converted):
+                    if error is not None:
+                        logger.warning("Failed to convert %s: %s", name, error)
+                        report.add_failed_file(name, error)
+                        continue
+                    report.add(document_report)
+                    results.append(document_records)
+                    save_records_safely(
+                        digest, name, document_records, document_report.failed_pages
+                    )
+            if not results:
+                return add_cors_headers(
+                    Response(
+                        {
+                            "error": "変換できたPDFファイルがありません",
+                            "failed_files": [
+                                {"name": name, "error": error}
+                                for name, error in report.failed_files
+                            ],
+                        },
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+                )
+        except BatchError as e:
+            return add_cors_headers(
+                Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            )
+        except MemoryLimitExceeded as e:
+            return memory_limit_response(e)
+        except Exception as e:
+            logger.exception("An error occurred during batch processing")
+            return add_cors_headers(
+                Response(
+                    {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+            )
+
+        with stage("merge"):
+            records = merge_records(results)
+        count("merged_rows", len(records))
+        logger.debug(
+            "Merged %d rows from %d files into %d rows",
+            sum(len(r) for r in results),
+            len(documents),
+            len(records),
+        )
+        if split:
+            sheets = split_by_card(records)
+        else:
+            sheets = [(EXCEL_SHEET_NAME, records)]
+
+        with stage("summary"):
+            summaries = summarize(records)
+        with stage("excel"):
+            response = excel_response(sheets, summary_tables(summaries))
+        response["Access-Control-Expose-Headers"] = "Content-Disposition"
+        add_batch_report_headers(response, report)
+        return add_cors_headers(
+            add_summary_headers(response, summaries), "POST, OPTIONS"
+        )
+
+
+def _int_param(params, name, default):
+    """0以上の整数のクエリパラメータを返す（読めなければパラメータ名を示すValueError）"""
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise ValueError(f"{name} must be a non-negative integer: {params[name]!r}")
+    return value
+
+
+class RecordListView(APIView):
+    """保存済みのETC明細を絞り込んで返す（filter_recordsのパラメータ + limit・offset）"""
+
+    renderer_classes = (JSONRenderer,)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            queryset = filter_records(request.query_params)
+            limit = min(_int_param(request.query_params, "limit", 1000), 10000)
+            offset = _int_param(request.query_params, "offset", 0)
+        except ValueError as e:
+            return add_cors_headers(
+                Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            )
+
+        rows = queryset.order_by("card_number", "usage_date", "id").values(
+            "card_number",
+            "usage_date",
+            "vehicle_type",
+            "vehicle_number",
+            "entry_ic",
+            "exit_ic",
+            "entry_ic_code",
+            "exit_ic_code",
+            "original_fee",
+            "final_fee",
+        )[offset : offset + limit]
+        return add_cors_headers(Response({"records": list(rows)}))
+
+
+class RecordSummaryView(APIView):
+    """保存済みのETC明細を月・カード・車両・ICごとに集計する
+
+    例: /api/records/summary/?group_by=vehicle_number&date_from=2023-07-01&date_to=2023-09-30
+    """
+
+    renderer_classes = (JSONRenderer,)
+
+    def get(self, request, *args, **kwargs):
+        group_by = [
+            group
+            for group in request.query_params.get("group_by", "month").split(",")
+            if group
+        ]
+        unknown = [group for group in group_by if group not in SUMMARY_GROUPS]
+        if unknown:
+            return add_cors_headers(
+                Response(
+                    {"error": f"Unknown group_by: {', '.join(unknown)}"},
+                    status=status.HTTP_400_BAD_REQUEST,
                 )
-                text += f"--- Page {i + 1} ---\n{page_text}\n"
-                logger.debug(f"Processed OCR for page {i + 1}")
+            )
+
+        try:
+            queryset = filter_records(request.query_params)
+        except ValueError as e:
+            return add_cors_headers(
+                Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            )
+        return add_cors_headers(
+            Response({"summary": list(summarize_records(queryset, group_by))})
+        )
+
+
+class SummaryView(APIView):
+    """アップロードされたPDFのカード別・車両別の月次集計をJSONで返す"""
+
+    parser_classes = (MultiPartParser, FormParser)
+    renderer_classes = (JSONRenderer,)
+
+    def options(self, request, *args, **kwargs):
+        return add_cors_headers(Response(), "POST, OPTIONS")
+
+    def post(self, request, *args, **kwargs):
+        return run_view("summary", self.convert, request)
+
+    def convert(self, request):
+        file_obj = request.FILES.get("file")
+        if not file_obj:
+            logger.error("No file uploaded")
+            return add_cors_headers(
+                Response(
+                    {"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST
+                ),
+                "POST, OPTIONS",
+            )
+
+        try:
+            records, report = convert_uploaded_file(file_obj)
+            with stage("summary"):
+                summaries = summarize(records)
+                data = summary_json(summaries)
+        except MemoryLimitExceeded as e:
+            return memory_limit_response(e)
         except Exception as e:
-            logger.error(f"Error during OCR processing: {e}")
-            raise Exception(f"Error during OCR processing: {e}")
-        return text
-
-    def format_as_markdown(self, text):
-        """抽出されたテキストをMarkdown形式に変換"""
-        lines = text.split("\n")
-        markdown_lines = []
-        for line in lines:
-            if line.startswith("--- Page"):
-                markdown_lines.append(f"## {line}")
-            elif line.strip():
-                markdown_lines.append(line)
-        formatted_text = "\n".join(markdown_lines)
-        logger.debug("Markdown formatting completed.")
-        return formatted_text
+            logger.exception("An error occurred during file processing")
+            return add_cors_headers(
+                Response(
+                    {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                ),
+                "POST, OPTIONS",
+            )
+        response = add_summary_headers(Response(data), summaries)
+        return add_report_headers(add_cors_headers(response, "POST, OPTIONS"), report)
+
+
+class MetricsView(APIView):
+    """段階ごとの処理時間・ページ数・行数をPrometheusのテキスト形式で返す"""
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -13,4 +13,7 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
-application = get_asgi_application()
+from pdfupload.middleware import limit_request_body  # noqa: E402
+
+# チャンク転送のアップロードも、受信したバイト数でMAX_UPLOAD_BYTESを超えたら断る
+application = limit_request_body(get_asgi_application())
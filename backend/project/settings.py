@@ -23,6 +23,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'pdfupload.middleware.upload_size_limit_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -67,6 +68,152 @@ DATABASES = {
 }
 
 
+# ?format= は出力形式（markdown/json/excel）の指定に使うので、
+# DRFのレンダラー切り替えには使わない
+REST_FRAMEWORK = {
+    "URL_FORMAT_OVERRIDE": None,
+}
+
+
+# PDF extraction
+# 2以上にするとページ範囲ごとにプロセスプールで並列抽出する
+
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", default=1))
+
+
+# Memory limits
+# PDF_PAGE_WINDOW: 一度にMarkdownへ変換するページ数（小さくするとメモリは減るが遅くなる）
+# PDF_MEMORY_LIMIT_MB: 1件の変換で増えてよいRSS（超えたら413を返す。0で無制限）
+
+PDF_PAGE_WINDOW = int(os.environ.get("PDF_PAGE_WINDOW", default=8))
+PDF_MEMORY_LIMIT_MB = int(os.environ.get("PDF_MEMORY_LIMIT_MB", default=512))
+
+
+# Upload
+# この大きさまでのアップロードはメモリ上に保持し、ディスクを経由せずにPDFを開く
+# （超えた場合はDjangoが書き出した一時ファイルをmmapして開く）
+
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(
+    os.environ.get("FILE_UPLOAD_MAX_MEMORY_SIZE", default=10 * 1024 * 1024)
+)
+# これを超えるリクエストは本文を解析する前に413で断る（0で無制限）
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", default=50 * 1024 * 1024))
+
+
+# Conversion limits
+# CONVERSION_WORKERS: 抽出・OCRを実行するプロセス数（バッチのファイルもここで並列に変換する）
+# CONVERSION_MAX_CONCURRENCY: 1プロセスで同時に実行する変換の数
+# CONVERSION_QUEUE_TIMEOUT: 空きを待つ秒数（超えたら503を返す）
+
+CONVERSION_WORKERS = int(
+    os.environ.get("CONVERSION_WORKERS", default=os.cpu_count() or 1)
+)
+CONVERSION_MAX_CONCURRENCY = int(
+    os.environ.get("CONVERSION_MAX_CONCURRENCY", default=CONVERSION_WORKERS)
+)
+CONVERSION_QUEUE_TIMEOUT = float(
+    os.environ.get("CONVERSION_QUEUE_TIMEOUT", default=30)
+)
+
+
+# Batch upload
+# BATCH_MAX_UNCOMPRESSED_BYTES: 1つのzipから展開してよい合計バイト数（0で無制限）
+# BATCH_MAX_COMPRESSION_RATIO: zip内のファイルの圧縮率（展開後/圧縮後）の上限（0で無制限）
+
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", default=500))
+BATCH_MAX_UNCOMPRESSED_BYTES = int(
+    os.environ.get("BATCH_MAX_UNCOMPRESSED_BYTES", default=500 * 1024 * 1024)
+)
+BATCH_MAX_COMPRESSION_RATIO = int(
+    os.environ.get("BATCH_MAX_COMPRESSION_RATIO", default=100)
+)
+
+
+# OCR
+# OCR_DRAFT_DPIを指定すると先に低解像度でOCRし、
+# 平均信頼度がOCR_MIN_CONFIDENCE未満のページだけOCR_DPIで再OCRする
+
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", default=os.cpu_count() or 1))
+OCR_DPI = int(os.environ.get("OCR_DPI", default=300))
+OCR_DRAFT_DPI = int(os.environ.get("OCR_DRAFT_DPI", default=0))
+OCR_MIN_CONFIDENCE = float(os.environ.get("OCR_MIN_CONFIDENCE", default=80))
+
+
+# Hybrid conversion (/api/convert/)
+# テキストレイヤーの文字数がHYBRID_MIN_TEXT_CHARS未満のページだけOCRする
+
+HYBRID_MIN_TEXT_CHARS = int(os.environ.get("HYBRID_MIN_TEXT_CHARS", default=20))
+
+
+# Interchange master
+# IC_MASTER_PATH: ICのマスタのCSV（code,name,road,aliases）。未指定の場合は同梱のものを使う
+# IC_MASTER_COMPLETE: マスタがすべてのICを含む場合だけ1にする。OCRで読み取ったIC名を
+# マスタの最も近い名前に補正する（同梱のマスタは一部のICだけなので補正しない）
+
+IC_MASTER_PATH = os.environ.get("IC_MASTER_PATH", default="") or None
+IC_MASTER_COMPLETE = bool(int(os.environ.get("IC_MASTER_COMPLETE", default=0)))
+
+
+# PDF result cache
+# PDF_CACHE_BACKEND: "disk"（PDF_CACHE_DIRに保存）または "django"（CACHESのPDF_CACHE_ALIASを使用）
+# 未指定の場合はキャッシュしない
+# "django"はプロセス間で共有できるキャッシュ（Redis・Memcached・DatabaseCacheなど）が必要。
+# CACHESを設定していない（LocMemCacheの）場合は "disk" として動く
+
+PDF_CACHE_BACKEND = os.environ.get("PDF_CACHE_BACKEND", default="")
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR", default=str(BASE_DIR / "cache"))
+PDF_CACHE_MAX_BYTES = int(
+    os.environ.get("PDF_CACHE_MAX_BYTES", default=256 * 1024 * 1024)
+)
+PDF_CACHE_ALIAS = os.environ.get("PDF_CACHE_ALIAS", default="default")
+
+
+# Conversion jobs
+# JOB_WORKERS: 同時に実行するジョブ数
+# JOB_QUEUE_LIMIT: 待機中・処理中のジョブがこの数に達したら新規登録を断る
+# JOB_LEASE_SECONDS: 処理中のジョブの更新がこの秒数途絶えたら、ワーカーが落ちたとみなして待機中に戻す
+# JOB_MAX_ATTEMPTS: 待機中に戻すのはこの回数まで（超えたら失敗にする）
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", default=2))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", default=100))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", default=300))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", default=3))
+
+
+# Output
+# OUTPUT_TRIP_TIMES: markdown・json・Excelの出力に入口時刻・出口時刻の列を加える
+# （列が増えるので、列の位置で読んでいるクライアントがなければ有効にする）
+
+OUTPUT_TRIP_TIMES = bool(int(os.environ.get("OUTPUT_TRIP_TIMES", default=0)))
+
+
+# 変換したETC明細をDB（pdfupload.EtcRecord）に保存する
+
+PERSIST_RECORDS = bool(int(os.environ.get("PERSIST_RECORDS", default=1)))
+
+
+# Logging / metrics
+# LOG_LEVEL: pdfupload配下のログレベル（DEBUGにすると処理の詳細を出力する）
+# SERVER_TIMING: 段階ごとの処理時間をServer-Timingヘッダーで返す
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", default="INFO")
+SERVER_TIMING = bool(int(os.environ.get("SERVER_TIMING", default=0)))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "simple": {"format": "%(asctime)s [%(levelname)s] %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "simple"},
+    },
+    "loggers": {
+        "pdfupload": {"handlers": ["console"], "level": LOG_LEVEL},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 